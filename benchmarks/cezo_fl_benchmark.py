@@ -0,0 +1,429 @@
+"""
+Round throughput of CeZO-FL: CeZO_Server.train_one_step on synthetic data, swept over models,
+num_clients, num_sample_clients, local_update_steps, num_pert and client staleness.
+
+Every configuration runs in a fresh process, so its peak RSS is its own. Per configuration:
+- rounds_per_second, forwards_per_second: forwards are client model forwards, counted from the
+  grad estimator's settings (a vmap-ed forward over several clients counts once per client),
+- replay_seconds_per_pull: time a sampled client spends catching up with the server records,
+- records_per_pull: how many records that is, about staleness + the sampling staleness,
+- bytes_per_round: what the rounds would exchange with --client-executor network (TASK and
+  RESULT messages), whatever executor ran them,
+- peak_rss_mb: peak resident memory of the process running the configuration.
+staleness is the number of extra records added to the server before every round, so every
+sampled client replays at least that many on its pull.
+
+Results are written as JSON with --output. --baseline compares them with a saved file and exits
+with status 1 when a metric regressed by more than --tolerance; --load compares a saved file
+instead of running the sweep.
+
+usage: python -m benchmarks.cezo_fl_benchmark [--models CNN_MNIST LeNet] [--num-clients 10 100]
+    [--num-sample-clients 5] [--local-update-steps 1 5] [--num-pert 1 5] [--staleness 0 10]
+    [--num-rounds 5] [--client-executor serial] [--output results.json]
+    [--baseline baseline.json] [--tolerance 0.1] [--load results.json] [--cuda]
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Sequence
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from cezo_fl.batched_clients import BatchedClientExecutor
+from cezo_fl.client import ResetClient
+from cezo_fl.client_executor import ThreadPoolClientExecutor
+from cezo_fl.server import (
+    AbstractClientExecutor,
+    CeZO_Server,
+    ClientTask,
+    LocalUpdateResult,
+    run_client_task,
+)
+from cezo_fl.transport import encode_result, encode_task
+from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+from models.cnn_cifar10 import CNN_CIFAR10
+from models.cnn_fashion import CNN_FMNIST
+from models.cnn_mnist import CNN_MNIST
+from models.lenet import LeNet
+from models.lstm import CharLSTM
+from models.resnet import Resnet20
+from shared.metrics import accuracy
+
+
+def _images(channels: int, size: int, num_classes: int):
+    def make_data(num_samples: int, generator: torch.Generator):
+        return (
+            torch.randn(num_samples, channels, size, size, generator=generator),
+            torch.randint(0, num_classes, (num_samples,), generator=generator),
+        )
+
+    return make_data
+
+
+def _characters(num_samples: int, generator: torch.Generator):
+    return (
+        torch.randint(0, 80, (num_samples, 80), generator=generator),
+        torch.randint(0, 80, (num_samples,), generator=generator),
+    )
+
+
+# model name: (model constructor, synthetic (inputs, labels) of n samples)
+MODELS: dict[str, tuple[Callable[[], torch.nn.Module], Callable]] = {
+    "CNN_MNIST": (CNN_MNIST, _images(1, 28, 10)),
+    "CNN_FMNIST": (CNN_FMNIST, _images(1, 28, 62)),
+    "LeNet": (LeNet, _images(3, 32, 10)),
+    "CNN_CIFAR10": (CNN_CIFAR10, _images(3, 32, 10)),
+    "Resnet20": (Resnet20, _images(3, 32, 10)),
+    "CharLSTM": (CharLSTM, _characters),
+}
+
+# metric: whether higher is better
+METRICS = {
+    "rounds_per_second": True,
+    "forwards_per_second": True,
+    "replay_seconds_per_pull": False,
+    "records_per_pull": False,
+    "bytes_per_round": False,
+    "peak_rss_mb": False,
+}
+
+
+class TimedResetClient(ResetClient):
+    """ResetClient that keeps the time spent in pull_model and the number of records replayed."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pull_seconds = 0.0
+        self.num_pulls = 0
+        self.num_pulled_records = 0
+
+    def pull_model(self, seeds_list, gradient_scalar, snapshot=None) -> None:
+        start = time.perf_counter()
+        super().pull_model(seeds_list, gradient_scalar, snapshot=snapshot)
+        self.pull_seconds += time.perf_counter() - start
+        self.num_pulls += 1
+        self.num_pulled_records += len(seeds_list)
+
+
+class MeteredClientExecutor(AbstractClientExecutor):
+    """
+    Runs tasks with `client_executor` (inline without one) and counts the bytes of the TASK and
+    RESULT messages the network executor would send for them. Encoding time is kept apart, so it
+    can be left out of the round time.
+    """
+
+    def __init__(self, clients, client_executor: AbstractClientExecutor | None):
+        self.clients = clients
+        self.num_clients = len(clients)
+        self.client_executor = client_executor
+        self.num_bytes = 0
+        self.encode_seconds = 0.0
+
+    def _count(self, messages: Sequence[bytes]) -> None:
+        # 5-byte header per message, see cezo_fl/transport.py
+        self.num_bytes += sum(len(message) + 5 for message in messages)
+
+    def run(self, tasks: Sequence[ClientTask]) -> list[LocalUpdateResult]:
+        start = time.perf_counter()
+        self._count([encode_task(task) for task in tasks])
+        self.encode_seconds += time.perf_counter() - start
+        if self.client_executor is None:
+            results = [run_client_task(self.clients[task.client_index], task) for task in tasks]
+        else:
+            results = self.client_executor.run(tasks)
+        start = time.perf_counter()
+        self._count([encode_result(result) for result in results])
+        self.encode_seconds += time.perf_counter() - start
+        return results
+
+    def submit(self, task: ClientTask):
+        raise NotImplementedError("MeteredClientExecutor only runs synchronous rounds")
+
+    def set_learning_rate(self, lr: float) -> None:
+        if self.client_executor is not None:
+            self.client_executor.set_learning_rate(lr)
+
+    def set_perturbation(self, num_pert: int) -> None:
+        if self.client_executor is not None:
+            self.client_executor.set_perturbation(num_pert)
+
+    def shutdown(self) -> None:
+        if self.client_executor is not None:
+            self.client_executor.shutdown()
+
+
+def forwards_per_local_update(grad_estimator: RGE) -> int:
+    """
+    Client model forwards of one local update step of ResetClient, train metrics reuse the
+    estimate's forwards (the clients are built without exact_metrics_interval).
+    """
+    if grad_estimator.grad_estimate_method == "forward":
+        return grad_estimator.num_pert + 1
+    return 2 * grad_estimator.num_pert
+
+
+def build_client(config: dict, client_index: int, device: torch.device) -> TimedResetClient:
+    model_fn, make_data = MODELS[config["model"]]
+    torch.manual_seed(0)
+    model = model_fn().to(device)
+    inputs, labels = make_data(
+        config["samples_per_client"], torch.Generator().manual_seed(client_index)
+    )
+    dataloader = DataLoader(
+        TensorDataset(inputs, labels),
+        batch_size=config["batch_size"],
+        shuffle=True,
+        generator=torch.Generator().manual_seed(client_index),
+    )
+    return TimedResetClient(
+        model,
+        dataloader,
+        RGE(model, mu=1e-3, num_pert=config["num_pert"], device=device),
+        torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9, weight_decay=1e-5),
+        torch.nn.CrossEntropyLoss(),
+        accuracy,
+        device,
+    )
+
+
+def add_stale_records(server: CeZO_Server, num_records: int, num_pert: int) -> None:
+    for _ in range(num_records):
+        server.seed_grad_records.add_records(
+            seeds=server.draw_local_update_seeds(),
+            grad=[torch.randn(num_pert) * 1e-3 for _ in range(server.local_update_steps)],
+        )
+
+
+def run_config(config: dict) -> dict[str, float]:
+    """Metrics of one configuration, meant to run in a fresh process (see run_sweep)."""
+    random.seed(0)
+    device = torch.device(config["device"])
+    clients = [build_client(config, i, device) for i in range(config["num_clients"])]
+    if config["client_executor"] == "thread":
+        inner_executor = ThreadPoolClientExecutor(clients, config["num_client_workers"])
+    elif config["client_executor"] == "batched":
+        inner_executor = BatchedClientExecutor(clients)
+    else:
+        inner_executor = None
+    client_executor = MeteredClientExecutor(clients, inner_executor)
+    server = CeZO_Server(
+        clients,
+        device,
+        num_sample_clients=config["num_sample_clients"],
+        local_update_steps=config["local_update_steps"],
+        client_executor=client_executor,
+    )
+
+    def train_one_round() -> None:
+        add_stale_records(server, config["staleness"], config["num_pert"])
+        server.train_one_step(server.seed_grad_records.num_records)
+
+    try:
+        with torch.no_grad():
+            for _ in range(config["warmup_rounds"]):
+                train_one_round()
+            for client in clients:
+                client.pull_seconds, client.num_pulls, client.num_pulled_records = 0.0, 0, 0
+            client_executor.num_bytes, client_executor.encode_seconds = 0, 0.0
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(config["num_rounds"]):
+                train_one_round()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start - client_executor.encode_seconds
+    finally:
+        client_executor.shutdown()
+
+    num_rounds = config["num_rounds"]
+    num_pulls = sum(client.num_pulls for client in clients)
+    num_forwards = (
+        num_rounds
+        * config["num_sample_clients"]
+        * config["local_update_steps"]
+        * forwards_per_local_update(clients[0].grad_estimator)
+    )
+    return {
+        "rounds_per_second": num_rounds / elapsed,
+        "forwards_per_second": num_forwards / elapsed,
+        "replay_seconds_per_pull": sum(client.pull_seconds for client in clients) / num_pulls,
+        "records_per_pull": sum(client.num_pulled_records for client in clients) / num_pulls,
+        "bytes_per_round": client_executor.num_bytes / num_rounds,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def get_configs(args) -> list[dict[str, Any]]:
+    configs = []
+    for model, num_clients, num_sample_clients, local_update_steps, num_pert, staleness in (
+        itertools.product(
+            args.models,
+            args.num_clients,
+            args.num_sample_clients,
+            args.local_update_steps,
+            args.num_pert,
+            args.staleness,
+        )
+    ):
+        if num_sample_clients > num_clients:
+            continue
+        configs.append(
+            {
+                "model": model,
+                "num_clients": num_clients,
+                "num_sample_clients": num_sample_clients,
+                "local_update_steps": local_update_steps,
+                "num_pert": num_pert,
+                "staleness": staleness,
+                "num_rounds": args.num_rounds,
+                "warmup_rounds": args.warmup_rounds,
+                "batch_size": args.batch_size,
+                "samples_per_client": args.samples_per_client,
+                "client_executor": args.client_executor,
+                "num_client_workers": args.num_client_workers,
+                "device": "cuda" if args.cuda and torch.cuda.is_available() else "cpu",
+            }
+        )
+    return configs
+
+
+def run_sweep(configs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    results = []
+    for config in configs:
+        # one spawned process per configuration, for a clean peak RSS and CUDA state
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            metrics = pool.submit(run_config, config).result()
+        results.append({"config": config, "metrics": metrics})
+        print(format_result(config, metrics), flush=True)
+    return results
+
+
+def format_config(config: dict[str, Any]) -> str:
+    return (
+        f"{config['model']:<12} C={config['num_clients']:<4} S={config['num_sample_clients']:<4} "
+        f"K={config['local_update_steps']:<3} P={config['num_pert']:<3} "
+        f"stale={config['staleness']:<4}"
+    )
+
+
+def format_result(config: dict[str, Any], metrics: dict[str, float]) -> str:
+    return (
+        f"{format_config(config)} "
+        f"rounds/s={metrics['rounds_per_second']:<9.3f} "
+        f"fwd/s={metrics['forwards_per_second']:<10.1f} "
+        f"replay={metrics['replay_seconds_per_pull'] * 1e3:.2f}ms/pull "
+        f"({metrics['records_per_pull']:.1f} records) "
+        f"bytes/round={metrics['bytes_per_round']:.0f} "
+        f"rss={metrics['peak_rss_mb']:.0f}MB"
+    )
+
+
+def _config_key(config: dict[str, Any]) -> str:
+    return json.dumps(config, sort_keys=True)
+
+
+def compare(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float
+) -> list[str]:
+    """
+    Print every metric next to its baseline and return the regressions, metrics worse than the
+    baseline by more than `tolerance` (relative). Configurations missing in either are skipped.
+    """
+    baseline_metrics = {_config_key(entry["config"]): entry["metrics"] for entry in baseline}
+    regressions = []
+    for entry in results:
+        base = baseline_metrics.get(_config_key(entry["config"]))
+        if base is None:
+            print(f"no baseline: {_config_key(entry['config'])}")
+            continue
+        name = format_config(entry["config"])
+        for metric, higher_is_better in METRICS.items():
+            value, base_value = entry["metrics"][metric], base[metric]
+            change = (value - base_value) / base_value if base_value else 0.0
+            regressed = -change > tolerance if higher_is_better else change > tolerance
+            print(
+                f"{name} {metric:<24} {base_value:>12.4g} -> {value:>12.4g} {change:+8.1%}"
+                + (" REGRESSION" if regressed else "")
+            )
+            if regressed:
+                regressions.append(f"{name} {metric} {change:+.1%}")
+    return regressions
+
+
+def save_results(path: str, results: list[dict[str, Any]]) -> None:
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "metadata": {
+                    "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "torch": torch.__version__,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "processor": platform.processor(),
+                    "num_threads": torch.get_num_threads(),
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_results(path: str) -> list[dict[str, Any]]:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CeZO-FL round throughput benchmark")
+    parser.add_argument("--models", nargs="+", choices=list(MODELS), default=list(MODELS))
+    parser.add_argument("--num-clients", nargs="+", type=int, default=[10, 100])
+    parser.add_argument("--num-sample-clients", nargs="+", type=int, default=[5])
+    parser.add_argument("--local-update-steps", nargs="+", type=int, default=[1, 5])
+    parser.add_argument("--num-pert", nargs="+", type=int, default=[1, 5])
+    parser.add_argument("--staleness", nargs="+", type=int, default=[0, 10])
+    parser.add_argument("--num-rounds", type=int, default=5)
+    parser.add_argument("--warmup-rounds", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--samples-per-client", type=int, default=256)
+    parser.add_argument(
+        "--client-executor", choices=["serial", "thread", "batched"], default="serial"
+    )
+    parser.add_argument("--num-client-workers", type=int, default=4)
+    parser.add_argument("--cuda", action="store_true", default=False)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument(
+        "--load", type=str, default=None, help="Compare these JSON results instead of running"
+    )
+    args = parser.parse_args()
+
+    if args.load is not None:
+        results = load_results(args.load)
+    else:
+        results = run_sweep(get_configs(args))
+    if args.output is not None:
+        save_results(args.output, results)
+    if args.baseline is not None:
+        regressions = compare(results, load_results(args.baseline), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
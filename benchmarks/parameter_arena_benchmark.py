@@ -0,0 +1,66 @@
+"""
+Benchmark perturb/restore/grad installation of RGE with and without the flat parameter arena.
+
+usage: python -m benchmarks.parameter_arena_benchmark [--num-steps 100] [--num-pert 5] [--cuda]
+"""
+
+import argparse
+import time
+
+import torch
+
+from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+from models.lstm import CharLSTM
+from models.resnet import Resnet20
+
+MODELS = {
+    "Resnet20": Resnet20,
+    "CharLSTM": CharLSTM,
+}
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def time_parameter_sweeps(
+    model_fn, flat_parameters: bool, num_steps: int, num_pert: int, device: torch.device
+) -> float:
+    """Seconds per step spent in the central-difference sweeps, excluding the forwards."""
+    torch.manual_seed(0)
+    model = model_fn().to(device)
+    rge = RGE(model, num_pert=num_pert, device=device, flat_parameters=flat_parameters)
+    perturbs = [rge.generate_perturbation_norm() for _ in range(num_pert)]
+    grad = torch.randn(rge.total_dimensions, device=device)
+
+    with torch.no_grad():
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            for perturb in perturbs:
+                rge.perturb_model(perturb, alpha=rge.mu)
+                rge.perturb_model(perturb, alpha=-2 * rge.mu)
+                rge.perturb_model(perturb, alpha=rge.mu)
+            rge.put_grad(grad)
+        synchronize(device)
+    return (time.perf_counter() - start) / num_steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flat parameter arena benchmark")
+    parser.add_argument("--num-steps", type=int, default=100)
+    parser.add_argument("--num-pert", type=int, default=5)
+    parser.add_argument("--cuda", action="store_true", default=False)
+    args = parser.parse_args()
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+
+    print(f"{'model':<10} {'#tensors':>10} {'loop (ms)':>10} {'arena (ms)':>11} {'speedup':>8}")
+    for model_name, model_fn in MODELS.items():
+        num_parameters = len(list(model_fn().parameters()))
+        loop_time = time_parameter_sweeps(model_fn, False, args.num_steps, args.num_pert, device)
+        arena_time = time_parameter_sweeps(model_fn, True, args.num_steps, args.num_pert, device)
+        print(
+            f"{model_name:<10} {num_parameters:>10} {loop_time * 1e3:>10.3f} "
+            f"{arena_time * 1e3:>11.3f} {loop_time / arena_time:>7.2f}x"
+        )
@@ -0,0 +1,99 @@
+"""
+Load test of the networked CeZO-FL transport: how many client rounds per second one server process
+drives. Clients are stubs that return immediately, so only the protocol, the sockets and the
+server's event loop are measured.
+
+usage: python -m benchmarks.transport_load_benchmark [--num-clients 1000] [--num-workers 8]
+    [--num-rounds 20] [--local-update-steps 10] [--num-pert 5] [--unix]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from functools import partial
+
+import torch
+
+from cezo_fl.server import AbstractClient, ClientTask, LocalUpdateResult
+from cezo_fl.transport import NetworkClientExecutor
+
+
+class StubClient(AbstractClient):
+    def __init__(self, num_pert: int):
+        self.num_pert = num_pert
+
+    def pull_model(self, seeds_list, gradient_scalar, snapshot=None) -> None:
+        return
+
+    def local_update(self, seeds) -> LocalUpdateResult:
+        return LocalUpdateResult(
+            grad_tensors=[torch.zeros(self.num_pert) for _ in seeds],
+            step_accuracy=0.0,
+            step_loss=0.0,
+        )
+
+
+def run_load_test(
+    num_clients: int,
+    num_workers: int,
+    num_rounds: int,
+    local_update_steps: int,
+    num_pert: int,
+    address: str,
+) -> dict[str, float]:
+    client_executor = NetworkClientExecutor(num_clients, address=address)
+    try:
+        client_executor.spawn_local_workers(
+            [partial(StubClient, num_pert) for _ in range(num_clients)], num_workers
+        )
+        seeds = torch.zeros(1, local_update_steps, dtype=torch.int64)
+        grads = torch.zeros(1, local_update_steps, num_pert)
+        tasks = [
+            # every client replays one iteration of records, as in a round with all clients
+            ClientTask(i, seeds, list(grads), list(range(local_update_steps)))
+            for i in range(num_clients)
+        ]
+        client_executor.run(tasks)  # warm up
+        bytes_sent, bytes_received = client_executor.bytes_sent, client_executor.bytes_received
+        start = time.perf_counter()
+        for _ in range(num_rounds):
+            client_executor.run(tasks)
+        elapsed = time.perf_counter() - start
+        num_tasks = num_rounds * num_clients
+        return {
+            "rounds_per_second": num_rounds / elapsed,
+            "client_rounds_per_second": num_tasks / elapsed,
+            "bytes_per_pull": (client_executor.bytes_sent - bytes_sent) / num_tasks,
+            "bytes_per_push": (client_executor.bytes_received - bytes_received) / num_tasks,
+        }
+    finally:
+        client_executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CeZO-FL transport load test")
+    parser.add_argument("--num-clients", type=int, default=1000)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--num-rounds", type=int, default=20)
+    parser.add_argument("--local-update-steps", type=int, default=10)
+    parser.add_argument("--num-pert", type=int, default=5)
+    parser.add_argument("--unix", action="store_true", default=False)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        address = f"unix:{os.path.join(tmp_dir, 'cezo_fl.sock')}" if args.unix else "127.0.0.1:0"
+        result = run_load_test(
+            args.num_clients,
+            args.num_workers,
+            args.num_rounds,
+            args.local_update_steps,
+            args.num_pert,
+            address,
+        )
+    transport = "unix socket" if args.unix else "tcp"
+    print(f"{args.num_clients} clients over {args.num_workers} workers, {transport}")
+    print(f"rounds/s:        {result['rounds_per_second']:.2f}")
+    print(f"client rounds/s: {result['client_rounds_per_second']:.1f}")
+    print(f"bytes per pull:  {result['bytes_per_pull']:.0f}")
+    print(f"bytes per push:  {result['bytes_per_push']:.0f}")
@@ -0,0 +1,146 @@
+import torch
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass
+
+from cezo_fl.server import CeZO_Server, ClientTask, LocalUpdateResult, run_client_task
+from cezo_fl.shared import update_model_given_seed_and_grad
+from shared.metrics import Metric
+
+
+@dataclass
+class BufferedUpdate:
+    client_index: int
+    seeds: tuple[int, ...]
+    # num_records of the server when the client pulled, i.e. the version it trained on
+    version: int
+    result: LocalUpdateResult
+
+
+class BufferedAsyncCeZO_Server(CeZO_Server):
+    """
+    Asynchronous CeZO-FL with buffered aggregation (FedBuff). num_sample_clients clients train at
+    any time, each from the server model it pulled when it was dispatched; an idle client is
+    dispatched as soon as one finishes. Finished updates wait in a buffer and every buffer_size of
+    them are aggregated into the records, so train_one_step returns after one aggregation instead
+    of waiting for a fixed set of clients.
+
+    Clients dispatched at the same server version share its local update seeds, so the buffer is
+    aggregated per version: one record (K seeds, K summed scalar vectors) for each version in the
+    buffer, oldest first. Every update is weighted by (1 + staleness) ** -staleness_exponent /
+    buffer_size, staleness being the number of records added since the client pulled. The
+    staleness of every aggregated update is kept in `staleness`.
+
+    Clients run through client_executor.submit, without one they run inline when dispatched, which
+    is only useful for testing.
+    """
+
+    def __init__(self, *args, buffer_size: int, staleness_exponent: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer_size = buffer_size
+        self.staleness_exponent = staleness_exponent
+        self.buffer: list[BufferedUpdate] = []
+        self.in_flight: dict[Future, tuple[int, tuple[int, ...], int]] = {}
+        self.version_seeds: tuple[int, tuple[int, ...]] | None = None
+        self.staleness: list[int] = []
+
+    def get_version_seeds(self) -> tuple[int, ...]:
+        version = self.seed_grad_records.num_records
+        if self.version_seeds is None or self.version_seeds[0] != version:
+            self.version_seeds = (version, tuple(self.draw_local_update_seeds()))
+        return self.version_seeds[1]
+
+    def submit(self, task: ClientTask) -> Future:
+        if self.client_executor is not None:
+            return self.client_executor.submit(task)
+        future: Future = Future()
+        future.set_result(run_client_task(self.clients[task.client_index], task))
+        return future
+
+    def get_idle_clients(self) -> tuple[list[int], int]:
+        """The clients not training and how many of them dispatch() starts."""
+        busy_clients = {client_index for client_index, _, _ in self.in_flight.values()}
+        idle_clients = [i for i in range(self.num_clients) if i not in busy_clients]
+        num_new_clients = min(self.num_sample_clients - len(self.in_flight), len(idle_clients))
+        return idle_clients, num_new_clients
+
+    def expected_replay_cost(self) -> float:
+        """Records the clients dispatch() starts now are expected to replay in total."""
+        idle_clients, num_new_clients = self.get_idle_clients()
+        if num_new_clients <= 0:
+            return 0.0
+        return self.client_sampler.expected_replay_cost(
+            self.get_client_staleness(), num_new_clients, candidates=idle_clients
+        )
+
+    def dispatch(self) -> None:
+        """Start idle clients, chosen by the client sampler, until num_sample_clients train."""
+        idle_clients, num_new_clients = self.get_idle_clients()
+        if num_new_clients <= 0:
+            return
+        sampled_client_index = self.client_sampler.sample(
+            self.get_client_staleness(), num_new_clients, candidates=idle_clients
+        )
+        version = self.seed_grad_records.num_records
+        seeds = self.get_version_seeds()
+        for index in sampled_client_index:
+            future = self.submit(self.make_client_task(index, list(seeds), version))
+            self.in_flight[future] = (index, seeds, version)
+
+    def collect(self) -> None:
+        """Wait for at least one client to finish and move its update to the buffer."""
+        done, _ = wait(list(self.in_flight), return_when=FIRST_COMPLETED)
+        for future in done:
+            client_index, seeds, version = self.in_flight.pop(future)
+            self.buffer.append(BufferedUpdate(client_index, seeds, version, future.result()))
+
+    def train_one_step(self, iteration: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Train until buffer_size updates are buffered and aggregate them. iteration is only kept
+        for the interface, the records advance by the number of versions in the buffer.
+        """
+        self.dispatch()
+        while len(self.buffer) < self.buffer_size:
+            self.collect()
+            if len(self.buffer) < self.buffer_size:
+                self.dispatch()
+        updates, self.buffer = self.buffer[: self.buffer_size], self.buffer[self.buffer_size :]
+        return self.aggregate(updates)
+
+    def aggregate(self, updates: list[BufferedUpdate]) -> tuple[torch.Tensor, torch.Tensor]:
+        step_train_loss = Metric("Step train loss")
+        step_train_accuracy = Metric("Step train accuracy")
+        num_records = self.seed_grad_records.num_records
+        versions = sorted({update.version for update in updates})
+        for version in versions:
+            group = [update for update in updates if update.version == version]
+            seeds = list(group[0].seeds)
+            grad_scalar: list[torch.Tensor] = [
+                torch.zeros_like(g) for g in group[0].result.grad_tensors
+            ]
+            for update in group:
+                step_train_loss.update(update.result.step_loss)
+                step_train_accuracy.update(update.result.step_accuracy)
+                staleness = num_records - update.version
+                self.staleness.append(staleness)
+                weight = (1 + staleness) ** -self.staleness_exponent / len(updates)
+                for scalar, g in zip(grad_scalar, update.result.grad_tensors):
+                    scalar.add_(g, alpha=weight)
+
+            self.seed_grad_records.add_records(seeds=seeds, grad=grad_scalar)
+            if self.server_model:
+                self.train()
+                update_model_given_seed_and_grad(
+                    self.optim,
+                    self.random_gradient_estimator,
+                    seeds,
+                    grad_scalar,
+                )
+
+        self.snapshot_and_trim_records()
+        return step_train_loss.avg_tensor, step_train_accuracy.avg_tensor
+
+    def wait_for_in_flight(self) -> None:
+        """Let the clients still training finish, their updates are dropped."""
+        wait(list(self.in_flight))
+        self.in_flight.clear()
+        self.buffer.clear()
@@ -0,0 +1,125 @@
+import random
+from concurrent.futures import Future
+import torch
+
+from cezo_fl.async_server import BufferedAsyncCeZO_Server
+from cezo_fl.server import AbstractClientExecutor, CeZO_Server, ClientTask, run_client_task
+from cezo_fl.sampling import RoundRobinSampler
+from cezo_fl.shared import update_model_given_seeds_list_and_grads
+
+
+class FifoExecutor(AbstractClientExecutor):
+    """Runs tasks in submission order, one task finishes per submit once `delay` are pending."""
+
+    def __init__(self, clients, delay: int):
+        self.clients = clients
+        self.num_clients = len(clients)
+        self.delay = delay
+        self.pending: list[tuple[Future, ClientTask]] = []
+
+    def submit(self, task: ClientTask) -> Future:
+        future: Future = Future()
+        self.pending.append((future, task))
+        if len(self.pending) > self.delay:
+            future, task = self.pending.pop(0)
+            future.set_result(run_client_task(self.clients[task.client_index], task))
+        return future
+
+    def run(self, tasks):
+        return NotImplemented
+
+    def set_learning_rate(self, lr: float) -> None:
+        return
+
+    def set_perturbation(self, num_pert: int) -> None:
+        return
+
+
+def test_full_buffer_of_fresh_updates_matches_sync(make_client, set_server_model):
+    server_parameters = []
+    for server_class, kwargs in [(CeZO_Server, {}), (BufferedAsyncCeZO_Server, {"buffer_size": 2})]:
+        random.seed(0)
+        server = server_class(
+            [make_client(i) for i in range(4)],
+            torch.device("cpu"),
+            num_sample_clients=2,
+            local_update_steps=2,
+            **kwargs,
+        )
+        set_server_model(server)
+        with torch.no_grad():
+            for iteration in range(4):
+                server.train_one_step(iteration)
+        server_parameters.append([p.clone() for p in server.server_model.parameters()])
+    assert server.staleness == [0] * 8
+    for sync_parameter, async_parameter in zip(*server_parameters):
+        torch.testing.assert_close(sync_parameter, async_parameter)
+
+
+def test_stale_updates_are_aggregated_per_version(
+    make_model_settings, make_client, set_server_model
+):
+    random.seed(0)
+    clients = [make_client(i) for i in range(4)]
+    server = BufferedAsyncCeZO_Server(
+        clients,
+        torch.device("cpu"),
+        num_sample_clients=3,
+        local_update_steps=2,
+        client_executor=FifoExecutor(clients, delay=2),
+        buffer_size=2,
+    )
+    set_server_model(server)
+    records = server.seed_grad_records
+    seeds_list, grad_list = [], []
+    with torch.no_grad():
+        for iteration in range(5):
+            num_records = records.num_records
+            server.train_one_step(iteration)
+            seeds_list += records.fetch_seed_records(num_records).clone()
+            grad_list += [g.clone() for g in records.fetch_grad_records(num_records)]
+
+    assert len(server.staleness) == 10
+    assert server.staleness[0] == 0
+    assert max(server.staleness) > 0
+    # an aggregation adds one record per client version in the buffer
+    assert 5 <= records.num_records <= 10
+
+    # the records describe the server model, a client replaying them from scratch catches up
+    model, grad_estimator, optimizer, _, _ = make_model_settings()
+    with torch.no_grad():
+        update_model_given_seeds_list_and_grads(optimizer, grad_estimator, seeds_list, grad_list)
+    for server_parameter, parameter in zip(server.server_model.parameters(), model.parameters()):
+        torch.testing.assert_close(server_parameter, parameter)
+
+
+def test_dispatch_uses_client_sampler(make_client):
+    random.seed(0)
+    clients = [make_client(i) for i in range(4)]
+    client_executor = FifoExecutor(clients, delay=1)
+    dispatched = []
+    submit = client_executor.submit
+
+    def recording_submit(task: ClientTask) -> Future:
+        dispatched.append(task.client_index)
+        return submit(task)
+
+    client_executor.submit = recording_submit  # type: ignore[method-assign]
+    sampler = RoundRobinSampler(4)
+    order = list(sampler.order)
+    server = BufferedAsyncCeZO_Server(
+        clients,
+        torch.device("cpu"),
+        num_sample_clients=2,
+        local_update_steps=1,
+        client_executor=client_executor,
+        client_sampler=sampler,
+        buffer_size=1,
+    )
+    with torch.no_grad():
+        for iteration in range(3):
+            assert server.expected_replay_cost() >= 0
+            server.train_one_step(iteration)
+
+    # the first idle client in round-robin order is started whenever one finishes
+    assert dispatched[:4] == order
@@ -0,0 +1,272 @@
+"""
+Batched simulation of many clients in one process: the sampled clients of a round train together,
+their parameters stacked along a leading client dimension and every forward of a local update step
+run for all of them at once with torch.func.vmap.
+
+This only pays off for small models (e.g. CNN_MNIST), whose per-client forwards are too small to
+use the hardware. Clients are ordinary ResetClients, pulls are replayed by each client as usual.
+"""
+
+import torch
+from concurrent.futures import Future
+from torch.func import functional_call, vmap
+from typing import Sequence
+
+from cezo_fl.client import ResetClient
+from cezo_fl.client_executor import set_client_learning_rate, set_client_perturbation
+from cezo_fl.server import AbstractClientExecutor, ClientTask, LocalUpdateResult
+from shared.metrics import Metric
+
+
+class BatchedClientExecutor(AbstractClientExecutor):
+    """
+    Runs the local updates of the clients of a round as one vectorized local update.
+
+    All sampled clients of a round share the local update seeds, so they share the perturbations:
+    they are generated once per step, added to the stacked parameters and the +mu (and -mu) losses
+    of all clients come from one vmap-ed forward over the stacked parameters and their stacked
+    batches. The SGD step is elementwise, so one torch.optim.SGD over the stacked parameters is
+    the step of every client. Parameters and momentum buffers are written back to the clients
+    afterwards, so up to float rounding every client ends up where ResetClient.local_update
+    leaves it and returns the same LocalUpdateResult.
+
+    Requirements, checked when the executor is built:
+    - clients are ResetClients of the same architecture with tensor inputs (no LLM batches),
+    - the grad estimator is an RGE without regenerate_perturbation,
+    - the optimizer is torch.optim.SGD with one param group and dampening=0.
+    Modules updating buffers in place (e.g. BatchNorm in train mode) and random modules (e.g.
+    dropout in train mode) can not run under vmap.
+
+    Clients whose batches have different shapes at a step (e.g. the last batch of an epoch) are
+    evaluated in one vmap-ed forward per shape. submit() runs a single client, use run() to get
+    the batching.
+    """
+
+    def __init__(self, clients: Sequence[ResetClient]):
+        for client in clients:
+            if not isinstance(client, ResetClient):
+                raise ValueError("BatchedClientExecutor only supports ResetClient")
+            if client.grad_estimator.regenerate_perturbation:
+                raise ValueError("BatchedClientExecutor does not support regenerate_perturbation")
+            optimizer = client.optimizer
+            if type(optimizer) is not torch.optim.SGD or len(optimizer.param_groups) != 1:
+                raise ValueError("BatchedClientExecutor requires torch.optim.SGD, one param group")
+            if optimizer.defaults["dampening"] != 0:
+                raise ValueError("BatchedClientExecutor does not support SGD dampening")
+        self.clients = clients
+        self.num_clients = len(clients)
+
+    def run(self, tasks: Sequence[ClientTask]) -> list[LocalUpdateResult]:
+        for task in tasks:
+            self.clients[task.client_index].pull_model(
+                task.seeds_list, task.grad_list, snapshot=task.snapshot
+            )
+        # Tasks of one round share their seeds, the async server may mix versions.
+        groups: dict[tuple[int, ...], list[int]] = {}
+        for i, task in enumerate(tasks):
+            groups.setdefault(tuple(task.local_update_seeds), []).append(i)
+        results: list[LocalUpdateResult] = [None] * len(tasks)  # type: ignore[list-item]
+        for seeds, task_indices in groups.items():
+            clients = [self.clients[tasks[i].client_index] for i in task_indices]
+            for i, result in zip(task_indices, batched_local_update(clients, seeds)):
+                results[i] = result
+        return results
+
+    def submit(self, task: ClientTask) -> Future:
+        future: Future = Future()
+        future.set_result(self.run([task])[0])
+        return future
+
+    def set_learning_rate(self, lr: float) -> None:
+        for client in self.clients:
+            set_client_learning_rate(client, lr)
+
+    def set_perturbation(self, num_pert: int) -> None:
+        for client in self.clients:
+            set_client_perturbation(client, num_pert)
+
+
+def _stack_batches(
+    batches: list[tuple[torch.Tensor, torch.Tensor]]
+) -> list[tuple[list[int], torch.Tensor, torch.Tensor]]:
+    """Group the clients by batch shape, (client positions, stacked inputs, stacked labels)."""
+    groups: dict[tuple, list[int]] = {}
+    for c, (batch_inputs, labels) in enumerate(batches):
+        groups.setdefault((batch_inputs.shape, labels.shape), []).append(c)
+    return [
+        (
+            positions,
+            torch.stack([batches[c][0] for c in positions]),
+            torch.stack([batches[c][1] for c in positions]),
+        )
+        for positions in groups.values()
+    ]
+
+
+@torch.no_grad()
+def batched_local_update(
+    clients: Sequence[ResetClient], seeds: Sequence[int]
+) -> list[LocalUpdateResult]:
+    """ResetClient.local_update(seeds) of every client, computed for all clients at once."""
+    template = clients[0]
+    model, grad_estimator, criterion = template.model, template.grad_estimator, template.criterion
+    device = template.device
+    parameter_names = grad_estimator._get_parameter_names()
+    num_clients = len(clients)
+    mu = grad_estimator.mu
+
+    # Stacked parameters are leaves of their own SGD, built from the clients' hyperparameters.
+    stacked_params = [
+        torch.stack([client.grad_estimator.parameters_list[i] for client in clients])
+        for i in range(len(parameter_names))
+    ]
+    group = template.optimizer.param_groups[0]
+    optimizer = torch.optim.SGD(
+        stacked_params,
+        lr=group["lr"],
+        momentum=group["momentum"],
+        weight_decay=group["weight_decay"],
+        nesterov=group["nesterov"],
+        maximize=group.get("maximize", False),
+    )
+    if group["momentum"] != 0:
+        for i, stacked_param in enumerate(stacked_params):
+            buffers = [
+                client.optimizer.state[client.grad_estimator.parameters_list[i]].get(
+                    "momentum_buffer"
+                )
+                for client in clients
+            ]
+            if any(buffer is not None for buffer in buffers):
+                # Without dampening the first step of a missing buffer equals one from zero.
+                optimizer.state[stacked_param]["momentum_buffer"] = torch.stack(
+                    [
+                        torch.zeros_like(stacked_param[0]) if buffer is None else buffer
+                        for buffer in buffers
+                    ]
+                )
+
+    def client_forward(params, batch_inputs):
+        return functional_call(model, dict(zip(parameter_names, params)), (batch_inputs,))
+
+    def client_loss(params, batch_inputs, labels):
+        pred = client_forward(params, batch_inputs)
+        return criterion(pred, labels), pred
+
+    def select(params: list[torch.Tensor], positions: list[int]) -> list[torch.Tensor]:
+        if len(positions) == num_clients:
+            return params
+        index = torch.tensor(positions, device=device)
+        return [p[index] for p in params]
+
+    def losses(params: list[torch.Tensor], batch_groups) -> tuple[torch.Tensor, list]:
+        """Loss [num_clients] and model output of every client."""
+        client_losses = torch.empty(num_clients, device=device)
+        client_preds: list = [None] * num_clients
+        for positions, batch_inputs, labels in batch_groups:
+            group_losses, group_preds = vmap(client_loss)(
+                select(params, positions), batch_inputs, labels
+            )
+            client_losses[torch.tensor(positions, device=device)] = group_losses
+            for c, pred in zip(positions, group_preds):
+                client_preds[c] = pred
+        return client_losses, client_preds
+
+    def perturbed(params: list[torch.Tensor], perturb: torch.Tensor, alpha: float):
+        perturbed_params, start = [], 0
+        for p in params:
+            _perturb = perturb[start : (start + p[0].numel())].view(p.shape[1:])
+            perturbed_params.append(torch.add(p, _perturb, alpha=alpha))
+            start += p[0].numel()
+        return perturbed_params
+
+    grad_tensors: list[list[torch.Tensor]] = [[] for _ in clients]
+    # one entry per client, accumulated on the device
+    train_loss = Metric("Client train loss")
+    train_accuracy = Metric("Client train accuracy")
+    for seed in seeds:
+        optimizer.zero_grad()
+        batches = []
+        for client in clients:
+            batch_inputs, labels = next(client.data_iterator)
+            if device != torch.device("cpu"):
+                batch_inputs, labels = batch_inputs.to(device), labels.to(device)
+            batches.append((batch_inputs, labels))
+        batch_groups = _stack_batches(batches)
+
+        # Same perturbations, in the same order, as every client's compute_grad.
+        grad_estimator.manual_seed(seed)
+        num_pert = grad_estimator.num_pert
+        perturbs = [grad_estimator.generate_perturbation_norm() for _ in range(num_pert)]
+        # train metrics come from the same forwards as in RGE, see RGE.last_loss
+        dir_grads = []
+        if grad_estimator.grad_estimate_method == "forward":
+            initial_losses, metric_preds = losses(stacked_params, batch_groups)
+            metric_losses = initial_losses
+        else:
+            metric_losses = torch.zeros(num_clients, device=device)
+        for perturb in perturbs:
+            pert_plus = perturbed(stacked_params, perturb, mu)
+            pert_plus_losses, _ = losses(pert_plus, batch_groups)
+            if grad_estimator.grad_estimate_method == "forward":
+                dir_grads.append((pert_plus_losses - initial_losses) / mu)
+            else:
+                pert_minus = perturbed(pert_plus, perturb, -2 * mu)
+                pert_minus_losses, metric_preds = losses(pert_minus, batch_groups)
+                dir_grads.append((pert_plus_losses - pert_minus_losses) / (2 * mu))
+                metric_losses += pert_plus_losses + pert_minus_losses
+            del pert_plus
+        if grad_estimator.grad_estimate_method == "central":
+            metric_losses /= 2 * num_pert
+        client_dir_grads = torch.stack(dir_grads, dim=1)  # [num_clients, num_pert]
+
+        start = 0
+        for p in stacked_params:
+            numel = p[0].numel()
+            grad = torch.zeros_like(p)
+            for k, perturb in enumerate(perturbs):
+                _perturb = perturb[start : (start + numel)].view(p.shape[1:])
+                grad.add_(_perturb * client_dir_grads[:, k].view(-1, *[1] * (p.dim() - 1)))
+            p.grad = grad.div_(num_pert)
+            start += numel
+        optimizer.step()
+
+        for c in range(num_clients):
+            grad_tensors[c].append(client_dir_grads[c].clone())
+
+        exact_clients = set()
+        for c, client in enumerate(clients):
+            client.num_local_steps += 1
+            interval = client.exact_metrics_interval
+            if interval and client.num_local_steps % interval == 0:
+                exact_clients.add(c)
+        step_accuracies: list = [None] * num_clients
+        for positions, batch_inputs, labels in batch_groups:
+            exact_preds = None
+            if exact_clients.intersection(positions):
+                exact_preds = vmap(client_forward)(select(stacked_params, positions), batch_inputs)
+            for i, (c, client_labels) in enumerate(zip(positions, labels)):
+                pred = metric_preds[c]
+                if c in exact_clients:
+                    pred = exact_preds[i]
+                    metric_losses[c] = criterion(pred, client_labels)
+                step_accuracies[c] = template.accuracy_func(pred, client_labels)
+        train_loss.update(metric_losses)
+        train_accuracy.update(torch.stack(step_accuracies))
+
+    for c, client in enumerate(clients):
+        for i, p in enumerate(client.grad_estimator.parameters_list):
+            p.copy_(stacked_params[i][c])
+            stacked_buffer = optimizer.state[stacked_params[i]].get("momentum_buffer")
+            if stacked_buffer is not None:
+                client.optimizer.state[p]["momentum_buffer"] = stacked_buffer[c].clone()
+
+    step_losses, step_accuracies = train_loss.avg_tensor, train_accuracy.avg_tensor
+    return [
+        LocalUpdateResult(
+            grad_tensors=grad_tensors[c],
+            step_accuracy=step_accuracies[c],
+            step_loss=step_losses[c],
+        )
+        for c in range(num_clients)
+    ]
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from cezo_fl.batched_clients import BatchedClientExecutor
+
+
+@pytest.mark.parametrize("grad_estimate_method", ["forward", "central"])
+def test_batched_clients_match_serial(grad_estimate_method, make_client, train_server):
+    def make_clients():
+        # 10 samples in batches of 4, every third batch is smaller
+        return [
+            make_client(
+                i, 10, grad_estimate_method=grad_estimate_method, mu=1e-2, weight_decay=1e-3
+            )
+            for i in range(4)
+        ]
+
+    serial_clients = make_clients()
+    serial_metrics, serial_grads = train_server(serial_clients, None, num_sample_clients=3)
+
+    batched_clients = make_clients()
+    batched_metrics, batched_grads = train_server(
+        batched_clients, BatchedClientExecutor(batched_clients), num_sample_clients=3
+    )
+
+    for (loss, acc), (batched_loss, batched_acc) in zip(serial_metrics, batched_metrics):
+        assert batched_loss == pytest.approx(loss, rel=1e-4)
+        assert batched_acc == pytest.approx(acc)
+    assert len(serial_grads) == len(batched_grads)
+    for serial_iteration_grads, batched_iteration_grads in zip(serial_grads, batched_grads):
+        for serial_grad, batched_grad in zip(serial_iteration_grads, batched_iteration_grads):
+            torch.testing.assert_close(batched_grad, serial_grad, rtol=1e-3, atol=1e-4)
+    # clients end up with the same model and momentum buffers
+    for client, batched_client in zip(serial_clients, batched_clients):
+        for p, batched_p in zip(client.model.parameters(), batched_client.model.parameters()):
+            torch.testing.assert_close(batched_p, p, rtol=1e-4, atol=1e-5)
+            buffer = client.optimizer.state[p].get("momentum_buffer")
+            batched_buffer = batched_client.optimizer.state[batched_p].get("momentum_buffer")
+            if buffer is None:
+                assert batched_buffer is None
+            else:
+                torch.testing.assert_close(batched_buffer, buffer, rtol=1e-3, atol=1e-5)
+
+
+def test_batched_clients_reject_regenerate_perturbation(make_client):
+    client = make_client(0)
+    client.grad_estimator.regenerate_perturbation = True
+    with pytest.raises(ValueError):
+        BatchedClientExecutor([client])
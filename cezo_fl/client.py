@@ -1,18 +1,99 @@
 import torch
 from torch.utils.data import DataLoader
-from typing import Sequence
+from typing import Iterator, Sequence
 from copy import deepcopy
 
 from shared.metrics import Metric
 from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
-from cezo_fl.server import AbstractClient, LocalUpdateResult
+from gradient_estimators.zo_optimizer import ZOSGD
+from cezo_fl.server import AbstractClient, LocalUpdateResult, ModelSnapshot
 from cezo_fl.shared import (
     CriterionType,
-    update_model_given_seed_and_grad,
+    update_model_given_seeds_list_and_grads,
     revert_SGD_given_seed_and_grad,
 )
 
 
+def load_model_and_optimizer_state(
+    model: torch.nn.Module, optimizer: torch.optim.Optimizer, state_dict: dict
+) -> None:
+    model.load_state_dict(state_dict["model"])
+    # Optimizer.load_state_dict keeps the state tensors (e.g. momentum buffers) it is given and the
+    # next step updates them in place, so copy them to keep the saved state intact.
+    optimizer.load_state_dict(deepcopy(state_dict["optimizer"]))
+
+
+def get_train_metrics(
+    grad_estimator: RGE, criterion: CriterionType, accuracy_func, batch_inputs, labels, exact: bool
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Train loss and accuracy of a local update step. They come from the forwards the estimate
+    already ran (see RGE.last_loss), unless `exact`, which runs a forward of the updated model.
+    """
+    if exact:
+        pred = grad_estimator.model_forward(batch_inputs)
+        return criterion(pred, labels), accuracy_func(pred, labels)
+    return grad_estimator.last_loss, accuracy_func(grad_estimator.last_pred, labels)
+
+
+def run_local_update(
+    seeds: Sequence[int],
+    data_iterator: Iterator,
+    grad_estimator: RGE,
+    optimizer: torch.optim.Optimizer,
+    criterion: CriterionType,
+    accuracy_func,
+    device: str | None,
+    exact_metrics_interval: int | None,
+    num_local_steps: int,
+) -> LocalUpdateResult:
+    """
+    One local update step per seed on the next batches of data_iterator. num_local_steps is the
+    number of steps the client ran before, it decides which steps get exact train metrics.
+    """
+    iteration_local_update_grad_vectors: list[torch.Tensor] = []
+    train_loss = Metric("Client train loss")
+    train_accuracy = Metric("Client train accuracy")
+
+    for seed in seeds:
+        optimizer.zero_grad()
+        # NOTE:dataloader manage its own randomnes state thus not affected by seed
+        batch_inputs, labels = next(data_iterator)
+        if device != torch.device("cpu"):
+            batch_inputs, labels = batch_inputs.to(device), labels.to(device)
+        grad_estimator.manual_seed(seed)
+        if isinstance(optimizer, ZOSGD):
+            # update model in place from the seed, no gradient is materialized
+            seed_grads = grad_estimator.compute_dir_grads(batch_inputs, labels, criterion)
+            optimizer.step(seed, seed_grads)
+        else:
+            # generate grads and update model's gradient
+            seed_grads = grad_estimator.compute_grad(batch_inputs, labels, criterion)
+            # update model
+            # NOTE: local model update also uses momentum and other states
+            optimizer.step()
+        iteration_local_update_grad_vectors.append(seed_grads)
+
+        # get_train_info
+        num_local_steps += 1
+        step_loss, step_accuracy = get_train_metrics(
+            grad_estimator,
+            criterion,
+            accuracy_func,
+            batch_inputs,
+            labels,
+            exact=bool(exact_metrics_interval) and num_local_steps % exact_metrics_interval == 0,
+        )
+        train_loss.update(step_loss)
+        train_accuracy.update(step_accuracy)
+
+    return LocalUpdateResult(
+        grad_tensors=iteration_local_update_grad_vectors,
+        step_accuracy=train_accuracy.avg_tensor,
+        step_loss=train_loss.avg_tensor,
+    )
+
+
 class SyncClient(AbstractClient):
 
     def __init__(
@@ -24,11 +105,18 @@ class SyncClient(AbstractClient):
         criterion: CriterionType,
         accuracy_func,
         device: str | None = None,
+        fused_replay: bool = False,
+        exact_metrics_interval: int | None = None,
     ):
         self.model = model
         self.dataloader = dataloader
 
         self.device = device
+        # replay all records of a pull in one fused sweep instead of one optimizer step per seed
+        self.fused_replay = fused_replay
+        # every this many local update steps, train metrics come from an extra exact forward
+        self.exact_metrics_interval = exact_metrics_interval
+        self.num_local_steps = 0
 
         self.grad_estimator = grad_estimator
         self.optimizer = optimizer
@@ -56,44 +144,29 @@ class SyncClient(AbstractClient):
         The inner tensor can be a scalar or a vector. The length of vector is the number
         of perturbations.
         """
-        iteration_local_update_grad_vectors: Sequence[torch.Tensor] = []
-        train_loss = Metric("Client train loss")
-        train_accuracy = Metric("Client train accuracy")
-
-        for seed in seeds:
-            self.optimizer.zero_grad()
-            # NOTE:dataloader manage its own randomnes state thus not affected by seed
-            batch_inputs, labels = next(self.data_iterator)
-            if self.device != torch.device("cpu"):
-                batch_inputs, labels = batch_inputs.to(self.device), labels.to(self.device)
-            # generate grads and update model's gradient
-            torch.manual_seed(seed)
-            seed_grads = self.grad_estimator.compute_grad(batch_inputs, labels, self.criterion)
-            iteration_local_update_grad_vectors.append(seed_grads)
-
-            # update model
-            # NOTE: local model update also uses momentum and other states
-            self.optimizer.step()
-
-            # get_train_info
-            pred = self.grad_estimator.model_forward(batch_inputs)
-            train_loss.update(self.criterion(pred, labels))
-            train_accuracy.update(self.accuracy_func(pred, labels))
+        result = run_local_update(
+            seeds,
+            self.data_iterator,
+            self.grad_estimator,
+            self.optimizer,
+            self.criterion,
+            self.accuracy_func,
+            self.device,
+            self.exact_metrics_interval,
+            self.num_local_steps,
+        )
+        self.num_local_steps += len(seeds)
 
         # This should only run 1 time before next pull, but still use append instead of assign to
         # prevent potential bug
         self.local_update_seeds += seeds
-        self.local_update_dir_grads += iteration_local_update_grad_vectors
+        self.local_update_dir_grads += result.grad_tensors
 
-        return LocalUpdateResult(
-            grad_tensors=iteration_local_update_grad_vectors,
-            step_accuracy=train_accuracy.avg,
-            step_loss=train_loss.avg,
-        )
+        return result
 
     def reset_model(self) -> None:
         """Reset the mode to the state before the local_update."""
-        assert isinstance(self.optimizer, torch.optim.SGD)
+        assert isinstance(self.optimizer, (torch.optim.SGD, ZOSGD))
         revert_SGD_given_seed_and_grad(
             self.optimizer,
             self.grad_estimator,
@@ -104,24 +177,30 @@ class SyncClient(AbstractClient):
     def screenshot(self) -> None:
         # deepcopy current model.state_dict and optimizer.state_dict
         self.last_pull_state_dict = deepcopy({"optimizer": self.optimizer.state_dict()})
-        self.local_update_seeds_list = []
-        self.local_update_grad_scalar = []
+        # local updates before this pull must not be reverted by the next reset_model
+        self.local_update_seeds = []
+        self.local_update_dir_grads = []
 
     def pull_model(
         self,
         seeds_list: Sequence[Sequence[int]],
         gradient_scalar: Sequence[Sequence[torch.Tensor]],
+        snapshot: ModelSnapshot | None = None,
     ) -> None:
-        # reset model
-        self.reset_model()
+        if snapshot is None:
+            # reset model
+            self.reset_model()
+        else:
+            # the records start at the snapshot, local updates are dropped with the old model
+            load_model_and_optimizer_state(self.model, self.optimizer, snapshot.state_dict)
         # update model to latest version
-        for iteration_seeds, iteration_grad_sclar in zip(seeds_list, gradient_scalar):
-            update_model_given_seed_and_grad(
-                self.optimizer,
-                self.grad_estimator,
-                iteration_seeds,
-                iteration_grad_sclar,
-            )
+        update_model_given_seeds_list_and_grads(
+            self.optimizer,
+            self.grad_estimator,
+            seeds_list,
+            gradient_scalar,
+            fused=self.fused_replay,
+        )
 
         # screenshot current pulled model
         self.screenshot()
@@ -138,11 +217,18 @@ class ResetClient(AbstractClient):
         criterion: CriterionType,
         accuracy_func,
         device: str | None = None,
+        fused_replay: bool = False,
+        exact_metrics_interval: int | None = None,
     ):
         self.model = model
         self.dataloader = dataloader
 
         self.device = device
+        # replay all records of a pull in one fused sweep instead of one optimizer step per seed
+        self.fused_replay = fused_replay
+        # every this many local update steps, train metrics come from an extra exact forward
+        self.exact_metrics_interval = exact_metrics_interval
+        self.num_local_steps = 0
 
         self.grad_estimator = grad_estimator
         self.optimizer = optimizer
@@ -168,40 +254,23 @@ class ResetClient(AbstractClient):
         The inner tensor can be a scalar or a vector. The length of vector is the number
         of perturbations.
         """
-        iteration_local_update_grad_vectors: Sequence[torch.Tensor] = []
-        train_loss = Metric("Client train loss")
-        train_accuracy = Metric("Client train accuracy")
-
-        for seed in seeds:
-            self.optimizer.zero_grad()
-            # NOTE:dataloader manage its own randomnes state thus not affected by seed
-            batch_inputs, labels = next(self.data_iterator)
-            if self.device != torch.device("cpu"):
-                batch_inputs, labels = batch_inputs.to(self.device), labels.to(self.device)
-            # generate grads and update model's gradient
-            torch.manual_seed(seed)
-            seed_grads = self.grad_estimator.compute_grad(batch_inputs, labels, self.criterion)
-            iteration_local_update_grad_vectors.append(seed_grads)
-
-            # update model
-            # NOTE: local model update also uses momentum and other states
-            self.optimizer.step()
-
-            # get_train_info
-            pred = self.grad_estimator.model_forward(batch_inputs)
-            train_loss.update(self.criterion(pred, labels))
-            train_accuracy.update(self.accuracy_func(pred, labels))
-
-        return LocalUpdateResult(
-            grad_tensors=iteration_local_update_grad_vectors,
-            step_accuracy=train_accuracy.avg,
-            step_loss=train_loss.avg,
+        result = run_local_update(
+            seeds,
+            self.data_iterator,
+            self.grad_estimator,
+            self.optimizer,
+            self.criterion,
+            self.accuracy_func,
+            self.device,
+            self.exact_metrics_interval,
+            self.num_local_steps,
         )
+        self.num_local_steps += len(seeds)
+        return result
 
     def reset_model(self) -> None:
         """Reset the mode to the state before the local_update."""
-        self.model.load_state_dict(self.last_pull_state_dict["model"])
-        self.optimizer.load_state_dict(self.last_pull_state_dict["optimizer"])
+        load_model_and_optimizer_state(self.model, self.optimizer, self.last_pull_state_dict)
 
     def screenshot(self) -> dict:
         # deepcopy current model.state_dict and optimizer.state_dict
@@ -213,17 +282,160 @@ class ResetClient(AbstractClient):
         self,
         seeds_list: Sequence[Sequence[int]],
         gradient_scalar: Sequence[Sequence[torch.Tensor]],
+        snapshot: ModelSnapshot | None = None,
     ) -> None:
-        # reset model
-        self.reset_model()
+        if snapshot is None:
+            # reset model
+            self.reset_model()
+        else:
+            # the records start at the snapshot instead of the last pull
+            load_model_and_optimizer_state(self.model, self.optimizer, snapshot.state_dict)
         # update model to latest version
-        for iteration_seeds, iteration_grad_sclar in zip(seeds_list, gradient_scalar):
-            update_model_given_seed_and_grad(
-                self.optimizer,
-                self.grad_estimator,
-                iteration_seeds,
-                iteration_grad_sclar,
-            )
+        update_model_given_seeds_list_and_grads(
+            self.optimizer,
+            self.grad_estimator,
+            seeds_list,
+            gradient_scalar,
+            fused=self.fused_replay,
+        )
 
         # screenshot current pulled model
         self.last_pull_state_dict = self.screenshot()
+
+
+class ClientWorkspace:
+    """
+    One model, optimizer and grad estimator shared by many VirtualClients.
+
+    A ResetClient pulling the server model always ends up with the state obtained by replaying all
+    records so far from the initial state, so that state (the anchor) is the same for every client
+    and is kept here once. Before a virtual client trains, the shared model is reset to the anchor
+    and the anchor is brought up to date with the records it has not seen yet.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        grad_estimator: RGE,
+        optimizer: torch.optim.Optimizer,
+        criterion: CriterionType,
+        accuracy_func,
+        device: str | None = None,
+        fused_replay: bool = False,
+        exact_metrics_interval: int | None = None,
+    ):
+        self.model = model
+        self.grad_estimator = grad_estimator
+        self.optimizer = optimizer
+        self.criterion = criterion
+        self.accuracy_func = accuracy_func
+        self.device = device
+        self.fused_replay = fused_replay
+        self.exact_metrics_interval = exact_metrics_interval
+
+        # number of server records replayed into the anchor
+        self.num_anchor_records = 0
+        self.anchor_state_dict = self.screenshot()
+
+    def screenshot(self) -> dict:
+        return deepcopy(
+            {"model": self.model.state_dict(), "optimizer": self.optimizer.state_dict()}
+        )
+
+    def reset_model(self) -> None:
+        load_model_and_optimizer_state(self.model, self.optimizer, self.anchor_state_dict)
+
+    def pull_model(
+        self,
+        num_pulled_records: int,
+        seeds_list: Sequence[Sequence[int]],
+        gradient_scalar: Sequence[Sequence[torch.Tensor]],
+        snapshot: ModelSnapshot | None = None,
+    ) -> None:
+        """`seeds_list` and `gradient_scalar` are the records from index num_pulled_records on."""
+        if snapshot is not None and snapshot.num_records > self.num_anchor_records:
+            # The snapshot is only read (reset_model copies from it), so it can be the anchor.
+            self.anchor_state_dict = snapshot.state_dict
+            self.num_anchor_records = snapshot.num_records
+        assert num_pulled_records <= self.num_anchor_records
+        self.reset_model()
+        num_seen = self.num_anchor_records - num_pulled_records
+        if len(seeds_list) <= num_seen:
+            return
+        update_model_given_seeds_list_and_grads(
+            self.optimizer,
+            self.grad_estimator,
+            seeds_list[num_seen:],
+            gradient_scalar[num_seen:],
+            fused=self.fused_replay,
+        )
+        self.num_anchor_records = num_pulled_records + len(seeds_list)
+        self.anchor_state_dict = self.screenshot()
+
+
+class VirtualClient(AbstractClient):
+    """
+    Same behavior as ResetClient, but the model lives in a ClientWorkspace shared with other
+    virtual clients. A client only keeps its data iterator and how many server records it pulled,
+    so memory is O(model) instead of O(num_clients * model).
+
+    NOTE: Clients sharing a workspace must run one at a time, i.e. with the serial client loop.
+    """
+
+    def __init__(self, workspace: ClientWorkspace, dataloader: DataLoader):
+        self.workspace = workspace
+        self.dataloader = dataloader
+        self.data_iterator = self._get_train_batch_iterator()
+        self.num_pulled_records = 0
+        self.num_local_steps = 0
+
+    @property
+    def optimizer(self) -> torch.optim.Optimizer:
+        return self.workspace.optimizer
+
+    def random_gradient_estimator(self):
+        return self.workspace.grad_estimator
+
+    def _get_train_batch_iterator(self):
+        # NOTE: used only in init, will generate an infinite iterator from dataloader
+        while True:
+            for v in self.dataloader:
+                yield v
+
+    def local_update(self, seeds: Sequence[int]) -> LocalUpdateResult:
+        """Returns a sequence of gradient scalar tensors for each local update.
+
+        The length of the returned sequence should be the same as the length of seeds.
+        The inner tensor can be a scalar or a vector. The length of vector is the number
+        of perturbations.
+        """
+        workspace = self.workspace
+        result = run_local_update(
+            seeds,
+            self.data_iterator,
+            workspace.grad_estimator,
+            workspace.optimizer,
+            workspace.criterion,
+            workspace.accuracy_func,
+            workspace.device,
+            workspace.exact_metrics_interval,
+            self.num_local_steps,
+        )
+        self.num_local_steps += len(seeds)
+        return result
+
+    def reset_model(self) -> None:
+        """Reset the mode to the state before the local_update."""
+        self.workspace.reset_model()
+
+    def pull_model(
+        self,
+        seeds_list: Sequence[Sequence[int]],
+        gradient_scalar: Sequence[Sequence[torch.Tensor]],
+        snapshot: ModelSnapshot | None = None,
+    ) -> None:
+        if snapshot is not None:
+            # the records start at the snapshot instead of the last pull
+            self.num_pulled_records = snapshot.num_records
+        self.workspace.pull_model(self.num_pulled_records, seeds_list, gradient_scalar, snapshot)
+        self.num_pulled_records += len(seeds_list)
@@ -0,0 +1,159 @@
+import dataclasses
+import multiprocessing
+import torch
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Literal, Sequence, TypeAlias
+
+from cezo_fl.server import (
+    AbstractClient,
+    AbstractClientExecutor,
+    ClientTask,
+    LocalUpdateResult,
+    run_client_task,
+)
+
+
+# "network" is NetworkClientExecutor in cezo_fl/transport.py, "batched" is BatchedClientExecutor
+# in cezo_fl/batched_clients.py
+ClientExecutorType: TypeAlias = Literal["serial", "thread", "process", "network", "batched"]
+
+
+def set_client_learning_rate(client: AbstractClient, lr: float) -> None:
+    for p in client.optimizer.param_groups:
+        p["lr"] = lr
+
+
+def set_client_perturbation(client: AbstractClient, num_pert: int) -> None:
+    client.random_gradient_estimator().num_pert = num_pert
+
+
+class ThreadPoolClientExecutor(AbstractClientExecutor):
+    """
+    Clients live in the server process and run in a thread pool. Torch ops release the GIL, so
+    this helps when the per-client forwards are large.
+
+    Every client draws its perturbations from its own estimator's generators, so concurrent clients
+    compute what they compute in the serial loop. Modules drawing from the global torch RNG (e.g.
+    dropout in train mode) still race on it, use "process" for models with such modules.
+    """
+
+    def __init__(self, clients: Sequence[AbstractClient], num_workers: int):
+        self.clients = clients
+        self.num_clients = len(clients)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    def submit(self, task: ClientTask) -> Future:
+        return self.pool.submit(run_client_task, self.clients[task.client_index], task)
+
+    def run(self, tasks: Sequence[ClientTask]) -> list[LocalUpdateResult]:
+        futures = [self.submit(task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def set_learning_rate(self, lr: float) -> None:
+        for client in self.clients:
+            set_client_learning_rate(client, lr)
+
+    def set_perturbation(self, num_pert: int) -> None:
+        for client in self.clients:
+            set_client_perturbation(client, num_pert)
+
+    def shutdown(self) -> None:
+        self.pool.shutdown()
+
+
+# State of a process pool worker, set once by _init_worker.
+_WORKER_CLIENTS: dict[int, AbstractClient] = {}
+
+
+def _init_worker(
+    client_factories: dict[int, Callable[[], AbstractClient]], num_threads: int
+) -> None:
+    torch.set_num_threads(num_threads)
+    for client_index, client_factory in client_factories.items():
+        _WORKER_CLIENTS[client_index] = client_factory()
+
+
+def _run_task_in_worker(task: ClientTask) -> LocalUpdateResult:
+    result = run_client_task(_WORKER_CLIENTS[task.client_index], task)
+    # Only scalars go back to the server, keep them off the worker's device.
+    result.grad_tensors = [grad_tensor.cpu() for grad_tensor in result.grad_tensors]
+    result.step_loss, result.step_accuracy = float(result.step_loss), float(result.step_accuracy)
+    return result
+
+
+def _set_learning_rate_in_worker(lr: float) -> None:
+    for client in _WORKER_CLIENTS.values():
+        set_client_learning_rate(client, lr)
+
+
+def _set_perturbation_in_worker(num_pert: int) -> None:
+    for client in _WORKER_CLIENTS.values():
+        set_client_perturbation(client, num_pert)
+
+
+class ProcessPoolClientExecutor(AbstractClientExecutor):
+    """
+    Clients are spread over num_workers processes, client i always lives in worker
+    i % num_workers, so its model and optimizer state stay in that worker across rounds.
+    Tasks only carry seeds and scalars in and LocalUpdateResult out.
+
+    client_factories[i] builds client i inside its worker and must be picklable (e.g. a
+    functools.partial of a module level function). Workers are spawned, so CUDA works in them.
+
+    Given the same seeds, every client computes exactly what it computes in the serial loop,
+    as long as nothing in a client depends on the process-wide RNG state left by other clients
+    (dataloaders need their own generator).
+    """
+
+    def __init__(
+        self,
+        client_factories: Sequence[Callable[[], AbstractClient]],
+        num_workers: int,
+        num_threads_per_worker: int = 1,
+    ):
+        self.num_clients = len(client_factories)
+        mp_context = multiprocessing.get_context("spawn")
+        # One single-process pool per worker, so a task can be routed to the worker owning the
+        # client. A shared pool would hand it to whichever worker is free.
+        self.pools: list[Executor] = []
+        for worker_index in range(num_workers):
+            worker_client_factories = {
+                client_index: client_factories[client_index]
+                for client_index in range(worker_index, self.num_clients, num_workers)
+            }
+            self.pools.append(
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=mp_context,
+                    initializer=_init_worker,
+                    initargs=(worker_client_factories, num_threads_per_worker),
+                )
+            )
+
+    def _pool_of(self, client_index: int) -> Executor:
+        return self.pools[client_index % len(self.pools)]
+
+    def submit(self, task: ClientTask) -> Future:
+        # The records are views into the server's buffers, pickling them would send everything.
+        task = dataclasses.replace(
+            task, seeds_list=task.seeds_list.clone(), grad_list=task.grad_list.clone()
+        )
+        return self._pool_of(task.client_index).submit(_run_task_in_worker, task)
+
+    def run(self, tasks: Sequence[ClientTask]) -> list[LocalUpdateResult]:
+        futures = [self.submit(task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def _broadcast(self, fn: Callable, *args) -> None:
+        for future in [pool.submit(fn, *args) for pool in self.pools]:
+            future.result()
+
+    def set_learning_rate(self, lr: float) -> None:
+        self._broadcast(_set_learning_rate_in_worker, lr)
+
+    def set_perturbation(self, num_pert: int) -> None:
+        self._broadcast(_set_perturbation_in_worker, num_pert)
+
+    def shutdown(self) -> None:
+        for pool in self.pools:
+            pool.shutdown()
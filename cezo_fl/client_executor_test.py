@@ -0,0 +1,46 @@
+from functools import partial
+import torch
+
+from cezo_fl.client_executor import ProcessPoolClientExecutor, ThreadPoolClientExecutor
+from cezo_fl.server import ClientTask, run_client_task
+
+
+def test_process_pool_matches_serial(make_client, train_server):
+    _, serial_grads = train_server([make_client(i) for i in range(3)], None)
+
+    client_executor = ProcessPoolClientExecutor(
+        [partial(make_client, i) for i in range(3)], num_workers=2
+    )
+    try:
+        _, process_grads = train_server([], client_executor)
+    finally:
+        client_executor.shutdown()
+
+    assert len(serial_grads) == len(process_grads)
+    for serial_iteration_grads, process_iteration_grads in zip(serial_grads, process_grads):
+        for serial_grad, process_grad in zip(serial_iteration_grads, process_iteration_grads):
+            assert torch.equal(serial_grad, process_grad)
+
+
+def test_thread_pool_matches_serial(make_client, train_server):
+    _, serial_grads = train_server([make_client(i) for i in range(3)], None)
+
+    clients = [make_client(i) for i in range(3)]
+    client_executor = ThreadPoolClientExecutor(clients, num_workers=3)
+    try:
+        _, thread_grads = train_server(clients, client_executor)
+    finally:
+        client_executor.shutdown()
+
+    assert len(serial_grads) == len(thread_grads)
+    for serial_iteration_grads, thread_iteration_grads in zip(serial_grads, thread_grads):
+        for serial_grad, thread_grad in zip(serial_iteration_grads, thread_iteration_grads):
+            assert torch.equal(serial_grad, thread_grad)
+
+
+def test_client_task_runs_with_grad_enabled(make_client):
+    # worker threads and processes start with grad enabled
+    assert torch.is_grad_enabled()
+    task = ClientTask(0, torch.zeros(0, 0, dtype=torch.int64), [], local_update_seeds=[1, 2])
+    result = run_client_task(make_client(0), task)
+    assert len(result.grad_tensors) == 2
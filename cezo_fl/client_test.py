@@ -1,5 +1,7 @@
+import random
 import torch
-from cezo_fl.client import SyncClient
+from cezo_fl.client import ClientWorkspace, SyncClient, VirtualClient
+from cezo_fl.server import CeZO_Server
 from models.cnn_mnist import CNN_MNIST
 from config import FakeArgs
 from preprocess import preprocess_cezo_fl
@@ -49,3 +51,30 @@ def test_sync_client_reset():
 
     for orig_param, reset_param in zip(original_model.parameters(), model.parameters()):
         assert (orig_param - reset_param).abs().max() < 1e-6
+
+
+def test_virtual_clients_match_reset_clients(make_model_settings, make_dataloader, make_client):
+    records = []
+    for virtual_clients in [False, True]:
+        random.seed(0)
+        if virtual_clients:
+            workspace = ClientWorkspace(*make_model_settings())
+            clients = [VirtualClient(workspace, make_dataloader(i)) for i in range(4)]
+        else:
+            clients = [make_client(i) for i in range(4)]
+        server = CeZO_Server(
+            clients, torch.device("cpu"), num_sample_clients=2, local_update_steps=2
+        )
+        seed_grad_records = server.seed_grad_records
+        iteration_grads = []
+        with torch.no_grad():
+            for iteration in range(6):
+                server.train_one_step(iteration)
+                iteration_grads.append(
+                    seed_grad_records.fetch_grad_records(seed_grad_records.current_iteration)[0]
+                )
+        records.append(iteration_grads)
+
+    for reset_iteration_grads, virtual_iteration_grads in zip(*records):
+        for reset_grad, virtual_grad in zip(reset_iteration_grads, virtual_iteration_grads):
+            assert torch.equal(reset_grad, virtual_grad)
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from cezo_fl.client import ResetClient
+from cezo_fl.server import CeZO_Server, GradRecordsView
+from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+from shared.metrics import accuracy
+
+
+def build_model_settings(
+    grad_estimate_method: str = "central", mu: float = 1e-3, weight_decay: float = 0.0
+):
+    # every client starts from the same weights
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(), torch.nn.Linear(8, 3))
+    grad_estimator = RGE(model, mu=mu, num_pert=2, grad_estimate_method=grad_estimate_method)
+    optimizer = torch.optim.SGD(
+        model.parameters(), lr=1e-2, momentum=0.9, weight_decay=weight_decay
+    )
+    return model, grad_estimator, optimizer, torch.nn.CrossEntropyLoss(), accuracy
+
+
+def build_dataloader(client_index: int, num_samples: int = 20) -> DataLoader:
+    generator = torch.Generator().manual_seed(client_index)
+    dataset = TensorDataset(
+        torch.randn(num_samples, 4, generator=generator),
+        torch.randint(0, 3, (num_samples,), generator=generator),
+    )
+    return DataLoader(dataset, batch_size=4, shuffle=True, generator=generator)
+
+
+def build_client(client_index: int, num_samples: int = 20, **settings) -> ResetClient:
+    """Module level, so that partial(build_client, i) can be sent to worker processes."""
+    model, grad_estimator, optimizer, criterion, accuracy_func = build_model_settings(**settings)
+    return ResetClient(
+        model,
+        build_dataloader(client_index, num_samples),
+        grad_estimator,
+        optimizer,
+        criterion,
+        accuracy_func,
+        torch.device("cpu"),
+    )
+
+
+def attach_server_model(server: CeZO_Server, **settings) -> None:
+    model, grad_estimator, optimizer, criterion, accuracy_func = build_model_settings(**settings)
+    server.set_server_model_and_criterion(
+        model, criterion, accuracy_func, optimizer, grad_estimator
+    )
+
+
+def run_server(
+    clients, client_executor, num_sample_clients: int = 2
+) -> tuple[list[tuple[float, float]], GradRecordsView]:
+    random.seed(0)
+    server = CeZO_Server(
+        clients,
+        torch.device("cpu"),
+        num_sample_clients=num_sample_clients,
+        local_update_steps=2,
+        client_executor=client_executor,
+    )
+    step_metrics = []
+    with torch.no_grad():
+        for iteration in range(4):
+            step_loss, step_accuracy = server.train_one_step(iteration)
+            step_metrics.append((float(step_loss), float(step_accuracy)))
+    records = server.seed_grad_records
+    return step_metrics, records.fetch_grad_records(records.earliest_records)
+
+
+@pytest.fixture
+def make_model_settings():
+    """(model, grad_estimator, optimizer, criterion, accuracy_func) with the same initial model."""
+    return build_model_settings
+
+
+@pytest.fixture
+def make_dataloader():
+    """The data of client i, shuffled with its own generator."""
+    return build_dataloader
+
+
+@pytest.fixture
+def make_client():
+    """ResetClient i, make_client(i, num_samples, **settings of make_model_settings)."""
+    return build_client
+
+
+@pytest.fixture
+def set_server_model():
+    """Gives a server a model built like the clients' initial models."""
+    return attach_server_model
+
+
+@pytest.fixture
+def train_server():
+    """Step metrics and grad records of 4 rounds of a server over clients or a client executor."""
+    return run_server
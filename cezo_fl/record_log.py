@@ -0,0 +1,163 @@
+import mmap
+import os
+import torch
+from typing import Iterator
+
+# One entry per iteration: (offset of its grads in grads.bin in elements, K, num_pert)
+_INDEX_ENTRY_SIZE = 3 * 8
+_SEED_DTYPE = torch.int64
+_GRAD_DTYPE = torch.float32
+
+
+class MappedGradRecordsView:
+    """
+    Grad records of a range of iterations read from a SeedRecordLog, same interface as
+    GradRecordsView. view[i] is the [K, num_pert of iteration i] tensor of iteration i, a view into
+    the memory-mapped grads file.
+    """
+
+    def __init__(self, grads: torch.Tensor, index: torch.Tensor):
+        self.grads = grads  # flat
+        self.index = index  # [num iterations, 3], see _INDEX_ENTRY_SIZE
+
+    def __len__(self) -> int:
+        return self.index.shape[0]
+
+    def __getitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            return MappedGradRecordsView(self.grads, self.index[index])
+        offset, num_local_updates, num_pert = self.index[index].tolist()
+        size = num_local_updates * num_pert
+        return self.grads[offset : offset + size].view(num_local_updates, num_pert)
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def clone(self) -> "MappedGradRecordsView":
+        """In-memory copy of only this range, e.g. before pickling."""
+        if len(self) == 0:
+            return MappedGradRecordsView(self.grads.new_zeros(0), self.index.clone())
+        start = int(self.index[0, 0])
+        end = int((self.index[-1, 0] + self.index[-1, 1] * self.index[-1, 2]).item())
+        index = self.index.clone()
+        index[:, 0] -= start
+        return MappedGradRecordsView(self.grads[start:end].clone(), index)
+
+
+class SeedRecordLog:
+    """
+    Append-only on-disk log of the server's (seeds, aggregated grad scalars), one row per iteration.
+
+    log_dir holds three files: seeds.bin (K int64 seeds per iteration), grads.bin (K * num_pert
+    float32 scalars per iteration, num_pert can change between iterations) and index.bin (one
+    fixed-size entry per iteration locating its grads). Reads go through mmap, so fetching a range
+    only touches the pages of that range and the history does not have to fit in memory.
+
+    An iteration is committed once its index entry is written, after its seeds and grads. Opening
+    an existing log recovers the committed iterations and truncates whatever a crash left behind.
+    With sync=True every append is fsync-ed, otherwise only flushed to the OS.
+    """
+
+    def __init__(self, log_dir: str, sync: bool = False):
+        os.makedirs(log_dir, exist_ok=True)
+        self.sync = sync
+        self.files = {}
+        for name in ["seeds", "grads", "index"]:
+            path = os.path.join(log_dir, f"{name}.bin")
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            self.files[name] = open(path, "r+b")
+        # name -> (mmap, mapped size in bytes), remapped when the file has grown
+        self.mapped: dict[str, tuple[mmap.mmap | None, int]] = {
+            name: (None, 0) for name in self.files
+        }
+        self._recover()
+
+    def _file_size(self, name: str) -> int:
+        return os.fstat(self.files[name].fileno()).st_size
+
+    def _recover(self) -> None:
+        self.num_iterations = self._file_size("index") // _INDEX_ENTRY_SIZE
+        self.num_local_updates = 0
+        self.num_grads = 0
+        if self.num_iterations > 0:
+            index = self._map("index", self.num_iterations * _INDEX_ENTRY_SIZE).view(-1, 3)
+            self.num_local_updates = int(index[0, 1])
+            seed_row_size = self.num_local_updates * _SEED_DTYPE.itemsize
+            num_seed_rows = self._file_size("seeds") // seed_row_size
+            grads_ends = index[:, 0] + index[:, 1] * index[:, 2]
+            num_grads = self._file_size("grads") // _GRAD_DTYPE.itemsize
+            complete = (grads_ends <= num_grads) & (
+                torch.arange(self.num_iterations) < num_seed_rows
+            )
+            # iterations are written in order, the first incomplete one ends the log
+            self.num_iterations = int(complete.cumprod(0).sum())
+            if self.num_iterations > 0:
+                self.num_grads = int(grads_ends[self.num_iterations - 1])
+        for name, size in [
+            ("seeds", self.num_iterations * self.num_local_updates * _SEED_DTYPE.itemsize),
+            ("grads", self.num_grads * _GRAD_DTYPE.itemsize),
+            ("index", self.num_iterations * _INDEX_ENTRY_SIZE),
+        ]:
+            self.mapped[name] = (None, 0)
+            self.files[name].truncate(size)
+            self.files[name].seek(size)
+
+    def __len__(self) -> int:
+        return self.num_iterations
+
+    def _map(self, name: str, size: int) -> torch.Tensor:
+        """The first `size` bytes of file `name` as a flat tensor of its dtype, without copying."""
+        dtype = _GRAD_DTYPE if name == "grads" else _SEED_DTYPE
+        if size == 0:
+            return torch.zeros(0, dtype=dtype)
+        mapped, mapped_size = self.mapped[name]
+        if mapped is None or mapped_size < size:
+            # ACCESS_COPY gives a writable (copy-on-write, never written) buffer for torch. The old
+            # map is not closed, tensors fetched from it keep it alive.
+            mapped = mmap.mmap(self.files[name].fileno(), size, access=mmap.ACCESS_COPY)
+            mapped_size = size
+            self.mapped[name] = (mapped, mapped_size)
+        return torch.frombuffer(mapped, dtype=dtype, count=size // dtype.itemsize)
+
+    def append(self, seeds: list[int], grads: torch.Tensor) -> int:
+        """Append one iteration, grads is [K, num_pert]. Returns the index of the iteration."""
+        num_local_updates, num_pert = grads.shape
+        if self.num_local_updates == 0:
+            self.num_local_updates = num_local_updates
+        assert len(seeds) == self.num_local_updates == num_local_updates
+
+        self.files["seeds"].write(torch.tensor(seeds, dtype=_SEED_DTYPE).numpy().tobytes())
+        self.files["grads"].write(grads.detach().to("cpu", _GRAD_DTYPE).numpy().tobytes())
+        for name in ["seeds", "grads"]:
+            self._flush(name)
+        entry = torch.tensor([self.num_grads, num_local_updates, num_pert], dtype=torch.int64)
+        self.files["index"].write(entry.numpy().tobytes())
+        self._flush("index")
+
+        self.num_grads += num_local_updates * num_pert
+        self.num_iterations += 1
+        return self.num_iterations - 1
+
+    def _flush(self, name: str) -> None:
+        self.files[name].flush()
+        if self.sync:
+            os.fsync(self.files[name].fileno())
+
+    def fetch_seeds(self, start: int) -> torch.Tensor:
+        """[num iterations, K] seeds of the iterations from start on."""
+        seeds = self._map(
+            "seeds", self.num_iterations * self.num_local_updates * _SEED_DTYPE.itemsize
+        )
+        return seeds.view(self.num_iterations, self.num_local_updates)[start:]
+
+    def fetch_grads(self, start: int) -> MappedGradRecordsView:
+        index = self._map("index", self.num_iterations * _INDEX_ENTRY_SIZE).view(-1, 3)
+        grads = self._map("grads", self.num_grads * _GRAD_DTYPE.itemsize)
+        return MappedGradRecordsView(grads, index[start:])
+
+    def close(self) -> None:
+        self.mapped = {name: (None, 0) for name in self.files}
+        for f in self.files.values():
+            f.close()
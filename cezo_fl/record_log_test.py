@@ -0,0 +1,57 @@
+import os
+import torch
+
+from cezo_fl.record_log import SeedRecordLog
+
+
+def append_iterations(log: SeedRecordLog, num_perts: list[int]) -> None:
+    for num_pert in num_perts:
+        i = len(log)
+        log.append([i, i + 1], torch.full((2, num_pert), float(i)))
+
+
+def test_append_and_fetch(tmp_path):
+    log = SeedRecordLog(str(tmp_path))
+    assert len(log) == 0
+    assert log.fetch_seeds(0).shape[0] == 0
+    assert len(log.fetch_grads(0)) == 0
+
+    append_iterations(log, [2, 2, 3, 1])
+    assert len(log) == 4
+    assert log.fetch_seeds(1).tolist() == [[1, 2], [2, 3], [3, 4]]
+    grads = log.fetch_grads(1)
+    assert [tuple(g.shape) for g in grads] == [(2, 2), (2, 3), (2, 1)]
+    for g, value in zip(grads, [1.0, 2.0, 3.0]):
+        assert torch.equal(g, torch.full(g.shape, value))
+
+    cloned = grads[1:].clone()
+    assert cloned.grads.shape == (2 * 3 + 2 * 1,)
+    for g, cloned_g in zip(grads[1:], cloned):
+        assert torch.equal(g, cloned_g)
+
+    # fetches see appends made after the file was mapped
+    append_iterations(log, [2])
+    assert log.fetch_seeds(4).tolist() == [[4, 5]]
+    assert torch.equal(log.fetch_grads(4)[0], torch.full((2, 2), 4.0))
+    log.close()
+
+
+def test_recover_after_partial_append(tmp_path):
+    log = SeedRecordLog(str(tmp_path))
+    append_iterations(log, [2, 3])
+    log.close()
+
+    # a crash in the middle of the third append: its seeds and half of its grads are written
+    with open(os.path.join(tmp_path, "seeds.bin"), "ab") as f:
+        f.write(torch.tensor([2, 3], dtype=torch.int64).numpy().tobytes())
+    with open(os.path.join(tmp_path, "grads.bin"), "ab") as f:
+        f.write(torch.zeros(2, dtype=torch.float32).numpy().tobytes())
+
+    log = SeedRecordLog(str(tmp_path))
+    assert len(log) == 2
+    assert log.fetch_seeds(0).tolist() == [[0, 1], [1, 2]]
+    append_iterations(log, [1])
+    assert log.fetch_seeds(0).tolist() == [[0, 1], [1, 2], [2, 3]]
+    assert [tuple(g.shape) for g in log.fetch_grads(0)] == [(2, 2), (2, 3), (2, 1)]
+    assert torch.equal(log.fetch_grads(2)[0], torch.full((2, 1), 2.0))
+    log.close()
@@ -0,0 +1,186 @@
+import abc
+import random
+from typing import Literal, Sequence, TypeAlias
+
+ClientSamplingType: TypeAlias = Literal["uniform", "round-robin", "staleness"]
+
+
+class ClientSampler:
+    """
+    Chooses the clients of a round. staleness[i] is the number of records client i replays on its
+    next pull (num_records - client_last_updates[i]), the replay cost of sampling it. candidates
+    restricts the choice to some clients (e.g. the idle ones of the async server), None is all.
+    """
+
+    @abc.abstractmethod
+    def sample(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> list[int]:
+        return NotImplemented
+
+    @abc.abstractmethod
+    def expected_replay_cost(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> float:
+        """Expected number of records replayed by the clients sample() would choose now."""
+        return NotImplemented
+
+
+def _candidates(staleness: Sequence[int], candidates: Sequence[int] | None) -> Sequence[int]:
+    return range(len(staleness)) if candidates is None else candidates
+
+
+class UniformSampler(ClientSampler):
+    def sample(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> list[int]:
+        return random.sample(_candidates(staleness, candidates), num_sample_clients)
+
+    def expected_replay_cost(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> float:
+        candidates = _candidates(staleness, candidates)
+        return num_sample_clients * sum(staleness[i] for i in candidates) / len(candidates)
+
+
+class RoundRobinSampler(ClientSampler):
+    """
+    Clients take turns in passes over all clients, num_sample_clients per round. Every pass keeps
+    the order of the previous one (initially shuffled) with each client moved by at most about
+    jitter positions, so a client waits at most (num_clients + jitter) / num_sample_clients + 1
+    rounds between two samplings. jitter=0 is plain round-robin. Clients that are not candidates
+    keep their place in the queue.
+    """
+
+    def __init__(self, num_clients: int, jitter: int = 0):
+        self.order = random.sample(range(num_clients), num_clients)
+        self.queue = list(self.order)
+        self.jitter = jitter
+
+    def _next_pass(self) -> None:
+        keys = {
+            client: position + random.uniform(0, self.jitter)
+            for position, client in enumerate(self.order)
+        }
+        self.order = sorted(self.order, key=keys.__getitem__)
+        self.queue += self.order
+
+    @staticmethod
+    def _first_distinct(
+        queue: list[int], num_sample_clients: int, candidates: set[int] | None
+    ) -> list[int]:
+        # a round can span two passes, a client is only sampled once
+        sampled: list[int] = []
+        for client in queue:
+            if client not in sampled and (candidates is None or client in candidates):
+                sampled.append(client)
+            if len(sampled) == num_sample_clients:
+                break
+        return sampled
+
+    def sample(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> list[int]:
+        candidate_set = None if candidates is None else set(candidates)
+        while True:
+            sampled = self._first_distinct(self.queue, num_sample_clients, candidate_set)
+            if len(sampled) == num_sample_clients:
+                break
+            self._next_pass()
+        for client in sampled:
+            self.queue.remove(client)
+        return sampled
+
+    def expected_replay_cost(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> float:
+        """Exact unless the round starts a new pass, which is taken as the last pass' order."""
+        candidate_set = None if candidates is None else set(candidates)
+        sampled = self._first_distinct(self.queue + self.order, num_sample_clients, candidate_set)
+        return float(sum(staleness[i] for i in sampled))
+
+
+class StalenessSampler(ClientSampler):
+    """
+    Samples clients with probability proportional to (staleness + 1), so stale clients are caught
+    up before they get expensive to replay, and always samples the clients whose staleness reached
+    max_staleness (the stalest first, at most num_sample_clients of them).
+    """
+
+    def __init__(self, max_staleness: int | None = None):
+        self.max_staleness = max_staleness
+
+    def _forced(
+        self, staleness: Sequence[int], num_sample_clients: int, candidates: Sequence[int]
+    ) -> list[int]:
+        if self.max_staleness is None:
+            return []
+        capped = [i for i in candidates if staleness[i] >= self.max_staleness]
+        capped.sort(key=lambda i: staleness[i], reverse=True)
+        return capped[:num_sample_clients]
+
+    def sample(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> list[int]:
+        candidates = _candidates(staleness, candidates)
+        sampled = self._forced(staleness, num_sample_clients, candidates)
+        forced = set(sampled)
+        # weighted sampling without replacement: the largest u ** (1 / weight)
+        keys = {
+            i: random.random() ** (1 / (staleness[i] + 1)) for i in candidates if i not in forced
+        }
+        rest = sorted(keys, key=keys.__getitem__, reverse=True)
+        return sampled + rest[: num_sample_clients - len(sampled)]
+
+    def expected_replay_cost(
+        self,
+        staleness: Sequence[int],
+        num_sample_clients: int,
+        candidates: Sequence[int] | None = None,
+    ) -> float:
+        """Approximate, inclusion probabilities are taken as min(1, num_left * weight / total)."""
+        candidates = _candidates(staleness, candidates)
+        forced = set(self._forced(staleness, num_sample_clients, candidates))
+        cost = float(sum(staleness[i] for i in forced))
+        num_left = num_sample_clients - len(forced)
+        rest = [staleness[i] for i in candidates if i not in forced]
+        total_weight = sum(s + 1 for s in rest)
+        if num_left > 0 and total_weight > 0:
+            cost += sum(s * min(1.0, num_left * (s + 1) / total_weight) for s in rest)
+        return cost
+
+
+def get_client_sampler(
+    client_sampling: ClientSamplingType,
+    num_clients: int,
+    jitter: int = 0,
+    max_staleness: int | None = None,
+) -> ClientSampler:
+    if client_sampling == "uniform":
+        return UniformSampler()
+    elif client_sampling == "round-robin":
+        return RoundRobinSampler(num_clients, jitter)
+    elif client_sampling == "staleness":
+        return StalenessSampler(max_staleness)
+    raise Exception(f"Client sampling {client_sampling} is not supported")
@@ -0,0 +1,68 @@
+import random
+
+from cezo_fl.sampling import RoundRobinSampler, StalenessSampler, UniformSampler
+
+
+def simulate(sampler, num_clients: int, num_sample_clients: int, num_rounds: int):
+    """Replay cost of every round and the max staleness of a sampled client."""
+    last_updates = [0] * num_clients
+    costs, expected_costs = [], []
+    for num_records in range(num_rounds):
+        staleness = [num_records - last_update for last_update in last_updates]
+        expected_costs.append(sampler.expected_replay_cost(staleness, num_sample_clients))
+        sampled = sampler.sample(staleness, num_sample_clients)
+        assert len(set(sampled)) == num_sample_clients
+        costs.append(sum(staleness[i] for i in sampled))
+        for i in sampled:
+            last_updates[i] = num_records
+    return costs, expected_costs
+
+
+def test_uniform_sampler_matches_random_sample():
+    random.seed(0)
+    expected = random.sample(range(10), 3)
+    random.seed(0)
+    assert UniformSampler().sample([0] * 10, 3) == expected
+    assert UniformSampler().expected_replay_cost([1, 2, 3, 6], 2) == 6
+
+
+def test_round_robin_bounds_replay_cost():
+    random.seed(0)
+    costs, expected_costs = simulate(RoundRobinSampler(10, jitter=0), 10, 2, 50)
+    # after the first pass every client replays exactly num_clients / num_sample_clients rounds
+    assert all(cost == 2 * 5 for cost in costs[5:])
+    assert costs == expected_costs
+
+    random.seed(0)
+    costs, _ = simulate(RoundRobinSampler(10, jitter=2), 10, 2, 200)
+    # (num_clients + jitter) / num_sample_clients + 1 rounds at most for both sampled clients
+    assert max(costs[10:]) <= 2 * 7
+
+
+def test_staleness_sampler_caps_staleness():
+    random.seed(0)
+    sampler = StalenessSampler(max_staleness=6)
+    last_updates = [0] * 10
+    for num_records in range(200):
+        staleness = [num_records - last_update for last_update in last_updates]
+        sampled = sampler.sample(staleness, 2)
+        if max(staleness) >= 6:
+            assert staleness[sampled[0]] == max(staleness)
+        # the stalest are served first, a capped client waits for at most 9 others
+        assert max(staleness) <= 6 + 5
+        for i in sampled:
+            last_updates[i] = num_records
+
+    # uniform staleness, the approximation is exact
+    assert StalenessSampler().expected_replay_cost([4] * 10, 2) == 8
+
+
+def test_samplers_only_choose_candidates():
+    random.seed(0)
+    staleness = [5, 0, 3, 9, 1, 2]
+    candidates = [1, 2, 4]
+    for sampler in [UniformSampler(), RoundRobinSampler(6), StalenessSampler(max_staleness=4)]:
+        for _ in range(5):
+            sampled = sampler.sample(staleness, 2, candidates=candidates)
+            assert len(set(sampled)) == 2 and set(sampled) <= set(candidates)
+        assert sampler.expected_replay_cost(staleness, 2, candidates=candidates) <= 3 + 1
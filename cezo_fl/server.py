@@ -1,10 +1,18 @@
 import abc
 import random
 import torch
-from typing import Any, Iterable, Sequence
-from collections import deque
-
-from cezo_fl.shared import CriterionType, update_model_given_seed_and_grad
+from concurrent.futures import Future
+from copy import deepcopy
+from typing import Any, Iterable, Iterator, Sequence
+
+from cezo_fl.record_log import MappedGradRecordsView, SeedRecordLog
+from cezo_fl.sampling import ClientSampler, UniformSampler
+from cezo_fl.shared import (
+    CriterionType,
+    update_model_given_seed_and_grad,
+    update_model_given_seeds_list_and_grads,
+)
+from shared.evaluation import evaluate_model
 from shared.metrics import Metric
 from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
 from dataclasses import dataclass
@@ -13,8 +21,17 @@ from dataclasses import dataclass
 @dataclass
 class LocalUpdateResult:
     grad_tensors: Sequence[torch.Tensor]
-    step_accuracy: float
-    step_loss: float
+    # Averages over the local update steps, tensors stay on the client's device (no sync).
+    step_accuracy: float | torch.Tensor
+    step_loss: float | torch.Tensor
+
+
+@dataclass
+class ModelSnapshot:
+    """Server model and optimizer state after replaying the first num_records records."""
+
+    num_records: int
+    state_dict: dict
 
 
 class AbstractClient:
@@ -39,7 +56,13 @@ class AbstractClient:
         self,
         seeds_list: Sequence[Sequence[int]],
         gradient_scalar: Sequence[Sequence[torch.Tensor]],
+        snapshot: ModelSnapshot | None = None,
     ) -> None:
+        """Catch up with the server by replaying seeds_list/gradient_scalar.
+
+        Without snapshot, the records start at the client's last pull. With snapshot, the client
+        loads it first and the records start at snapshot.num_records.
+        """
         return NotImplemented
 
     @abc.abstractmethod
@@ -47,50 +70,202 @@ class AbstractClient:
         return NotImplemented
 
 
+@dataclass
+class ClientTask:
+    """Everything one sampled client needs for one round: catch up with the server, then train."""
+
+    client_index: int
+    seeds_list: torch.Tensor  # [num iterations, K] view, see SeedAndGradientRecords
+    grad_list: "GradRecordsView | MappedGradRecordsView"
+    local_update_seeds: Sequence[int]
+    snapshot: ModelSnapshot | None = None
+
+
+# Grad mode is per thread and worker processes start with it enabled, every entry point of a
+# client (serial, thread, process or network worker) goes through here.
+@torch.no_grad()
+def run_client_task(client: AbstractClient, task: ClientTask) -> LocalUpdateResult:
+    if task.snapshot is None:
+        # client will reset model to last pull states before update its model to match server
+        client.pull_model(task.seeds_list, task.grad_list)
+    else:
+        client.pull_model(task.seeds_list, task.grad_list, snapshot=task.snapshot)
+    return client.local_update(seeds=task.local_update_seeds)
+
+
+class AbstractClientExecutor:
+    """Runs the sampled clients of a round concurrently, see cezo_fl/client_executor.py."""
+
+    num_clients: int
+
+    @abc.abstractmethod
+    def run(self, tasks: Sequence[ClientTask]) -> list[LocalUpdateResult]:
+        """Results are returned in the order of tasks, whatever order they finish in."""
+        return NotImplemented
+
+    @abc.abstractmethod
+    def submit(self, task: ClientTask) -> Future:
+        """Start one task without waiting for it, the future's result is its LocalUpdateResult."""
+        return NotImplemented
+
+    @abc.abstractmethod
+    def set_learning_rate(self, lr: float) -> None:
+        return NotImplemented
+
+    @abc.abstractmethod
+    def set_perturbation(self, num_pert: int) -> None:
+        return NotImplemented
+
+    def shutdown(self) -> None:
+        return
+
+
+class GradRecordsView:
+    """
+    Grad records of a range of iterations, a view into SeedAndGradientRecords' buffer.
+
+    view[i] is the [K, num_pert of iteration i] tensor of iteration i, i.e. one dir_grads row per
+    local update. Slicing gives another view, nothing is copied.
+    """
+
+    def __init__(self, grads: torch.Tensor, num_perts: list[int]):
+        self.grads = grads
+        self.num_perts = num_perts
+
+    def __len__(self) -> int:
+        return len(self.num_perts)
+
+    def __getitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            return GradRecordsView(self.grads[index], self.num_perts[index])
+        return self.grads[index, :, : self.num_perts[index]]
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def clone(self) -> "GradRecordsView":
+        """Compact copy, e.g. before pickling (a pickled view carries the whole buffer)."""
+        max_num_pert = max(self.num_perts, default=0)
+        return GradRecordsView(self.grads[:, :, :max_num_pert].clone(), list(self.num_perts))
+
+
 class SeedAndGradientRecords:
-    def __init__(self):
-        # For seed_records/grad_records, each entry stores info related to 1 iteration
-        # seed_records[i]: length = number of local updates K
-        # seed_records[i][k]: seed_k
-        # grad_records[i]: [vector for local_update_k for k in range(K)]
-        # grad_records[i][k]: scalar for 1 perturb or vector for >=1 perturb
-        # What should happen on clients pull server using grad_records[i][k]
-        # client use seed_records[i][k] to generate perturbation(s)
+    def __init__(self, initial_capacity: int = 64):
+        # Each row stores info related to 1 iteration, K = number of local updates
+        # seeds[i]: [K] int64, seeds[i][k]: seed_k
+        # grads[i]: [K, max_num_pert], grads[i][k][:num_perts[i]] is the vector of local_update_k
+        # num_perts[i]: num_pert of iteration i, it can change in the middle of a run
+        # What should happen on clients pull server using grads[i][k]
+        # client use seeds[i][k] to generate perturbation(s)
         # client_grad[i][k]:
-        # vector = mean(perturbations[j] * grad_records[i][k][j] for j)
-
-        self.seed_records: deque[list[int]] = deque()
-        self.grad_records: deque[list[torch.Tensor]] = deque()
+        # vector = mean(perturbations[j] * grads[i][k][j] for j)
+        #
+        # Row r of the buffers is iteration `base + r`. Rows of removed iterations are reused by
+        # moving the live rows to the front when the buffers are full, so the live iterations
+        # are always contiguous and a range fetch is a view.
+        self.capacity = initial_capacity
+        self.base = 0
+        self.seeds: torch.Tensor | None = None
+        self.grads: torch.Tensor | None = None
+        self.num_perts = torch.zeros(initial_capacity, dtype=torch.int64)
         self.earliest_records = 0
         self.current_iteration = -1
+        # Only the latest snapshot is kept, it is always the closest one to the current iteration.
+        self.latest_snapshot: ModelSnapshot | None = None
+
+    @property
+    def num_records(self) -> int:
+        return self.current_iteration + 1
+
+    def add_snapshot(self, state_dict: dict) -> None:
+        self.latest_snapshot = ModelSnapshot(num_records=self.num_records, state_dict=state_dict)
+
+    def _reallocate(self, capacity: int, max_num_pert: int) -> None:
+        """Move the live rows to the front of new buffers."""
+        assert self.seeds is not None and self.grads is not None
+        live = slice(self.earliest_records - self.base, self.num_records - self.base)
+        num_live = live.stop - live.start
+        seeds = self.seeds.new_zeros(capacity, self.seeds.shape[1])
+        grads = self.grads.new_zeros(capacity, self.grads.shape[1], max_num_pert)
+        num_perts = self.num_perts.new_zeros(capacity)
+        seeds[:num_live] = self.seeds[live]
+        grads[:num_live, :, : self.grads.shape[2]] = self.grads[live]
+        num_perts[:num_live] = self.num_perts[live]
+        self.seeds, self.grads, self.num_perts = seeds, grads, num_perts
+        self.capacity = capacity
+        self.base = self.earliest_records
 
     def add_records(self, seeds: list[int], grad: list[torch.Tensor]) -> int:
+        grad_tensor = torch.stack([g.reshape(-1) for g in grad]).cpu()
+        num_local_updates, num_pert = grad_tensor.shape
+        if self.seeds is None:
+            self.seeds = torch.zeros(self.capacity, num_local_updates, dtype=torch.int64)
+            self.grads = torch.zeros(
+                self.capacity, num_local_updates, num_pert, dtype=grad_tensor.dtype
+            )
+        assert len(seeds) == self.seeds.shape[1], "number of local updates can not change"
+
+        if num_pert > self.grads.shape[2]:
+            self._reallocate(self.capacity, num_pert)
+        if self.num_records - self.base == self.capacity:
+            num_live = self.num_records - self.earliest_records
+            # compact in place of growing when at most half of the rows are live
+            capacity = self.capacity if 2 * num_live <= self.capacity else 2 * self.capacity
+            self._reallocate(capacity, self.grads.shape[2])
+
+        row = self.num_records - self.base
+        self.seeds[row] = torch.tensor(seeds, dtype=torch.int64)
+        self.grads[row, :, :num_pert] = grad_tensor
+        self.num_perts[row] = num_pert
         self.current_iteration += 1
-        self.seed_records.append(seeds)
-        self.grad_records.append(grad)
         return self.current_iteration
 
     def remove_too_old(self, earliest_record_needs: int):
-        if self.earliest_records >= earliest_record_needs:
-            return  # No need to do anything
-        while self.earliest_records < earliest_record_needs:
-            self.seed_records.popleft()
-            self.grad_records.popleft()
-            self.earliest_records += 1
-
-    def fetch_seed_records(self, earliest_record_needs: int) -> list[list[int]]:
+        # The rows are reused later, see add_records.
+        self.earliest_records = max(self.earliest_records, earliest_record_needs)
+
+    def fetch_seed_records(self, earliest_record_needs: int) -> torch.Tensor:
+        """[num iterations, K] view of the seeds since earliest_record_needs."""
+        assert earliest_record_needs >= self.earliest_records
+        if self.seeds is None:
+            return torch.zeros(0, 0, dtype=torch.int64)
+        return self.seeds[earliest_record_needs - self.base : self.num_records - self.base]
+
+    def fetch_grad_records(self, earliest_record_needs: int) -> GradRecordsView:
+        assert earliest_record_needs >= self.earliest_records
+        if self.grads is None:
+            return GradRecordsView(torch.zeros(0, 0, 0), [])
+        rows = slice(earliest_record_needs - self.base, self.num_records - self.base)
+        return GradRecordsView(self.grads[rows], self.num_perts[rows].tolist())
+
+
+class PersistentSeedAndGradientRecords(SeedAndGradientRecords):
+    """
+    SeedAndGradientRecords backed by a SeedRecordLog in log_dir instead of memory buffers. Nothing
+    is ever removed from the log (remove_too_old only moves earliest_records), fetches are views of
+    the memory-mapped files. Opening an existing log_dir resumes from its recovered records.
+    """
+
+    def __init__(self, log_dir: str, sync: bool = False):
+        super().__init__(initial_capacity=0)
+        self.log = SeedRecordLog(log_dir, sync=sync)
+        self.current_iteration = len(self.log) - 1
+
+    def add_records(self, seeds: list[int], grad: list[torch.Tensor]) -> int:
+        self.current_iteration = self.log.append(seeds, torch.stack([g.reshape(-1) for g in grad]))
+        return self.current_iteration
+
+    def fetch_seed_records(self, earliest_record_needs: int) -> torch.Tensor:
         assert earliest_record_needs >= self.earliest_records
-        return [
-            self.seed_records[i - self.earliest_records]
-            for i in range(earliest_record_needs, self.current_iteration + 1)
-        ]
+        return self.log.fetch_seeds(earliest_record_needs)
 
-    def fetch_grad_records(self, earliest_record_needs: int) -> list[list[torch.Tensor]]:
+    def fetch_grad_records(self, earliest_record_needs: int) -> MappedGradRecordsView:
         assert earliest_record_needs >= self.earliest_records
-        return [
-            self.grad_records[i - self.earliest_records]
-            for i in range(earliest_record_needs, self.current_iteration + 1)
-        ]
+        return self.log.fetch_grads(earliest_record_needs)
+
+    def close(self) -> None:
+        self.log.close()
 
 
 # TODO Make sure all client model intialized with same weight.
@@ -102,14 +277,38 @@ class CeZO_Server:
         device: torch.device,
         num_sample_clients: int = 10,
         local_update_steps: int = 10,
+        client_executor: AbstractClientExecutor | None = None,
+        snapshot_interval: int | None = None,
+        history_window: int | None = None,
+        snapshot_load_cost: float = 1.0,
+        seed_grad_records: SeedAndGradientRecords | None = None,
+        client_sampler: ClientSampler | None = None,
     ) -> None:
+        # Without client_executor, clients are run one by one in this process. With one, the
+        # executor owns the clients and `clients` may be empty (e.g. they live in worker processes).
         self.clients = clients
+        self.client_executor = client_executor
+        self.num_clients = len(clients) if client_executor is None else client_executor.num_clients
         self.device = device
         self.num_sample_clients = num_sample_clients
         self.local_update_steps = local_update_steps
 
-        self.seed_grad_records = SeedAndGradientRecords()
-        self.client_last_updates = [0 for _ in range(len(self.clients))]
+        # e.g. PersistentSeedAndGradientRecords, in memory by default
+        if seed_grad_records is None:
+            seed_grad_records = SeedAndGradientRecords()
+        self.seed_grad_records = seed_grad_records
+        self.client_last_updates = [0 for _ in range(self.num_clients)]
+        self.client_sampler = client_sampler or UniformSampler()
+
+        # With snapshot_interval, the server model (and optimizer) is snapshotted every
+        # snapshot_interval iterations. A stale client can then load the snapshot and replay only
+        # the records after it, and records older than history_window iterations are dropped even
+        # if some client has not pulled them yet (it will catch up from the snapshot).
+        # snapshot_load_cost is the cost of loading a snapshot in replayed iterations, a client
+        # loads the snapshot only when that is cheaper than replaying from its last pull.
+        self.snapshot_interval = snapshot_interval
+        self.history_window = history_window
+        self.snapshot_load_cost = snapshot_load_cost
 
         self.server_model: torch.nn.Module | None = None
         self.server_criterion: CriterionType | None = None
@@ -135,51 +334,141 @@ class CeZO_Server:
         if self.server_model:
             self.server_model.train()
 
+    def get_client_staleness(self) -> list[int]:
+        """Number of records each client would replay if it was sampled now."""
+        num_records = self.seed_grad_records.num_records
+        return [num_records - last_update for last_update in self.client_last_updates]
+
     def get_sampled_client_index(self) -> list[int]:
-        return random.sample(range(len(self.clients)), self.num_sample_clients)
+        return self.client_sampler.sample(self.get_client_staleness(), self.num_sample_clients)
+
+    def expected_replay_cost(self) -> float:
+        """Records the clients sampled in the next round are expected to replay in total."""
+        return self.client_sampler.expected_replay_cost(
+            self.get_client_staleness(), self.num_sample_clients
+        )
 
     def set_perturbation(self, num_pert: int) -> None:
+        if self.client_executor is not None:
+            self.client_executor.set_perturbation(num_pert)
+            return
         for client in self.clients:
             client.random_gradient_estimator().num_pert = num_pert
 
     def set_learning_rate(self, lr: float) -> None:
         # Client
-        for client in self.clients:
-            for p in client.optimizer.param_groups:
-                p["lr"] = lr
+        if self.client_executor is not None:
+            self.client_executor.set_learning_rate(lr)
+        else:
+            for client in self.clients:
+                for p in client.optimizer.param_groups:
+                    p["lr"] = lr
         # Server
         if self.server_model:
             for p in self.optim.param_groups:
                 p["lr"] = lr
 
-    def train_one_step(self, iteration: int) -> tuple[float, float]:
+    def replay_records(self, start: int, stop: int) -> None:
+        """Apply records [start, stop) to the server model, e.g. to rebuild it from a log."""
+        if self.server_model is None:
+            raise RuntimeError("set_server_model_and_criterion for server first.")
+        update_model_given_seeds_list_and_grads(
+            self.optim,
+            self.random_gradient_estimator,
+            self.seed_grad_records.fetch_seed_records(start)[: stop - start],
+            self.seed_grad_records.fetch_grad_records(start)[: stop - start],
+        )
+
+    def take_snapshot(self) -> None:
+        if self.server_model is None:
+            raise RuntimeError("Snapshots need the server model, set_server_model_and_criterion.")
+        state_dict = {"model": self.server_model.state_dict(), "optimizer": self.optim.state_dict()}
+        self.seed_grad_records.add_snapshot(deepcopy(state_dict))
+
+    def choose_snapshot(self, last_update_iter: int) -> ModelSnapshot | None:
+        """The snapshot a client last updated at last_update_iter should pull from, if any."""
+        snapshot = self.seed_grad_records.latest_snapshot
+        if snapshot is None or snapshot.num_records <= last_update_iter:
+            return None
+        if last_update_iter < self.seed_grad_records.earliest_records:
+            # the records since the client's last pull are gone
+            return snapshot
+        num_records = self.seed_grad_records.num_records
+        full_replay_cost = num_records - last_update_iter
+        snapshot_cost = self.snapshot_load_cost + num_records - snapshot.num_records
+        return snapshot if snapshot_cost < full_replay_cost else None
+
+    def earliest_record_needs(self) -> int:
+        earliest_record_needs = min(self.client_last_updates)
+        snapshot = self.seed_grad_records.latest_snapshot
+        if snapshot is None:
+            return earliest_record_needs
+        # Clients behind the history window catch up from the snapshot, which needs the records
+        # after it.
+        if self.history_window is not None:
+            window_start = self.seed_grad_records.num_records - self.history_window
+            earliest_record_needs = max(earliest_record_needs, window_start)
+        return min(earliest_record_needs, snapshot.num_records)
+
+    def draw_local_update_seeds(self) -> list[int]:
+        return [random.randint(0, 1000000) for _ in range(self.local_update_steps)]
+
+    def make_client_task(self, index: int, seeds: list[int], iteration: int) -> ClientTask:
+        """Task of client `index` starting its local update at `iteration` (= num_records)."""
+        last_update_iter = self.client_last_updates[index]
+        snapshot = self.choose_snapshot(last_update_iter)
+        # The seed and grad in last_update_iter is fetched as well
+        # Note at that iteration, we just reset the client model so that iteration
+        # information is needed as well.
+        earliest_record_needs = last_update_iter if snapshot is None else snapshot.num_records
+        self.client_last_updates[index] = iteration
+        return ClientTask(
+            client_index=index,
+            seeds_list=self.seed_grad_records.fetch_seed_records(earliest_record_needs),
+            grad_list=self.seed_grad_records.fetch_grad_records(earliest_record_needs),
+            local_update_seeds=seeds,
+            snapshot=snapshot,
+        )
+
+    def snapshot_and_trim_records(self) -> None:
+        """Called after new records are added (and applied to the server model)."""
+        if self.snapshot_interval:
+            snapshot = self.seed_grad_records.latest_snapshot
+            last_snapshot_records = 0 if snapshot is None else snapshot.num_records
+            if self.seed_grad_records.num_records - last_snapshot_records >= self.snapshot_interval:
+                self.take_snapshot()
+
+        # Optional: optimize the memory. Remove is exclusive, i.e., the min last updates
+        # information is still kept.
+        self.seed_grad_records.remove_too_old(earliest_record_needs=self.earliest_record_needs())
+
+    def train_one_step(self, iteration: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        One round, returns the average train loss and accuracy of the sampled clients as tensors
+        on the clients' device, so the round does not wait for the device to report them.
+        """
         # Step 0: initiate something
         sampled_client_index = self.get_sampled_client_index()
-        seeds = [random.randint(0, 1000000) for _ in range(self.local_update_steps)]
+        seeds = self.draw_local_update_seeds()
 
         # Step 1 & 2: pull model and local update
+        tasks = [self.make_client_task(index, seeds, iteration) for index in sampled_client_index]
+
+        if self.client_executor is None:
+            results = [run_client_task(self.clients[task.client_index], task) for task in tasks]
+        else:
+            results = self.client_executor.run(tasks)
+
         local_grad_scalar_list: list[list[torch.Tensor]] = []  # Clients X Local_update
         step_train_loss = Metric("Step train loss")
         step_train_accuracy = Metric("Step train accuracy")
-        for index in sampled_client_index:
-            client = self.clients[index]
-            last_update_iter = self.client_last_updates[index]
-            # The seed and grad in last_update_iter is fetched as well
-            # Note at that iteration, we just reset the client model so that iteration
-            # information is needed as well.
-            seeds_list = self.seed_grad_records.fetch_seed_records(last_update_iter)
-            grad_list = self.seed_grad_records.fetch_grad_records(last_update_iter)
-            # client will reset model to last pull states before update its model to match server
-            client.pull_model(seeds_list, grad_list)
-
-            client_local_update_result = client.local_update(seeds=seeds)
-
+        # Results are in the order of sampled_client_index, so the aggregation below does not
+        # depend on how the clients were executed.
+        for client_local_update_result in results:
             step_train_loss.update(client_local_update_result.step_loss)
             step_train_accuracy.update(client_local_update_result.step_accuracy)
             local_grad_scalar_list.append(client_local_update_result.grad_tensors)
 
-            self.client_last_updates[index] = iteration
-
         # Step 3: server-side aggregation
         avg_grad_scalar: list[torch.Tensor] = []
         for each_client_update in zip(*local_grad_scalar_list):
@@ -187,10 +476,6 @@ class CeZO_Server:
 
         self.seed_grad_records.add_records(seeds=seeds, grad=avg_grad_scalar)
 
-        # Optional: optimize the memory. Remove is exclusive, i.e., the min last updates
-        # information is still kept.
-        self.seed_grad_records.remove_too_old(earliest_record_needs=min(self.client_last_updates))
-
         if self.server_model:
             self.train()
             update_model_given_seed_and_grad(
@@ -200,25 +485,23 @@ class CeZO_Server:
                 avg_grad_scalar,
             )
 
-        return step_train_loss.avg, step_train_accuracy.avg
+        self.snapshot_and_trim_records()
+
+        return step_train_loss.avg_tensor, step_train_accuracy.avg_tensor
 
     def eval_model(self, test_loader: Iterable[Any]) -> tuple[float, float]:
         if self.server_model is None:
             raise RuntimeError("set_server_model_and_criterion for server first.")
         self.server_model.eval()
-        eval_loss = Metric("Eval loss")
-        eval_accuracy = Metric("Eval accuracy")
-        with torch.no_grad():
-            for _, (batch_inputs, batch_labels) in enumerate(test_loader):
-                if self.device != torch.device("cpu"):
-                    batch_inputs, batch_labels = batch_inputs.to(self.device), batch_labels.to(
-                        self.device
-                    )
-                pred = self.random_gradient_estimator.model_forward(batch_inputs)
-                eval_loss.update(self.server_criterion(pred, batch_labels))
-                eval_accuracy.update(self.server_accuracy_func(pred, batch_labels))
+        eval_loss, eval_accuracy = evaluate_model(
+            self.random_gradient_estimator.model_forward,
+            self.server_criterion,
+            self.server_accuracy_func,
+            test_loader,
+            self.device,
+        )
         print(
             f"\nEvaluation(Iteration {self.seed_grad_records.current_iteration}): ",
-            f"Eval Loss:{eval_loss.avg:.4f}, " f"Accuracy:{eval_accuracy.avg * 100:.2f}%",
+            f"Eval Loss:{eval_loss:.4f}, " f"Accuracy:{eval_accuracy * 100:.2f}%",
         )
-        return eval_loss.avg, eval_accuracy.avg
+        return eval_loss, eval_accuracy
@@ -1,30 +1,63 @@
+import random
 from cezo_fl.server import (
     AbstractClient,
     LocalUpdateResult,
     CeZO_Server,
+    PersistentSeedAndGradientRecords,
     SeedAndGradientRecords,
     update_model_given_seed_and_grad,
 )
+from cezo_fl.shared import update_model_given_seeds_list_and_grads
 from typing import Sequence
 from unittest.mock import MagicMock, patch
+import pytest
 from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
 import torch
 
 
 def test_seed_records():
-    sr = SeedAndGradientRecords()
+    sr = SeedAndGradientRecords(initial_capacity=2)
 
-    sr.add_records([1, 2, 3], [None] * 3)  # iter 0
-    sr.add_records([2, 3, 4], [None] * 3)  # iter 1
-    assert sr.fetch_seed_records(earliest_record_needs=0) == [[1, 2, 3], [2, 3, 4]]
+    def grads(value: float, num_pert: int = 2):
+        return [torch.full((num_pert,), value) for _ in range(3)]
 
-    sr.add_records([3, 4, 5], [None] * 3)  # iter 2
+    sr.add_records([1, 2, 3], grads(0.1))  # iter 0
+    sr.add_records([2, 3, 4], grads(0.2))  # iter 1
+    assert sr.fetch_seed_records(earliest_record_needs=0).tolist() == [[1, 2, 3], [2, 3, 4]]
+
+    sr.add_records([3, 4, 5], grads(0.3))  # iter 2, buffers grow
     sr.remove_too_old(earliest_record_needs=1)
-    assert sr.fetch_seed_records(earliest_record_needs=2) == [[3, 4, 5]]
-    assert sr.fetch_seed_records(earliest_record_needs=3) == []
+    assert sr.fetch_seed_records(earliest_record_needs=2).tolist() == [[3, 4, 5]]
+    assert sr.fetch_seed_records(earliest_record_needs=3).tolist() == []
+
+    # fetches are views of the buffers
+    seed_records = sr.fetch_seed_records(earliest_record_needs=1)
+    grad_records = sr.fetch_grad_records(earliest_record_needs=1)
+    assert seed_records.data_ptr() == sr.seeds[1 - sr.base].data_ptr()
+    assert grad_records.grads.data_ptr() == sr.grads[1 - sr.base].data_ptr()
+    assert len(grad_records) == 2
+    torch.testing.assert_close(grad_records[1], torch.full((3, 2), 0.3))
+
+    # num_pert changes in the middle of the run
+    sr.add_records([4, 5, 6], grads(0.4, num_pert=3))  # iter 3
+    sr.remove_too_old(earliest_record_needs=2)
+    sr.add_records([5, 6, 7], grads(0.5, num_pert=1))  # iter 4
+    assert sr.fetch_seed_records(earliest_record_needs=2).tolist() == [
+        [3, 4, 5],
+        [4, 5, 6],
+        [5, 6, 7],
+    ]
+    grad_records = sr.fetch_grad_records(earliest_record_needs=2)
+    assert [tuple(g.shape) for g in grad_records] == [(3, 2), (3, 3), (3, 1)]
+    for g, value in zip(grad_records, [0.3, 0.4, 0.5]):
+        torch.testing.assert_close(g, torch.full(g.shape, value))
+    cloned = grad_records[1:].clone()
+    assert [tuple(g.shape) for g in cloned] == [(3, 3), (3, 1)]
+    assert cloned.grads.data_ptr() != grad_records.grads.data_ptr()
 
 
-def test_update_model_given_seed_and_grad():
+@pytest.mark.parametrize("regenerate_perturbation", [False, True])
+def test_update_model_given_seed_and_grad(regenerate_perturbation):
     # Make the update second times and the output suppose to be the same.
     ouputs = []
     for _ in range(2):
@@ -38,7 +71,7 @@ def test_update_model_given_seed_and_grad():
         optim = torch.optim.SGD(fake_model.parameters(), lr=1e-3)
         update_model_given_seed_and_grad(
             optim,
-            RGE(fake_model, num_pert=2),
+            RGE(fake_model, num_pert=2, regenerate_perturbation=regenerate_perturbation),
             iteration_seeds=[1, 2, 3],
             iteration_grad_scalar=[  # two perturbations
                 torch.tensor([0.1, 0.2]),
@@ -114,3 +147,139 @@ def test_server_train_one_step(mocke_get_sampled_client_index):
     second_pull_model_args = clients[2].pull_model.call_args_list[1][0]
     assert len(first_pull_model_args[0]) == 1  # Pull the 0-th round seeds.
     assert len(second_pull_model_args[0]) == 2  # Pull the 1-st and 2-nd round seeds.
+
+
+@pytest.mark.parametrize("history_window", [None, 2])
+def test_snapshot_catch_up_matches_full_replay(history_window, make_client, set_server_model):
+    grads = []
+    for snapshot_interval in [None, 3]:
+        random.seed(0)
+        server = CeZO_Server(
+            [make_client(i) for i in range(4)],
+            torch.device("cpu"),
+            num_sample_clients=1,
+            local_update_steps=2,
+            snapshot_interval=snapshot_interval,
+            history_window=history_window,
+        )
+        set_server_model(server)
+
+        records = server.seed_grad_records
+        iteration_grads = []
+        with torch.no_grad():
+            for iteration in range(12):
+                server.train_one_step(iteration)
+                iteration_grads.append(
+                    records.fetch_grad_records(records.current_iteration)[0].clone()
+                )
+                if snapshot_interval is not None and history_window is not None:
+                    assert records.num_records - records.earliest_records <= 3
+        grads.append(iteration_grads)
+
+    for full_replay_grads, snapshot_grads in zip(*grads):
+        for full_replay_grad, snapshot_grad in zip(full_replay_grads, snapshot_grads):
+            torch.testing.assert_close(full_replay_grad, snapshot_grad)
+
+
+def test_persistent_records_resume(tmp_path, make_client, set_server_model):
+    def make_server(seed_grad_records):
+        server = CeZO_Server(
+            [make_client(i) for i in range(3)],
+            torch.device("cpu"),
+            num_sample_clients=2,
+            local_update_steps=2,
+            seed_grad_records=seed_grad_records,
+        )
+        set_server_model(server)
+        return server
+
+    server_parameters = []
+    for seed_grad_records in [None, PersistentSeedAndGradientRecords(str(tmp_path))]:
+        random.seed(0)
+        server = make_server(seed_grad_records)
+        with torch.no_grad():
+            for iteration in range(5):
+                server.train_one_step(iteration)
+        server_parameters.append([p.clone() for p in server.server_model.parameters()])
+    # the on-disk records train the same way as the in-memory ones
+    for parameter, persistent_parameter in zip(*server_parameters):
+        torch.testing.assert_close(parameter, persistent_parameter)
+    seeds = server.seed_grad_records.fetch_seed_records(0).clone()
+    server.seed_grad_records.close()
+
+    resumed_records = PersistentSeedAndGradientRecords(str(tmp_path))
+    assert resumed_records.num_records == 5
+    assert torch.equal(resumed_records.fetch_seed_records(0), seeds)
+    server = make_server(resumed_records)
+    with torch.no_grad():
+        server.replay_records(0, 5)
+    for parameter, resumed_parameter in zip(server_parameters[1], server.server_model.parameters()):
+        torch.testing.assert_close(parameter, resumed_parameter)
+    resumed_records.close()
+
+
+@pytest.mark.parametrize("regenerate_perturbation", [False, True])
+@pytest.mark.parametrize("momentum,weight_decay", [(0, 0), (0, 1e-2), (0.9, 1e-2)])
+def test_fused_replay_matches_sequential_replay(regenerate_perturbation, momentum, weight_decay):
+    seeds_list = [[1, 2], [3, 4], [5, 6]]
+    grad_scalar_list = [
+        [torch.tensor([0.1, -0.2]), torch.tensor([0.3, 0.4])],
+        [torch.tensor([-0.5, 0.6]), torch.tensor([0.7, -0.8])],
+        [torch.tensor([0.9, 1.0]), torch.tensor([-1.1, 1.2])],
+    ]
+    models, optimizers = [], []
+    for fused in [False, True]:
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(10, 5), torch.nn.ReLU(), torch.nn.Linear(5, 2))
+        rge = RGE(model, num_pert=2, regenerate_perturbation=regenerate_perturbation)
+        optimizer = torch.optim.SGD(
+            model.parameters(), lr=1e-2, momentum=momentum, weight_decay=weight_decay
+        )
+        with torch.no_grad():
+            # start from an existing momentum buffer
+            update_model_given_seed_and_grad(optimizer, rge, [7], [torch.tensor([0.5, 0.5])])
+            update_model_given_seeds_list_and_grads(
+                optimizer, rge, seeds_list, grad_scalar_list, fused=fused
+            )
+        models.append(model)
+        optimizers.append(optimizer)
+
+    for p, fused_p in zip(models[0].parameters(), models[1].parameters()):
+        torch.testing.assert_close(p, fused_p)
+        if momentum != 0:
+            torch.testing.assert_close(
+                optimizers[0].state[p]["momentum_buffer"],
+                optimizers[1].state[fused_p]["momentum_buffer"],
+            )
+
+
+@pytest.mark.parametrize("regenerate_perturbation", [False, True])
+@pytest.mark.parametrize("fused", [False, True])
+def test_replay_from_seed_records(regenerate_perturbation, fused):
+    seeds_list = [[1, 2], [3, 4]]
+    grad_scalar_list = [
+        [torch.tensor([0.1, -0.2]), torch.tensor([0.3, 0.4])],
+        [torch.tensor([-0.5, 0.6]), torch.tensor([0.7, -0.8])],
+    ]
+    records = SeedAndGradientRecords()
+    for seeds, grad in zip(seeds_list, grad_scalar_list):
+        records.add_records(seeds=seeds, grad=grad)
+
+    models = []
+    # python int seeds, then the int64 tensor rows of the records
+    for replayed_seeds, replayed_grads in [
+        (seeds_list, grad_scalar_list),
+        (records.fetch_seed_records(0), records.fetch_grad_records(0)),
+    ]:
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(10, 5), torch.nn.ReLU(), torch.nn.Linear(5, 2))
+        rge = RGE(model, num_pert=2, regenerate_perturbation=regenerate_perturbation)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-2, momentum=0.9)
+        with torch.no_grad():
+            update_model_given_seeds_list_and_grads(
+                optimizer, rge, replayed_seeds, replayed_grads, fused=fused
+            )
+        models.append(model)
+
+    for p, replayed_p in zip(models[0].parameters(), models[1].parameters()):
+        torch.testing.assert_close(p, replayed_p)
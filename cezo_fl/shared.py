@@ -3,12 +3,13 @@ from typing import Sequence, Callable, TypeAlias
 from gradient_estimators.random_gradient_estimator import (
     RandomGradientEstimator as RGE,
 )
+from gradient_estimators.zo_optimizer import ZOSGD
 
 CriterionType: TypeAlias = Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
 
 
 def get_update_grad_for_1_seed(grad_estimator: RGE, perturb_grad_vector: torch.Tensor, seed: int):
-    torch.manual_seed(seed)
+    grad_estimator.manual_seed(seed)
     update_grad = 0
     for local_update_grad in perturb_grad_vector:
         perturb = grad_estimator.generate_perturbation_norm()
@@ -22,6 +23,18 @@ def get_update_grad_for_1_seed(grad_estimator: RGE, perturb_grad_vector: torch.T
     return update_grad.div_(perturb_grad_vector.shape[0])
 
 
+def put_update_grad_for_1_seed(
+    grad_estimator: RGE, perturb_grad_vector: torch.Tensor, seed: int
+) -> None:
+    if grad_estimator.regenerate_perturbation:
+        # Regenerate the perturbations slice by slice instead of a full-dimension update vector.
+        pert_seeds = grad_estimator.get_perturbation_seeds(seed, perturb_grad_vector.shape[0])
+        grad_estimator.put_grad_from_seeds(pert_seeds, perturb_grad_vector)
+    else:
+        update_grad = get_update_grad_for_1_seed(grad_estimator, perturb_grad_vector, seed)
+        grad_estimator.put_grad(update_grad)
+
+
 def update_model_given_seed_and_grad(
     optimizer: torch.optim.Optimizer,
     grad_estimator: RGE,
@@ -29,19 +42,194 @@ def update_model_given_seed_and_grad(
     iteration_grad_scalar: Sequence[torch.Tensor],
 ) -> None:
     assert len(iteration_seeds) == len(iteration_grad_scalar)
+    if isinstance(optimizer, ZOSGD):
+        # Updates the weights directly from seeds, no gradient is materialized.
+        for local_update_seed, local_update_grad_vector in zip(
+            iteration_seeds, iteration_grad_scalar
+        ):
+            optimizer.step(local_update_seed, local_update_grad_vector)
+        return
+
     optimizer.zero_grad()
     for local_update_seed, local_update_grad_vector in zip(iteration_seeds, iteration_grad_scalar):
         # create gradient
-        update_grad = get_update_grad_for_1_seed(
-            grad_estimator, local_update_grad_vector, local_update_seed
-        )
-        grad_estimator.put_grad(update_grad)
+        put_update_grad_for_1_seed(grad_estimator, local_update_grad_vector, local_update_seed)
         # update model
         optimizer.step()
 
 
+def get_replay_sgd_hyperparameters(
+    optimizer: torch.optim.Optimizer,
+) -> tuple[float, float, float] | None:
+    """(lr, momentum, weight_decay) if an optimizer step is the recurrence fused replay handles."""
+    if len(optimizer.param_groups) != 1:
+        return None
+    group = optimizer.param_groups[0]
+    if isinstance(optimizer, ZOSGD):
+        return group["lr"], 0.0, group["weight_decay"]
+    if not isinstance(optimizer, torch.optim.SGD):
+        return None
+    if group["dampening"] != 0 or group["nesterov"] or group.get("maximize", False):
+        return None
+    return group["lr"], group["momentum"], group["weight_decay"]
+
+
+Matrix2x2: TypeAlias = tuple[tuple[float, float], tuple[float, float]]
+
+
+def get_fused_replay_coefficients(
+    lr: float, momentum: float, weight_decay: float, num_steps: int
+) -> tuple[Matrix2x2, list[tuple[float, float]]]:
+    """
+    With w the weights and b the momentum buffer, an SGD step with gradient g is
+        b' = momentum * b + g + weight_decay * w
+        w' = w - lr * b'
+    i.e. (w', b') = A (w, b) + c g with A = [[1 - lr * wd, -lr * momentum], [wd, momentum]] and
+    c = [-lr, 1]. So after num_steps steps
+        (w, b) = A^num_steps (w_0, b_0) + sum_t A^(num_steps - 1 - t) c g_t.
+    Returns A^num_steps and the (w, b) coefficients A^(num_steps - 1 - t) c of every g_t.
+    """
+    a = ((1 - lr * weight_decay, -lr * momentum), (weight_decay, momentum))
+    c = (-lr, 1.0)
+    power: Matrix2x2 = ((1.0, 0.0), (0.0, 1.0))
+    coefficients: list[tuple[float, float]] = [(0.0, 0.0)] * num_steps
+    for t in reversed(range(num_steps)):
+        coefficients[t] = (
+            power[0][0] * c[0] + power[0][1] * c[1],
+            power[1][0] * c[0] + power[1][1] * c[1],
+        )
+        power = (
+            (
+                power[0][0] * a[0][0] + power[0][1] * a[1][0],
+                power[0][0] * a[0][1] + power[0][1] * a[1][1],
+            ),
+            (
+                power[1][0] * a[0][0] + power[1][1] * a[1][0],
+                power[1][0] * a[0][1] + power[1][1] * a[1][1],
+            ),
+        )
+    return power, coefficients
+
+
+@torch.no_grad()
+def fused_update_model_given_seeds_and_grads(
+    optimizer: torch.optim.Optimizer,
+    grad_estimator: RGE,
+    seeds_list: Sequence[Sequence[int]],
+    grad_scalar_list: Sequence[Sequence[torch.Tensor]],
+) -> bool:
+    """
+    Replay many iterations of seed records at once. The replayed gradients do not depend on the
+    weights, so the SGD steps collapse into w = a_ww * w + a_wb * b + sum_t coef_w_t * g_t (and the
+    same for the momentum buffer b), and every parameter is written once.
+
+    Matches update_model_given_seed_and_grad called per iteration up to float rounding. Returns
+    False (and does nothing) when the optimizer is not plain SGD (no dampening, nesterov or
+    maximize) or ZOSGD.
+    """
+    hyperparameters = get_replay_sgd_hyperparameters(optimizer)
+    if hyperparameters is None:
+        return False
+    lr, momentum, weight_decay = hyperparameters
+    steps = [
+        (seed, grad_vector)
+        for iteration_seeds, iteration_grad_scalar in zip(seeds_list, grad_scalar_list)
+        for seed, grad_vector in zip(iteration_seeds, iteration_grad_scalar)
+    ]
+    if len(steps) == 0:
+        return True
+    ((a_ww, a_wb), (a_bw, a_bb)), coefficients = get_fused_replay_coefficients(
+        lr, momentum, weight_decay, len(steps)
+    )
+
+    def get_initial_states(p: torch.Tensor, buf: torch.Tensor | None):
+        new_p = p.mul(a_ww)
+        new_buf = p.mul(a_bw) if momentum != 0 else None
+        if buf is not None:
+            new_p.add_(buf, alpha=a_wb)
+            new_buf.add_(buf, alpha=a_bb)
+        return new_p, new_buf
+
+    def set_states(p: torch.Tensor, new_p: torch.Tensor, new_buf: torch.Tensor | None):
+        p.copy_(new_p)
+        if new_buf is not None:
+            optimizer.state[p]["momentum_buffer"] = new_buf
+
+    parameters_list = grad_estimator.parameters_list
+    bufs = [
+        optimizer.state[p].get("momentum_buffer") if momentum != 0 else None
+        for p in parameters_list
+    ]
+    if grad_estimator.regenerate_perturbation:
+        # (pert_seed, norm, scale of w, scale of b) of every perturbation of every step
+        terms = []
+        for (seed, grad_vector), (coef_w, coef_b) in zip(steps, coefficients):
+            num_pert = grad_vector.shape[0]
+            pert_seeds = grad_estimator.get_perturbation_seeds(seed, num_pert)
+            norms = grad_estimator.seeded_perturbation_norms(pert_seeds)
+            for pert_seed, norm, dir_grad in zip(pert_seeds, norms, grad_vector.tolist()):
+                scale = dir_grad / num_pert
+                terms.append((pert_seed, norm, coef_w * scale, coef_b * scale))
+        for i, (p, buf) in enumerate(zip(parameters_list, bufs)):
+            new_p, new_buf = get_initial_states(p, buf)
+            for pert_seed, norm, scale_w, scale_b in terms:
+                perturb = grad_estimator.regenerate_parameter_perturbation(pert_seed, i, norm)
+                new_p.add_(perturb, alpha=scale_w)
+                if new_buf is not None:
+                    new_buf.add_(perturb, alpha=scale_b)
+            # the perturbations of the other parameters do not read p, so it is written now and
+            # at most one parameter (and buffer) is held twice
+            set_states(p, new_p, new_buf)
+    else:
+        flat_p = torch.cat([p.detach().flatten() for p in parameters_list])
+        flat_buf = None
+        if any(buf is not None for buf in bufs):
+            flat_buf = torch.cat(
+                [
+                    torch.zeros_like(p).flatten() if buf is None else buf.flatten()
+                    for p, buf in zip(parameters_list, bufs)
+                ]
+            )
+        flat_new_p, flat_new_buf = get_initial_states(flat_p, flat_buf)
+        for (seed, grad_vector), (coef_w, coef_b) in zip(steps, coefficients):
+            update_grad = get_update_grad_for_1_seed(grad_estimator, grad_vector, seed)
+            flat_new_p.add_(update_grad, alpha=coef_w)
+            if flat_new_buf is not None:
+                flat_new_buf.add_(update_grad, alpha=coef_b)
+        start = 0
+        for p in parameters_list:
+            new_p = flat_new_p[start : (start + p.numel())].view(p.shape)
+            new_buf = None
+            if flat_new_buf is not None:
+                new_buf = flat_new_buf[start : (start + p.numel())].view(p.shape).clone()
+            set_states(p, new_p, new_buf)
+            start += p.numel()
+    return True
+
+
+def update_model_given_seeds_list_and_grads(
+    optimizer: torch.optim.Optimizer,
+    grad_estimator: RGE,
+    seeds_list: Sequence[Sequence[int]],
+    grad_scalar_list: Sequence[Sequence[torch.Tensor]],
+    fused: bool = False,
+) -> None:
+    """Replay the records of several iterations, in one fused sweep if `fused` and supported."""
+    if fused and fused_update_model_given_seeds_and_grads(
+        optimizer, grad_estimator, seeds_list, grad_scalar_list
+    ):
+        return
+    for iteration_seeds, iteration_grad_scalar in zip(seeds_list, grad_scalar_list):
+        update_model_given_seed_and_grad(
+            optimizer,
+            grad_estimator,
+            iteration_seeds,
+            iteration_grad_scalar,
+        )
+
+
 def revert_SGD_given_seed_and_grad(
-    optimizer: torch.optim.SGD,
+    optimizer: torch.optim.SGD | ZOSGD,
     grad_estimator: RGE,
     iteration_seeds: Sequence[int],
     iteration_grad_scalar: Sequence[torch.Tensor],  # this should be stored in each client
@@ -50,7 +238,9 @@ def revert_SGD_given_seed_and_grad(
     This only works with SGD without momentum and without lr scheduling
     """
     try:
-        assert isinstance(optimizer, torch.optim.SGD) and optimizer.defaults["momentum"] == 0
+        assert isinstance(optimizer, ZOSGD) or (
+            isinstance(optimizer, torch.optim.SGD) and optimizer.defaults["momentum"] == 0
+        )
     except AssertionError:
         raise Exception("Revert only supports SGD without momentum")
 
@@ -60,14 +250,18 @@ def revert_SGD_given_seed_and_grad(
     # reverse loop the seed and scalar
     for i in reversed(range(n_update)):
         local_update_seed, local_update_grad_vector = iteration_seeds[i], iteration_grad_scalar[i]
-        # create gradient
-        update_grad = get_update_grad_for_1_seed(
-            grad_estimator, local_update_grad_vector, local_update_seed
-        )
-
         # update model
         # 1. update using gradient
-        grad_estimator.perturb_model(update_grad, lr)
+        if grad_estimator.regenerate_perturbation:
+            pert_seeds = grad_estimator.get_perturbation_seeds(
+                local_update_seed, local_update_grad_vector.shape[0]
+            )
+            grad_estimator.apply_seeded_update(pert_seeds, local_update_grad_vector, alpha=lr)
+        else:
+            update_grad = get_update_grad_for_1_seed(
+                grad_estimator, local_update_grad_vector, local_update_seed
+            )
+            grad_estimator.perturb_model(update_grad, lr)
         # 2. scale down with weight_decay
         if weight_decay > 0:
             grad_estimator.perturb_model(perturb=None, alpha=1 / (1 - lr * weight_decay))
@@ -0,0 +1,388 @@
+"""
+Networked CeZO-FL: the server drives clients living in other processes (or machines) over TCP or
+Unix sockets.
+
+Wire protocol: every message is a 5-byte header (message type, payload size) followed by the
+payload. A round costs one TASK/RESULT exchange per sampled client:
+- TASK carries the seed records the client has to replay (int64 seeds, int32 num_pert per
+  iteration, float32 scalars), the local update seeds and, only when the client catches up from
+  one, a torch.save-d snapshot. Fields are ordered so every array is aligned to its dtype.
+- RESULT carries the LocalUpdateResult, two float64 metrics and K * num_pert float32 scalars.
+A worker process connects to the server and sends HELLO with the int32 indices of the clients it
+hosts.
+"""
+
+import asyncio
+import enum
+import io
+import multiprocessing
+import struct
+import threading
+import torch
+from concurrent.futures import Future
+from typing import Callable, Sequence
+
+from cezo_fl.client_executor import set_client_learning_rate, set_client_perturbation
+from cezo_fl.record_log import MappedGradRecordsView
+from cezo_fl.server import (
+    AbstractClient,
+    AbstractClientExecutor,
+    ClientTask,
+    LocalUpdateResult,
+    ModelSnapshot,
+    run_client_task,
+)
+
+
+class MessageType(enum.IntEnum):
+    HELLO = 1
+    TASK = 2
+    RESULT = 3
+    SET_LEARNING_RATE = 4
+    SET_PERTURBATION = 5
+    ACK = 6
+    ERROR = 7
+    SHUTDOWN = 8
+
+
+_HEADER = struct.Struct("<BI")
+# client index, num iterations, K (seeds per iteration), num local update seeds, has snapshot,
+# padded to 8 bytes
+_TASK_HEADER = struct.Struct("<iiii?7x")
+# step loss, step accuracy, K, num_pert
+_RESULT_HEADER = struct.Struct("<ddii")
+_INT = struct.Struct("<i")
+_FLOAT = struct.Struct("<d")
+
+
+def parse_address(address: str) -> tuple[str, str | int]:
+    """Parse "unix:/path/to.sock" to ("unix", path) and "host:port" to (host, port)."""
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:") :]
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[MessageType, bytearray]:
+    message_type, size = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    # bytearray, so tensors decoded from it are writable views
+    return MessageType(message_type), bytearray(await reader.readexactly(size))
+
+
+def write_message(writer: asyncio.StreamWriter, message_type: MessageType, payload: bytes) -> int:
+    """Queue a message, returns the bytes written. Await writer.drain() to flush."""
+    writer.write(_HEADER.pack(message_type, len(payload)))
+    writer.write(payload)
+    return _HEADER.size + len(payload)
+
+
+def _tensor_bytes(tensor: torch.Tensor, dtype: torch.dtype) -> bytes:
+    return tensor.detach().to("cpu", dtype).contiguous().numpy().tobytes()
+
+
+class _PayloadReader:
+    def __init__(self, payload: bytearray):
+        self.payload = payload
+        self.offset = 0
+
+    def unpack(self, s: struct.Struct) -> tuple:
+        values = s.unpack_from(self.payload, self.offset)
+        self.offset += s.size
+        return values
+
+    def tensor(self, dtype: torch.dtype, count: int) -> torch.Tensor:
+        if count == 0:
+            return torch.zeros(0, dtype=dtype)
+        tensor = torch.frombuffer(self.payload, dtype=dtype, count=count, offset=self.offset)
+        self.offset += count * dtype.itemsize
+        return tensor
+
+    def rest(self) -> bytes:
+        return bytes(self.payload[self.offset :])
+
+
+def encode_task(task: ClientTask) -> bytes:
+    seeds = torch.as_tensor(task.seeds_list, dtype=torch.int64)
+    # rows are [K, num_pert] tensors, or lists of K [num_pert] tensors
+    grad_rows = [g if isinstance(g, torch.Tensor) else torch.stack(list(g)) for g in task.grad_list]
+    num_iterations = len(grad_rows)
+    num_local_updates = seeds.shape[1] if num_iterations > 0 else 0
+    grads = [g.reshape(-1) for g in grad_rows]
+    num_perts = [g.shape[1] for g in grad_rows]
+    parts = [
+        _TASK_HEADER.pack(
+            task.client_index,
+            num_iterations,
+            num_local_updates,
+            len(task.local_update_seeds),
+            task.snapshot is not None,
+        ),
+        _tensor_bytes(seeds, torch.int64),
+        _tensor_bytes(torch.tensor(task.local_update_seeds, dtype=torch.int64), torch.int64),
+        _tensor_bytes(torch.tensor(num_perts, dtype=torch.int32), torch.int32),
+        _tensor_bytes(torch.cat(grads) if grads else torch.zeros(0), torch.float32),
+    ]
+    if task.snapshot is not None:
+        buffer = io.BytesIO()
+        torch.save((task.snapshot.num_records, task.snapshot.state_dict), buffer)
+        parts.append(buffer.getvalue())
+    return b"".join(parts)
+
+
+def decode_task(payload: bytearray) -> ClientTask:
+    reader = _PayloadReader(payload)
+    client_index, num_iterations, num_local_updates, num_local_update_seeds, has_snapshot = (
+        reader.unpack(_TASK_HEADER)
+    )
+    seeds = reader.tensor(torch.int64, num_iterations * num_local_updates)
+    local_update_seeds = reader.tensor(torch.int64, num_local_update_seeds).tolist()
+    num_perts = reader.tensor(torch.int32, num_iterations).to(torch.int64)
+    sizes = num_perts * num_local_updates
+    grads = reader.tensor(torch.float32, int(sizes.sum()))
+    # (offset, K, num_pert) per iteration, the layout of MappedGradRecordsView
+    index = torch.stack(
+        [sizes.cumsum(0) - sizes, torch.full_like(sizes, num_local_updates), num_perts], dim=1
+    )
+    snapshot = None
+    if has_snapshot:
+        num_records, state_dict = torch.load(io.BytesIO(reader.rest()), map_location="cpu")
+        snapshot = ModelSnapshot(num_records=num_records, state_dict=state_dict)
+    return ClientTask(
+        client_index=client_index,
+        seeds_list=seeds.view(num_iterations, num_local_updates),
+        grad_list=MappedGradRecordsView(grads, index),
+        local_update_seeds=local_update_seeds,
+        snapshot=snapshot,
+    )
+
+
+def encode_result(result: LocalUpdateResult) -> bytes:
+    grads = torch.stack([g.reshape(-1) for g in result.grad_tensors])
+    return _RESULT_HEADER.pack(
+        float(result.step_loss), float(result.step_accuracy), *grads.shape
+    ) + _tensor_bytes(grads, torch.float32)
+
+
+def decode_result(payload: bytearray) -> LocalUpdateResult:
+    reader = _PayloadReader(payload)
+    step_loss, step_accuracy, num_local_updates, num_pert = reader.unpack(_RESULT_HEADER)
+    grads = reader.tensor(torch.float32, num_local_updates * num_pert)
+    return LocalUpdateResult(
+        grad_tensors=list(grads.view(num_local_updates, num_pert)),
+        step_accuracy=step_accuracy,
+        step_loss=step_loss,
+    )
+
+
+class _Connection:
+    """One worker connection, requests are answered in order one at a time."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    async def request(self, message_type: MessageType, payload: bytes) -> bytearray:
+        async with self.lock:
+            self.bytes_sent += write_message(self.writer, message_type, payload)
+            await self.writer.drain()
+            reply_type, reply = await read_message(self.reader)
+        self.bytes_received += _HEADER.size + len(reply)
+        if reply_type == MessageType.ERROR:
+            raise RuntimeError(f"Client worker failed: {reply.decode()}")
+        return reply
+
+
+class NetworkClientExecutor(AbstractClientExecutor):
+    """
+    Runs the sampled clients in worker processes connected over TCP ("host:port", port 0 picks a
+    free one) or a Unix socket ("unix:/path"). The server's asyncio loop runs in a background
+    thread, so CeZO_Server keeps its synchronous interface.
+
+    Workers are started with spawn_local_workers, or elsewhere with run_client_worker(address,
+    ...); wait_for_clients blocks until every one of the num_clients clients is hosted.
+    """
+
+    def __init__(self, num_clients: int, address: str = "127.0.0.1:0"):
+        self.num_clients = num_clients
+        self.connections: dict[int, _Connection] = {}
+        self.worker_processes: list[multiprocessing.process.BaseProcess] = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.address = self._call(self._start_server(address))
+
+    def _call(self, coroutine, timeout: float | None = None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    async def _start_server(self, address: str) -> str:
+        self.all_connected = asyncio.Event()
+        host, port = parse_address(address)
+        if host == "unix":
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=port)
+            return address
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"{host}:{port}"
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        message_type, payload = await read_message(reader)
+        assert message_type == MessageType.HELLO
+        connection = _Connection(reader, writer)
+        connection.bytes_received += _HEADER.size + len(payload)
+        for client_index in _PayloadReader(payload).tensor(torch.int32, len(payload) // 4).tolist():
+            self.connections[client_index] = connection
+        if len(self.connections) == self.num_clients:
+            self.all_connected.set()
+
+    def wait_for_clients(self, timeout: float | None = None) -> None:
+        self._call(asyncio.wait_for(self.all_connected.wait(), timeout))
+
+    def spawn_local_workers(
+        self,
+        client_factories: Sequence[Callable[[], AbstractClient]],
+        num_workers: int,
+        num_threads_per_worker: int = 1,
+    ) -> None:
+        """Same placement as ProcessPoolClientExecutor, client i is hosted by worker i % n."""
+        mp_context = multiprocessing.get_context("spawn")
+        for worker_index in range(num_workers):
+            worker_client_factories = {
+                client_index: client_factories[client_index]
+                for client_index in range(worker_index, len(client_factories), num_workers)
+            }
+            process = mp_context.Process(
+                target=run_client_worker,
+                args=(self.address, worker_client_factories, num_threads_per_worker),
+            )
+            process.start()
+            self.worker_processes.append(process)
+        self.wait_for_clients()
+
+    @property
+    def bytes_sent(self) -> int:
+        return sum(connection.bytes_sent for connection in set(self.connections.values()))
+
+    @property
+    def bytes_received(self) -> int:
+        return sum(connection.bytes_received for connection in set(self.connections.values()))
+
+    async def _run_task(self, task: ClientTask) -> LocalUpdateResult:
+        connection = self.connections[task.client_index]
+        return decode_result(await connection.request(MessageType.TASK, encode_task(task)))
+
+    async def _run_tasks(self, tasks: Sequence[ClientTask]) -> list[LocalUpdateResult]:
+        return await asyncio.gather(*[self._run_task(task) for task in tasks])
+
+    def run(self, tasks: Sequence[ClientTask]) -> list[LocalUpdateResult]:
+        return self._call(self._run_tasks(tasks))
+
+    def submit(self, task: ClientTask) -> Future:
+        return asyncio.run_coroutine_threadsafe(self._run_task(task), self.loop)
+
+    async def _broadcast(self, message_type: MessageType, payload: bytes) -> None:
+        connections = set(self.connections.values())
+        await asyncio.gather(*[c.request(message_type, payload) for c in connections])
+
+    def set_learning_rate(self, lr: float) -> None:
+        self._call(self._broadcast(MessageType.SET_LEARNING_RATE, _FLOAT.pack(lr)))
+
+    def set_perturbation(self, num_pert: int) -> None:
+        self._call(self._broadcast(MessageType.SET_PERTURBATION, _INT.pack(num_pert)))
+
+    async def _shutdown(self) -> None:
+        for connection in set(self.connections.values()):
+            write_message(connection.writer, MessageType.SHUTDOWN, b"")
+            await connection.writer.drain()
+            connection.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def shutdown(self) -> None:
+        self._call(self._shutdown())
+        for process in self.worker_processes:
+            process.join()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class RemoteClient(AbstractClient):
+    """
+    Proxy of client client_index of a NetworkClientExecutor, for code that drives AbstractClients
+    one by one. pull_model is sent together with the next local_update, in one round trip.
+    """
+
+    def __init__(self, client_executor: NetworkClientExecutor, client_index: int):
+        self.client_executor = client_executor
+        self.client_index = client_index
+        self.pending_pull: tuple = ()
+        self.pull_model(torch.zeros(0, 0, dtype=torch.int64), [])
+
+    def pull_model(
+        self,
+        seeds_list: Sequence[Sequence[int]],
+        gradient_scalar: Sequence[Sequence[torch.Tensor]],
+        snapshot: ModelSnapshot | None = None,
+    ) -> None:
+        self.pending_pull = (seeds_list, gradient_scalar, snapshot)
+
+    def local_update(self, seeds: Sequence[int]) -> LocalUpdateResult:
+        seeds_list, gradient_scalar, snapshot = self.pending_pull
+        task = ClientTask(self.client_index, seeds_list, gradient_scalar, seeds, snapshot)
+        self.pull_model(torch.zeros(0, 0, dtype=torch.int64), [])
+        return self.client_executor.run([task])[0]
+
+
+def run_client_worker(
+    address: str,
+    client_factories: dict[int, Callable[[], AbstractClient]],
+    num_threads: int = 1,
+) -> None:
+    """Build the clients, connect to a NetworkClientExecutor at address and serve until SHUTDOWN."""
+    torch.set_num_threads(num_threads)
+    clients = {client_index: factory() for client_index, factory in client_factories.items()}
+    # the spawned process starts with grad enabled, clients perturb their parameters in place
+    with torch.no_grad():
+        asyncio.run(_serve_clients(address, clients))
+
+
+async def _serve_clients(address: str, clients: dict[int, AbstractClient]) -> None:
+    host, port = parse_address(address)
+    if host == "unix":
+        reader, writer = await asyncio.open_unix_connection(port)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    hello = _tensor_bytes(torch.tensor(list(clients), dtype=torch.int32), torch.int32)
+    write_message(writer, MessageType.HELLO, hello)
+    await writer.drain()
+
+    while True:
+        message_type, payload = await read_message(reader)
+        if message_type == MessageType.SHUTDOWN:
+            break
+        try:
+            if message_type == MessageType.TASK:
+                task = decode_task(payload)
+                result = run_client_task(clients[task.client_index], task)
+                write_message(writer, MessageType.RESULT, encode_result(result))
+            elif message_type == MessageType.SET_LEARNING_RATE:
+                (lr,) = _FLOAT.unpack(payload)
+                for client in clients.values():
+                    set_client_learning_rate(client, lr)
+                write_message(writer, MessageType.ACK, b"")
+            elif message_type == MessageType.SET_PERTURBATION:
+                (num_pert,) = _INT.unpack(payload)
+                for client in clients.values():
+                    set_client_perturbation(client, num_pert)
+                write_message(writer, MessageType.ACK, b"")
+            else:
+                raise ValueError(f"Unexpected message {message_type.name}")
+        except Exception as e:
+            write_message(writer, MessageType.ERROR, repr(e).encode())
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
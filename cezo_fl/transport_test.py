@@ -0,0 +1,71 @@
+from functools import partial
+import torch
+
+from cezo_fl.server import ClientTask, GradRecordsView, LocalUpdateResult, ModelSnapshot
+from cezo_fl.transport import (
+    NetworkClientExecutor,
+    RemoteClient,
+    decode_result,
+    decode_task,
+    encode_result,
+    encode_task,
+)
+
+
+def test_task_and_result_round_trip():
+    grads = torch.zeros(2, 3, 4)
+    grads[0, :, :2] = torch.randn(3, 2)
+    grads[1] = torch.randn(3, 4)
+    task = ClientTask(
+        client_index=7,
+        seeds_list=torch.tensor([[1, 2, 3], [4, 5, 6]]),
+        grad_list=GradRecordsView(grads, [2, 4]),
+        local_update_seeds=[8, 9, 10],
+        snapshot=ModelSnapshot(num_records=1, state_dict={"model": {"w": torch.ones(2)}}),
+    )
+    decoded = decode_task(bytearray(encode_task(task)))
+    assert decoded.client_index == 7
+    assert decoded.seeds_list.tolist() == [[1, 2, 3], [4, 5, 6]]
+    assert decoded.local_update_seeds == [8, 9, 10]
+    assert len(decoded.grad_list) == 2
+    for grad, decoded_grad in zip(task.grad_list, decoded.grad_list):
+        assert torch.equal(grad, decoded_grad)
+    assert decoded.snapshot.num_records == 1
+    assert torch.equal(decoded.snapshot.state_dict["model"]["w"], torch.ones(2))
+
+    result = LocalUpdateResult(
+        grad_tensors=[torch.randn(4) for _ in range(3)], step_accuracy=0.5, step_loss=1.5
+    )
+    decoded_result = decode_result(bytearray(encode_result(result)))
+    assert (decoded_result.step_loss, decoded_result.step_accuracy) == (1.5, 0.5)
+    for grad, decoded_grad in zip(result.grad_tensors, decoded_result.grad_tensors):
+        assert torch.equal(grad, decoded_grad)
+
+
+def test_network_matches_serial(tmp_path, make_client, train_server):
+    _, serial_grads = train_server([make_client(i) for i in range(3)], None)
+
+    for address in ["127.0.0.1:0", f"unix:{tmp_path / 'cezo_fl.sock'}"]:
+        client_executor = NetworkClientExecutor(3, address=address)
+        try:
+            client_executor.spawn_local_workers([partial(make_client, i) for i in range(3)], 2)
+            _, network_grads = train_server([], client_executor)
+            assert client_executor.bytes_sent > 0 and client_executor.bytes_received > 0
+        finally:
+            client_executor.shutdown()
+
+        assert len(serial_grads) == len(network_grads)
+        for serial_iteration_grads, network_iteration_grads in zip(serial_grads, network_grads):
+            for serial_grad, network_grad in zip(serial_iteration_grads, network_iteration_grads):
+                assert torch.equal(serial_grad, network_grad)
+
+
+def test_remote_local_update_outside_no_grad(make_client):
+    client_executor = NetworkClientExecutor(1)
+    try:
+        client_executor.spawn_local_workers([partial(make_client, 0)], 1)
+        assert torch.is_grad_enabled()
+        result = RemoteClient(client_executor, 0).local_update(seeds=[1, 2])
+    finally:
+        client_executor.shutdown()
+    assert len(result.grad_tensors) == 2
@@ -1,5 +1,6 @@
 import torch.nn as nn
 import torch
+from functools import partial
 from tensorboardX import SummaryWriter
 from os import path
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -7,19 +8,26 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 from config import get_params, get_args_str
 from preprocess import preprocess_cezo_fl
 
-from cezo_fl.server import CeZO_Server
-from cezo_fl.client import ResetClient
+from cezo_fl.async_server import BufferedAsyncCeZO_Server
+from cezo_fl.sampling import get_client_sampler
+from cezo_fl.server import CeZO_Server, PersistentSeedAndGradientRecords
+from cezo_fl.client import ClientWorkspace, ResetClient, VirtualClient
+from cezo_fl.batched_clients import BatchedClientExecutor
+from cezo_fl.client_executor import ProcessPoolClientExecutor, ThreadPoolClientExecutor
+from cezo_fl.transport import NetworkClientExecutor
 
 from shared.model_helpers import get_current_datetime_str
 from models.cnn_mnist import CNN_MNIST
 from models.lenet import LeNet
 from models.cnn_fashion import CNN_FMNIST
 from models.lstm import CharLSTM
-from shared.language_utils import get_lm_loss, LM_TEMPLATE_MAP
+from shared.language_utils import get_lm_loss, LengthBucketBatchSampler, LM_TEMPLATE_MAP
+from shared.evaluation import BackgroundEvaluator, evaluate_model
 from shared.metrics import accuracy
 
 from tqdm import tqdm
 from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+from gradient_estimators.zo_optimizer import ZOSGD
 
 
 def prepare_settings_underseed(args, device):
@@ -62,7 +70,11 @@ def prepare_settings_underseed(args, device):
         # )
     elif args.dataset in LM_TEMPLATE_MAP.keys():
         model_name = "facebook/opt-125m"
-        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        # Move to device before creating the gradient estimator, --flat-parameters re-homes the
+        # parameters and a later `.to(device)` would detach them again.
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32).to(
+            device
+        )
         model.model_name = "opt-125m"
         tokenizer = AutoTokenizer.from_pretrained(
             model_name, padding_side="left", truncate_side="left"
@@ -75,6 +87,13 @@ def prepare_settings_underseed(args, device):
     else:
         raise Exception(f"Dataset {args.dataset} is not supported")
 
+    verbalizer_id_list = None
+    if args.verbalizer_scoring:
+        if args.dataset not in LM_TEMPLATE_MAP.keys():
+            raise Exception("--verbalizer-scoring is only supported for LM datasets")
+        # the last_token criterion only reads these logits
+        verbalizer_id_list = [verbalizer_id_map[i] for i in range(len(verbalizer_id_map))]
+
     if args.grad_estimate_method in ["rge-central", "rge-forward"]:
         method = args.grad_estimate_method[4:]
         print(f"Using RGE {method}")
@@ -84,41 +103,131 @@ def prepare_settings_underseed(args, device):
             num_pert=args.num_pert,
             grad_estimate_method=method,
             device=device,
+            pert_batch_size=args.pert_batch_size,
+            regenerate_perturbation=args.regenerate_perturbation,
+            flat_parameters=args.flat_parameters,
+            fused_central_sweep=args.fused_central_sweep,
+            perturbation_chunk_size=args.perturbation_chunk_size,
+            verbalizer_id_list=verbalizer_id_list,
         )
     else:
         raise Exception(f"Grad estimate method {args.grad_estimate_method} not supported")
+
+    if args.fused_zo_sgd:
+        if optimizer.defaults["momentum"] != 0:
+            raise Exception("--fused-zo-sgd only supports SGD without momentum")
+        optimizer = ZOSGD(
+            grad_estimator, lr=args.lr, weight_decay=optimizer.defaults["weight_decay"]
+        )
     return model, criterion, optimizer, grad_estimator, accuracy_func
 
 
+def build_client(args, device, train_loader) -> ResetClient:
+    (
+        client_model,
+        client_criterion,
+        client_optimizer,
+        client_grad_estimator,
+        client_accuracy_func,
+    ) = prepare_settings_underseed(args, device)
+    client_model.to(device)
+
+    return ResetClient(
+        client_model,
+        train_loader,
+        client_grad_estimator,
+        client_optimizer,
+        client_criterion,
+        client_accuracy_func,
+        device,
+        fused_replay=args.fused_replay,
+        exact_metrics_interval=args.exact_train_metrics_interval,
+    )
+
+
 def setup_server_and_clients(args, device, train_loaders) -> CeZO_Server:
     clients = []
-
-    for i in range(args.num_clients):
+    client_executor = None
+    if args.virtual_clients:
+        if args.client_executor != "serial":
+            raise Exception("--virtual-clients only supports --client-executor serial")
         (
-            client_model,
-            client_criterion,
-            client_optimizer,
-            client_grad_estimator,
-            client_accuracy_func,
+            workspace_model,
+            workspace_criterion,
+            workspace_optimizer,
+            workspace_grad_estimator,
+            workspace_accuracy_func,
         ) = prepare_settings_underseed(args, device)
-        client_model.to(device)
-
-        client = ResetClient(
-            client_model,
-            train_loaders[i],
-            client_grad_estimator,
-            client_optimizer,
-            client_criterion,
-            client_accuracy_func,
+        workspace = ClientWorkspace(
+            workspace_model,
+            workspace_grad_estimator,
+            workspace_optimizer,
+            workspace_criterion,
+            workspace_accuracy_func,
             device,
+            fused_replay=args.fused_replay,
+            exact_metrics_interval=args.exact_train_metrics_interval,
+        )
+        for i in range(args.num_clients):
+            clients.append(VirtualClient(workspace, train_loaders[i]))
+    elif args.client_executor == "process":
+        # clients are built inside the worker processes and never exist in this one
+        client_executor = ProcessPoolClientExecutor(
+            [
+                partial(build_client, args, device, train_loaders[i])
+                for i in range(args.num_clients)
+            ],
+            num_workers=args.num_client_workers,
+            num_threads_per_worker=args.client_worker_threads,
+        )
+    elif args.client_executor == "network":
+        # clients are built in local worker processes that connect over --server-address
+        client_executor = NetworkClientExecutor(args.num_clients, address=args.server_address)
+        client_executor.spawn_local_workers(
+            [
+                partial(build_client, args, device, train_loaders[i])
+                for i in range(args.num_clients)
+            ],
+            num_workers=args.num_client_workers,
+            num_threads_per_worker=args.client_worker_threads,
         )
-        clients.append(client)
+    else:
+        for i in range(args.num_clients):
+            clients.append(build_client(args, device, train_loaders[i]))
+        if args.client_executor == "thread":
+            client_executor = ThreadPoolClientExecutor(clients, args.num_client_workers)
+        elif args.client_executor == "batched":
+            client_executor = BatchedClientExecutor(clients)
 
-    server = CeZO_Server(
+    async_kwargs = {}
+    server_class = CeZO_Server
+    if args.async_buffer_size:
+        server_class = BufferedAsyncCeZO_Server
+        async_kwargs = {
+            "buffer_size": args.async_buffer_size,
+            "staleness_exponent": args.staleness_exponent,
+        }
+    server = server_class(
         clients,
         device,
         num_sample_clients=args.num_sample_clients,
         local_update_steps=args.local_update_steps,
+        client_executor=client_executor,
+        snapshot_interval=args.snapshot_interval,
+        history_window=args.history_window,
+        snapshot_load_cost=args.snapshot_load_cost,
+        seed_grad_records=(
+            PersistentSeedAndGradientRecords(args.record_log_dir)
+            if args.record_log_dir
+            else None
+        ),
+        client_sampler=get_client_sampler(
+            args.client_sampling,
+            args.num_clients,
+            jitter=args.sampling_jitter,
+            max_staleness=args.max_staleness,
+        ),
+        **async_kwargs,
     )
 
     # set server tools
@@ -140,6 +249,43 @@ def setup_server_and_clients(args, device, train_loaders) -> CeZO_Server:
     return server
 
 
+# iteration -> (lr scale, num_pert scale), applied after that iteration. Iterations count server
+# records: one per round, or one per aggregated version with --async-buffer-size.
+SCHEDULE = {500: (0.8, 2), 1000: (0.5, 4), 2000: (0.3, 8)}
+
+
+def get_lr_and_num_pert(args, iteration: int) -> tuple[float, int]:
+    """lr and num_pert the schedule uses at iteration."""
+    lr, num_pert = args.lr, args.num_pert
+    for milestone, (lr_scale, num_pert_scale) in SCHEDULE.items():
+        if iteration > milestone:
+            lr, num_pert = args.lr * lr_scale, args.num_pert * num_pert_scale
+    return lr, num_pert
+
+
+def reaches_multiple(start: int, stop: int, interval: int) -> bool:
+    """Whether a multiple of interval is in (start, stop], i.e. reached by a step from start."""
+    return stop // interval > start // interval
+
+
+def resume_server(server: CeZO_Server, args) -> int:
+    """
+    Rebuild the server model from the records recovered from --record-log-dir, returns the
+    iteration to continue from. Clients start from scratch and replay the whole log on their first
+    pull.
+    """
+    num_records = server.seed_grad_records.num_records
+    # replay every schedule segment with the lr it was trained with
+    boundaries = sorted({0, num_records} | {m + 1 for m in SCHEDULE if m + 1 < num_records})
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        server.set_learning_rate(get_lr_and_num_pert(args, start)[0])
+        server.replay_records(start, stop)
+    lr, num_pert = get_lr_and_num_pert(args, num_records)
+    server.set_learning_rate(lr)
+    server.set_perturbation(num_pert)
+    return num_records
+
+
 # def get_warmup_lr(
 #     args, current_epoch: int, current_iter: int, iters_per_epoch: int
 # ) -> float:
@@ -173,28 +319,116 @@ if __name__ == "__main__":
             )
         )
 
-    with tqdm(total=args.iterations, desc="Training:") as t, torch.no_grad():
-        for ite in range(args.iterations):
+    evaluator = None
+    if args.background_eval:
+        # the replica is built like the server model and only receives its weights
+        replica_model, _, _, replica_grad_estimator, _ = prepare_settings_underseed(args, device)
+        evaluator = BackgroundEvaluator(
+            replica_model,
+            test_loader,
+            lambda _, batches: evaluate_model(
+                replica_grad_estimator.model_forward,
+                server.server_criterion,
+                server.server_accuracy_func,
+                batches,
+                device,
+            ),
+        )
+
+    def log_eval_results(eval_results: list[tuple[int, float, float]]) -> None:
+        for eval_ite, eval_loss, eval_accuracy in eval_results:
+            if evaluator is not None:
+                print(
+                    f"\nEvaluation(Iteration {eval_ite}): ",
+                    f"Eval Loss:{eval_loss:.4f}, " f"Accuracy:{eval_accuracy * 100:.2f}%",
+                )
+            if args.log_to_tensorboard:
+                writer.add_scalar("Loss/test", eval_loss, eval_ite)
+                writer.add_scalar("Accuracy/test", eval_accuracy, eval_ite)
+
+    # train metrics stay on the device until metrics_sync_interval rounds are pending
+    pending_train_metrics: list[tuple[int, torch.Tensor, torch.Tensor]] = []
+
+    def log_train_metrics(t: tqdm) -> None:
+        if not pending_train_metrics:
+            return
+        # one sync for all pending rounds
+        values = torch.stack(
+            [torch.stack([loss, accuracy]) for _, loss, accuracy in pending_train_metrics]
+        ).tolist()
+        for (train_ite, _, _), (train_loss, train_accuracy) in zip(pending_train_metrics, values):
+            if args.log_to_tensorboard:
+                writer.add_scalar("Loss/train", train_loss, train_ite)
+                writer.add_scalar("Accuracy/train", train_accuracy, train_ite)
+        t.set_postfix({"Loss": train_loss, "Accuracy": train_accuracy})
+        pending_train_metrics.clear()
+
+    start_iteration = 0
+    if server.seed_grad_records.num_records > 0:
+        with torch.no_grad():
+            start_iteration = resume_server(server, args)
+        print(f"Resumed from {start_iteration} iterations in {args.record_log_dir}")
+
+    with tqdm(
+        total=args.iterations, initial=start_iteration, desc="Training:"
+    ) as t, torch.no_grad():
+        # the records are the iteration counter, as in resume_server: an async aggregation can
+        # add several of them in one step
+        ite = start_iteration
+        lr, num_pert = get_lr_and_num_pert(args, ite)
+        while ite < args.iterations:
+            expected_replay_cost = server.expected_replay_cost()
             step_loss, step_accuracy = server.train_one_step(ite)
             torch.cuda.empty_cache()
-            t.set_postfix({"Loss": step_loss, "Accuracy": step_accuracy})
-            t.update(1)
-            if ite == 500:
-                server.set_learning_rate(args.lr * 0.8)
-                server.set_perturbation(args.num_pert * 2)
-            elif ite == 1000:
-                server.set_learning_rate(args.lr * 0.5)
-                server.set_perturbation(args.num_pert * 4)
-            elif ite == 2000:
-                server.set_learning_rate(args.lr * 0.3)
-                server.set_perturbation(args.num_pert * 8)
+            next_ite = server.seed_grad_records.num_records
+            pending_train_metrics.append((ite, step_loss, step_accuracy))
+            if reaches_multiple(ite, next_ite, args.metrics_sync_interval):
+                log_train_metrics(t)
+            t.update(next_ite - ite)
+            if get_lr_and_num_pert(args, next_ite) != (lr, num_pert):
+                lr, num_pert = get_lr_and_num_pert(args, next_ite)
+                server.set_learning_rate(lr)
+                server.set_perturbation(num_pert)
 
             if args.log_to_tensorboard:
-                writer.add_scalar("Loss/train", step_loss, ite)
-                writer.add_scalar("Accuracy/train", step_accuracy, ite)
+                writer.add_scalar("ReplayCost/expected", expected_replay_cost, ite)
+                if isinstance(server, BufferedAsyncCeZO_Server):
+                    buffer_staleness = server.staleness[-args.async_buffer_size :]
+                    writer.add_scalar(
+                        "Staleness/train", sum(buffer_staleness) / len(buffer_staleness), ite
+                    )
             # eval
-            if args.eval_iterations != 0 and (ite + 1) % args.eval_iterations == 0:
-                eval_loss, eval_accuracy = server.eval_model(test_loader)
-                if args.log_to_tensorboard:
-                    writer.add_scalar("Loss/test", eval_loss, ite)
-                    writer.add_scalar("Accuracy/test", eval_accuracy, ite)
+            eval_results = []
+            if args.eval_iterations != 0 and reaches_multiple(ite, next_ite, args.eval_iterations):
+                if evaluator is None:
+                    eval_results.append((ite, *server.eval_model(test_loader)))
+                else:
+                    evaluator.submit(ite, server.server_model)
+            if evaluator is not None:
+                eval_results += evaluator.poll()
+            log_eval_results(eval_results)
+            ite = next_ite
+        log_train_metrics(t)
+
+    if evaluator is not None:
+        log_eval_results(evaluator.close())
+
+    # only the epochs of clients trained in this process are seen
+    padding_waste = [
+        waste
+        for train_loader in train_loaders
+        if isinstance(train_loader.batch_sampler, LengthBucketBatchSampler)
+        for waste in train_loader.batch_sampler.padding_waste
+    ]
+    if padding_waste:
+        print(
+            f"Padding waste: {sum(padding_waste) / len(padding_waste) * 100:.2f}% of the tokens "
+            f"per client epoch, over {len(padding_waste)} epochs"
+        )
+
+    if isinstance(server, BufferedAsyncCeZO_Server):
+        server.wait_for_in_flight()
+    if server.client_executor is not None:
+        server.client_executor.shutdown()
+    if isinstance(server.seed_grad_records, PersistentSeedAndGradientRecords):
+        server.seed_grad_records.close()
@@ -9,7 +9,22 @@ DEFAULTS = {
     "mu": 1e-4,
     "compressor": "quant",
     "num_pert": 1,
+    "pert_batch_size": 1,
+    "regenerate_perturbation": False,
+    "flat_parameters": False,
+    "fused_central_sweep": False,
+    "perturbation_chunk_size": None,
+    "exact_train_metrics_interval": None,
+    "metrics_sync_interval": 10,
+    "fused_zo_sgd": False,
+    "verbalizer_scoring": False,
+    "cge_batch_size": 1,
+    "cge_max_block_memory_mb": None,
+    "cge_query_budget": None,
+    "cge_sampling": "uniform",
     "dataset": "mnist",
+    "token_cache_dir": "",
+    "length_bucket_batches": 1,
     "momentum": 0.9,
     "warmup_epochs": 5,
     "sparsity_file": None,
@@ -29,6 +44,22 @@ DEFAULTS = {
     "num_clients": 5,
     "num_sample_clients": 3,
     "local_update_steps": 1,
+    "client_executor": "serial",
+    "num_client_workers": 4,
+    "client_worker_threads": 1,
+    "server_address": "127.0.0.1:0",
+    "virtual_clients": False,
+    "snapshot_interval": None,
+    "history_window": None,
+    "snapshot_load_cost": 1.0,
+    "fused_replay": False,
+    "record_log_dir": None,
+    "async_buffer_size": None,
+    "staleness_exponent": 0.0,
+    "background_eval": False,
+    "client_sampling": "uniform",
+    "sampling_jitter": 0,
+    "max_staleness": None,
 }
 
 
@@ -42,6 +73,104 @@ def get_params():
     parser.add_argument("--num-clients", type=int, default=DEFAULTS["num_clients"])
     parser.add_argument("--num-sample-clients", type=int, default=DEFAULTS["num_sample_clients"])
     parser.add_argument("--local-update-steps", type=int, default=DEFAULTS["local_update_steps"])
+    parser.add_argument(
+        "--client-executor",
+        type=str,
+        choices=["serial", "thread", "process", "network", "batched"],
+        default=DEFAULTS["client_executor"],
+        help="How the sampled clients of a round are run",
+    )
+    parser.add_argument(
+        "--num-client-workers",
+        type=int,
+        default=DEFAULTS["num_client_workers"],
+        help="Threads/processes used by --client-executor thread/process/network",
+    )
+    parser.add_argument(
+        "--client-worker-threads",
+        type=int,
+        default=DEFAULTS["client_worker_threads"],
+        help="torch.set_num_threads of each --client-executor process/network worker",
+    )
+    parser.add_argument(
+        "--server-address",
+        type=str,
+        default=DEFAULTS["server_address"],
+        help='Address --client-executor network listens on, "host:port" or "unix:/path"',
+    )
+    parser.add_argument(
+        "--virtual-clients",
+        default=DEFAULTS["virtual_clients"],
+        action=argparse.BooleanOptionalAction,
+        help="Share one model between all clients, only works with --client-executor serial",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=int,
+        default=DEFAULTS["snapshot_interval"],
+        help="Snapshot the server model every this many iterations for stale clients to load",
+    )
+    parser.add_argument(
+        "--history-window",
+        type=int,
+        default=DEFAULTS["history_window"],
+        help="With --snapshot-interval, keep seed records of at most this many past iterations",
+    )
+    parser.add_argument(
+        "--snapshot-load-cost",
+        type=float,
+        default=DEFAULTS["snapshot_load_cost"],
+        help="Cost of loading a snapshot, in replayed iterations",
+    )
+    parser.add_argument(
+        "--fused-replay",
+        default=DEFAULTS["fused_replay"],
+        action=argparse.BooleanOptionalAction,
+        help="Clients replay all pulled SGD steps in one closed-form sweep per parameter",
+    )
+    parser.add_argument(
+        "--record-log-dir",
+        type=str,
+        default=DEFAULTS["record_log_dir"],
+        help="Keep the server seed records in an on-disk log here, resume from it if it exists",
+    )
+    parser.add_argument(
+        "--async-buffer-size",
+        type=int,
+        default=DEFAULTS["async_buffer_size"],
+        help="Train asynchronously, aggregating every this many client updates (FedBuff)",
+    )
+    parser.add_argument(
+        "--staleness-exponent",
+        type=float,
+        default=DEFAULTS["staleness_exponent"],
+        help="With --async-buffer-size, weight updates by (1 + staleness) ** -exponent",
+    )
+    parser.add_argument(
+        "--background-eval",
+        default=DEFAULTS["background_eval"],
+        action=argparse.BooleanOptionalAction,
+        help="Evaluate a copy of the model in a background thread while training goes on",
+    )
+    parser.add_argument(
+        "--client-sampling",
+        type=str,
+        choices=["uniform", "round-robin", "staleness"],
+        default=DEFAULTS["client_sampling"],
+        help="How the clients of a round are sampled, see cezo_fl/sampling.py",
+    )
+    parser.add_argument(
+        "--sampling-jitter",
+        type=int,
+        default=DEFAULTS["sampling_jitter"],
+        help="With --client-sampling round-robin, sample among this many extra queued clients",
+    )
+    parser.add_argument(
+        "--max-staleness",
+        type=int,
+        default=DEFAULTS["max_staleness"],
+        help="With --client-sampling staleness, always sample clients this many records behind",
+    )
     # rge_main
     parser.add_argument("--train-batch-size", type=int, default=DEFAULTS["train_batch_size"])
     parser.add_argument("--test-batch-size", type=int, default=DEFAULTS["test_batch_size"])
@@ -51,7 +180,103 @@ def get_params():
     parser.add_argument("--mu", type=float, default=DEFAULTS["mu"])
     parser.add_argument("--compressor", type=str, default=DEFAULTS["compressor"])
     parser.add_argument("--num-pert", type=int, default=DEFAULTS["num_pert"])
+    parser.add_argument(
+        "--pert-batch-size",
+        type=int,
+        default=DEFAULTS["pert_batch_size"],
+        help="Number of perturbations evaluated in one vectorized forward (RGE only)",
+    )
+    parser.add_argument(
+        "--regenerate-perturbation",
+        default=DEFAULTS["regenerate_perturbation"],
+        action=argparse.BooleanOptionalAction,
+        help="Regenerate perturbations per parameter from seeds instead of storing them (RGE only)",
+    )
+    parser.add_argument(
+        "--flat-parameters",
+        default=DEFAULTS["flat_parameters"],
+        action=argparse.BooleanOptionalAction,
+        help="Store model parameters as views of one contiguous buffer",
+    )
+    parser.add_argument(
+        "--fused-central-sweep",
+        default=DEFAULTS["fused_central_sweep"],
+        action=argparse.BooleanOptionalAction,
+        help="Fuse the restore of a perturbation with the next one in RGE central",
+    )
+    parser.add_argument(
+        "--perturbation-chunk-size",
+        type=int,
+        default=DEFAULTS["perturbation_chunk_size"],
+        help="Generate full-dimension perturbations in independently seeded chunks (RGE only)",
+    )
+    parser.add_argument(
+        "--exact-train-metrics-interval",
+        type=int,
+        default=DEFAULTS["exact_train_metrics_interval"],
+        help="Every this many steps, train metrics come from a forward of the updated model "
+        "instead of the forwards of the gradient estimate",
+    )
+    parser.add_argument(
+        "--metrics-sync-interval",
+        type=int,
+        default=DEFAULTS["metrics_sync_interval"],
+        help="Train metrics are brought to the host (progress bar, tensorboard) every this many "
+        "steps, in between training does not wait for the device",
+    )
+    parser.add_argument(
+        "--fused-zo-sgd",
+        default=DEFAULTS["fused_zo_sgd"],
+        action=argparse.BooleanOptionalAction,
+        help="Apply SGD updates directly from perturbation seeds, needs --regenerate-perturbation",
+    )
+    parser.add_argument(
+        "--verbalizer-scoring",
+        default=DEFAULTS["verbalizer_scoring"],
+        action=argparse.BooleanOptionalAction,
+        help="LM datasets: forwards only compute the last position's logits of the verbalizer "
+        "tokens instead of the full vocabulary logits of every position",
+    )
+    parser.add_argument(
+        "--cge-batch-size",
+        type=int,
+        default=DEFAULTS["cge_batch_size"],
+        help="Max number of coordinates CGE estimates in one vmap-ed forward",
+    )
+    parser.add_argument(
+        "--cge-max-block-memory-mb",
+        type=float,
+        default=DEFAULTS["cge_max_block_memory_mb"],
+        help="Cap CGE blocks so the parameter copies of one block fit in this many MB",
+    )
+    parser.add_argument(
+        "--cge-query-budget",
+        type=int,
+        default=DEFAULTS["cge_query_budget"],
+        help="Estimate only this many sampled coordinates per CGE step (forwards per step)",
+    )
+    parser.add_argument(
+        "--cge-sampling",
+        type=str,
+        choices=["uniform", "importance"],
+        default=DEFAULTS["cge_sampling"],
+        help="How --cge-query-budget samples coordinates",
+    )
     parser.add_argument("--dataset", type=str, default=DEFAULTS["dataset"])
+    parser.add_argument(
+        "--token-cache-dir",
+        type=str,
+        default=DEFAULTS["token_cache_dir"],
+        help="Directory of the memory-mapped token ids of LM datasets (e.g. ./data/token_cache), "
+        "empty (default) to tokenize on every access",
+    )
+    parser.add_argument(
+        "--length-bucket-batches",
+        type=int,
+        default=DEFAULTS["length_bucket_batches"],
+        help="Cached LM datasets batch sequences of similar lengths, sorted within buckets of "
+        "this many batches (1: plain shuffled batches)",
+    )
     parser.add_argument("--momentum", type=float, default=DEFAULTS["momentum"])
     parser.add_argument("--warmup-epochs", type=int, default=DEFAULTS["warmup_epochs"])
 
@@ -144,7 +369,22 @@ class FakeArgs:
     mu = 1e-4
     compressor = "quant"
     num_pert = 1
+    pert_batch_size = 1
+    regenerate_perturbation = False
+    flat_parameters = False
+    fused_central_sweep = False
+    perturbation_chunk_size = None
+    exact_train_metrics_interval = None
+    metrics_sync_interval = 10
+    fused_zo_sgd = False
+    verbalizer_scoring = False
+    cge_batch_size = 1
+    cge_max_block_memory_mb = None
+    cge_query_budget = None
+    cge_sampling = "uniform"
     dataset = "mnist"
+    token_cache_dir = ""
+    length_bucket_batches = 1
     momentum = 0.9
     warmup_epochs = 5
     sparsity_file = None
@@ -163,3 +403,19 @@ class FakeArgs:
     num_clients = 5
     num_sample_clients = 3
     local_update_steps = 1
+    client_executor = "serial"
+    num_client_workers = 4
+    client_worker_threads = 1
+    server_address = "127.0.0.1:0"
+    virtual_clients = False
+    snapshot_interval = None
+    history_window = None
+    snapshot_load_cost = 1.0
+    fused_replay = False
+    record_log_dir = None
+    async_buffer_size = None
+    staleness_exponent = 0.0
+    background_eval = False
+    client_sampling = "uniform"
+    sampling_jitter = 0
+    max_staleness = None
@@ -1,6 +1,13 @@
+import bisect
 import torch
+from torch.func import functional_call, vmap
 from torch.nn import Parameter
-from typing import Iterator
+from typing import Iterator, Literal, TypeAlias
+
+from gradient_estimators.parameter_arena import FlatParameterArena
+
+
+CoordinateSampling: TypeAlias = Literal["uniform", "importance"]
 
 
 def get_parameter_indices_for_ith_elem(i, cumsum_dimension):
@@ -25,12 +32,24 @@ class CoordinateGradientEstimator:
         mu=1e-3,
         device: str | None = None,
         prune_mask_arr: torch.Tensor | None = None,
+        flat_parameters: bool = False,
+        coordinate_batch_size: int = 1,
+        max_block_memory: int | None = None,
+        query_budget: int | None = None,
+        coordinate_sampling: CoordinateSampling = "uniform",
+        importance_decay: float = 0.9,
+        importance_floor: float = 0.1,
     ):
         self.device = device
         self.model = model
         if parameters is None:
             parameters = model.parameters()
         self.parameters_list: list[Parameter] = list(parameters)
+        # Opt-in: with parameters as views of one flat buffer, the i-th coordinate is simply
+        # parameter_arena.data[i] and no index lookup is needed.
+        self.parameter_arena: FlatParameterArena | None = None
+        if flat_parameters:
+            self.parameter_arena = FlatParameterArena(self.parameters_list)
 
         self.flatten_parameters_list = [p.flatten() for p in self.parameters_list]
         self.parameter_dimension = torch.tensor(
@@ -38,8 +57,45 @@ class CoordinateGradientEstimator:
         )
         self.cumsum_dimension = torch.cumsum(self.parameter_dimension, dim=0)
         self.total_dimensions = torch.sum(self.parameter_dimension).item()
+        # Per-parameter [start, end) ranges of the flattened coordinates as python ints, so finding
+        # the parameter of a coordinate is a bisect instead of a tensor reduction + host sync.
+        self.parameter_offsets: list[int] = []
+        self.parameter_ends: list[int] = []
+        offset = 0
+        for p in self.parameters_list:
+            self.parameter_offsets.append(offset)
+            offset += p.numel()
+            self.parameter_ends.append(offset)
+
+        # coordinate_batch_size > 1 estimates up to that many coordinates of one parameter in one
+        # vmap-ed forward. Each coordinate needs its own copy of the parameter it belongs to, so
+        # max_block_memory (bytes) further caps the block size of large parameters.
+        self.coordinate_batch_size = coordinate_batch_size
+        self.max_block_memory = max_block_memory
+        self.parameter_names: list[str] | None = None
+        if coordinate_batch_size > 1:
+            parameter_to_name = {p: name for name, p in self.model.named_parameters()}
+            self.parameter_names = [parameter_to_name[p] for p in self.parameters_list]
+
+        # query_budget (forwards per step, base loss excluded) turns on randomized block-coordinate
+        # estimation: only that many coordinates are estimated and the rest of the gradient is 0.
+        # "importance" sampling draws coordinates proportionally to their running gradient
+        # magnitude mixed with importance_floor of uniform, so every coordinate keeps being visited.
+        self.query_budget = query_budget
+        self.coordinate_sampling: CoordinateSampling = coordinate_sampling
+        self.importance_decay = importance_decay
+        self.importance_floor = importance_floor
+        self.coordinate_importance: torch.Tensor | None = None
+        if query_budget is not None and coordinate_sampling == "importance":
+            # bf16 is plenty for sampling weights and halves the size of the per-coordinate state
+            self.coordinate_importance = torch.ones(
+                self.total_dimensions, dtype=torch.bfloat16, device=self.device
+            )
 
         self.mu = mu
+        # Loss and output of the unperturbed forward of the last compute_grad, for train metrics.
+        self.last_loss: torch.Tensor | None = None
+        self.last_pred: torch.Tensor | None = None
 
         self.prune_mask_arr = None
         self.prune_mask_indices = None
@@ -50,11 +106,28 @@ class CoordinateGradientEstimator:
         self.prune_mask_arr = prune_mask_arr
         self.prune_mask_indices = torch.argwhere(prune_mask_arr).view(-1)
 
+    def get_parameter_index(self, i: int) -> int:
+        """Index in parameters_list of the parameter the i-th flattened coordinate belongs to."""
+        if i < 0 or i >= self.total_dimensions:
+            raise Exception(f"Index {i} out of range from {self.total_dimensions} dimensions")
+        return bisect.bisect_right(self.parameter_ends, i)
+
+    def get_block_size(self, parameter_index: int) -> int:
+        """Number of coordinates of one parameter estimated per vmap-ed forward."""
+        block_size = self.coordinate_batch_size
+        if self.max_block_memory is not None:
+            p = self.parameters_list[parameter_index]
+            bytes_per_coordinate = p.numel() * p.element_size()
+            block_size = min(block_size, max(1, self.max_block_memory // bytes_per_coordinate))
+        return block_size
+
     def estimate_ith_parameter_grad(self, i, loss_fn, base_loss):
-        index_of_parameter_in_parameters_list, index_within_parameter = (
-            get_parameter_indices_for_ith_elem(i, self.cumsum_dimension)
-        )
-        flatten_parameter = self.flatten_parameters_list[index_of_parameter_in_parameters_list]
+        if self.parameter_arena is not None:
+            flatten_parameter, index_within_parameter = self.parameter_arena.data, i
+        else:
+            parameter_index = self.get_parameter_index(i)
+            index_within_parameter = i - self.parameter_offsets[parameter_index]
+            flatten_parameter = self.flatten_parameters_list[parameter_index]
         # clone to be safe, might not need
         orig_value = flatten_parameter[index_within_parameter].clone()
 
@@ -67,6 +140,10 @@ class CoordinateGradientEstimator:
         return grad_i
 
     def put_grad(self, grad: torch.Tensor) -> None:
+        if self.parameter_arena is not None:
+            self.parameter_arena.put_grad(grad)
+            return
+
         start = 0
         for p in self.parameters_list:
             p.grad = grad[start : (start + p.numel())].view(p.shape)
@@ -80,16 +157,129 @@ class CoordinateGradientEstimator:
 
         return estimate_indices
 
+    def _get_estimate_indices_tensor(self) -> torch.Tensor:
+        if self.prune_mask_indices is None:
+            return torch.arange(self.total_dimensions, device=self.device)
+        return self.prune_mask_indices.to(self.device)
+
+    def sample_estimate_indices(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Sample at most query_budget distinct coordinates out of get_estimate_indices().
+
+        Returns the sorted sampled coordinates and the factor each estimated partial derivative is
+        scaled by, so that the sparse gradient is an unbiased estimate of the full CGE gradient.
+        """
+        candidates = self._get_estimate_indices_tensor()
+        num_candidates = candidates.shape[0]
+        if self.coordinate_sampling == "uniform":
+            # without replacement: P(i is sampled) = budget / num_candidates
+            positions = torch.randperm(num_candidates, device=self.device)[: self.query_budget]
+            scales = torch.full(
+                (positions.shape[0],), num_candidates / self.query_budget, device=self.device
+            )
+        else:
+            importance = self.coordinate_importance[candidates].float()
+            probs = (1 - self.importance_floor) * importance / importance.sum()
+            probs += self.importance_floor / num_candidates
+            # with replacement: E[count_i] = budget * probs_i, duplicates are estimated once
+            draws = torch.multinomial(probs, self.query_budget, replacement=True)
+            positions, counts = torch.unique(draws, return_counts=True)
+            scales = counts / (self.query_budget * probs[positions])
+        order = torch.argsort(positions)
+        return candidates[positions[order]], scales[order]
+
+    def update_coordinate_importance(
+        self, indices: torch.Tensor, coordinate_grads: torch.Tensor
+    ) -> None:
+        """Running (EMA) gradient magnitude of the coordinates estimated in this step."""
+        importance = self.coordinate_importance[indices].float()
+        importance.mul_(self.importance_decay).add_(
+            coordinate_grads.abs(), alpha=1 - self.importance_decay
+        )
+        self.coordinate_importance[indices] = importance.to(self.coordinate_importance.dtype)
+
     def compute_grad(self, batch_inputs, labels, criterion) -> None:
         grad = torch.zeros(self.total_dimensions, device=self.device)
 
         def loss_fn():
             return criterion(self.model(batch_inputs), labels)
 
-        base_loss = loss_fn()
+        base_pred = self.model(batch_inputs)
+        base_loss = criterion(base_pred, labels)
+        self.last_loss, self.last_pred = base_loss, base_pred
+
+        sample_coordinates = self.query_budget is not None and self.query_budget < len(
+            self.get_estimate_indices()
+        )
+        if sample_coordinates:
+            estimate_indices, scales = self.sample_estimate_indices()
+        else:
+            estimate_indices = self._get_estimate_indices_tensor()
+
+        if self.coordinate_batch_size > 1:
+            coordinate_grads = self._batched_estimate_coordinate_grads(
+                estimate_indices, batch_inputs, labels, criterion, base_loss
+            )
+        else:
+            coordinate_grads = torch.zeros(estimate_indices.shape[0], device=self.device)
+            for k, i in enumerate(estimate_indices.tolist()):
+                coordinate_grads[k] = self.estimate_ith_parameter_grad(i, loss_fn, base_loss)
 
-        estimate_indices = self.get_estimate_indices()
-        for i in estimate_indices:
-            grad[i] = self.estimate_ith_parameter_grad(i, loss_fn, base_loss)
+        if sample_coordinates:
+            if self.coordinate_sampling == "importance":
+                self.update_coordinate_importance(estimate_indices, coordinate_grads)
+            coordinate_grads.mul_(scales)
+        grad[estimate_indices] = coordinate_grads
 
         self.put_grad(grad)
+
+    def _split_indices_by_parameter(
+        self, indices: torch.Tensor
+    ) -> Iterator[tuple[int, torch.Tensor, slice]]:
+        """
+        For sorted flattened indices, yield (parameter index, indices relative to the start of the
+        parameter, slice of `indices` they come from) for every parameter containing any of them.
+        """
+        bounds = torch.searchsorted(
+            indices, torch.tensor(self.parameter_ends, device=indices.device)
+        ).tolist()
+        lo = 0
+        for parameter_index, hi in enumerate(bounds):
+            if hi > lo:
+                local_indices = indices[lo:hi] - self.parameter_offsets[parameter_index]
+                yield parameter_index, local_indices, slice(lo, hi)
+            lo = hi
+
+    def _batched_estimate_coordinate_grads(
+        self, indices: torch.Tensor, batch_inputs, labels, criterion, base_loss
+    ) -> torch.Tensor:
+        """
+        Estimate the partial derivatives of the sorted flattened `indices` in blocks. Every
+        coordinate of a block gets its own variant of the parameter with mu added at that
+        coordinate, and all variants run in one vmap-ed forward.
+
+        NOTE: Modules updating buffers in place (e.g. BatchNorm in train mode) and random modules
+        (e.g. dropout in train mode) can not run under vmap.
+        """
+        coordinate_grads = torch.zeros(indices.shape[0], device=self.device)
+        for parameter_index, local_indices, out_slice in self._split_indices_by_parameter(indices):
+            name = self.parameter_names[parameter_index]
+            p = self.parameters_list[parameter_index]
+
+            def loss_fn(variant):
+                # parameters missing from the dict are taken from the model itself
+                pred = functional_call(self.model, {name: variant}, (batch_inputs,))
+                return criterion(pred, labels)
+
+            block_size = self.get_block_size(parameter_index)
+            block_start = out_slice.start
+            for block in local_indices.split(block_size):
+                num_variants = block.shape[0]
+                variants = p.detach().reshape(1, -1).repeat(num_variants, 1)
+                rows = torch.arange(num_variants, device=variants.device)
+                variants[rows, block] += self.mu
+                losses = vmap(loss_fn)(variants.view(num_variants, *p.shape))
+                block_end = block_start + num_variants
+                coordinate_grads[block_start:block_end] = (losses - base_loss) / self.mu
+                block_start = block_end
+        return coordinate_grads
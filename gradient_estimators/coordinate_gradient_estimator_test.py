@@ -7,6 +7,7 @@ from gradient_estimators.coordinate_gradient_estimator import (
     get_parameter_indices_for_ith_elem,
     CoordinateGradientEstimator as CGE,
 )
+from gradient_estimators.random_gradient_estimator_test import SmallCNN
 
 
 class LinearReg(nn.Module):
@@ -53,7 +54,8 @@ def test_get_estimate_indices():
     assert (cge.get_estimate_indices() == torch.tensor([0, 1], dtype=int)).all()
 
 
-def test_simple_model_training():
+@pytest.mark.parametrize("flat_parameters", [False, True])
+def test_simple_model_training(flat_parameters):
     torch.manual_seed(1)
     model = LinearReg()
 
@@ -63,7 +65,7 @@ def test_simple_model_training():
     true_intercept = 1
     ys = xs * true_slope + true_intercept
 
-    cge = CGE(model)
+    cge = CGE(model, flat_parameters=flat_parameters)
     sgd = SGD(model.parameters(), momentum=0.8)
     criterion = nn.MSELoss()
 
@@ -85,3 +87,70 @@ def test_simple_model_training():
         abs(estimated_slope - true_slope) < 0.01
         and abs(estimated_intercept - true_intercept) < 0.01
     )
+
+
+def test_get_parameter_index():
+    model = LinearReg()
+    cge = CGE(model)
+
+    assert cge.parameter_offsets == [0, 1]
+    assert cge.get_parameter_index(0) == 0
+    assert cge.get_parameter_index(1) == 1
+    with pytest.raises(Exception):
+        cge.get_parameter_index(2)
+
+
+@pytest.mark.parametrize("coordinate_batch_size", [4, 64])
+@pytest.mark.parametrize("use_prune_mask", [False, True])
+def test_batched_grad_matches_sequential(coordinate_batch_size, use_prune_mask):
+    torch.manual_seed(0)
+    model = SmallCNN()
+    batch_inputs, labels = torch.randn(2, 1, 8, 8), torch.tensor([0, 1])
+    prune_mask = torch.rand(sum(p.numel() for p in model.parameters())) < 0.3
+    grads = []
+    for batch_size in [1, coordinate_batch_size]:
+        cge = CGE(model, mu=1e-2, coordinate_batch_size=batch_size)
+        if use_prune_mask:
+            cge.set_prune_mask(prune_mask)
+        with torch.no_grad():
+            cge.compute_grad(batch_inputs, labels, nn.CrossEntropyLoss())
+        grads.append([p.grad.clone() for p in model.parameters()])
+
+    for grad, batched_grad in zip(*grads):
+        torch.testing.assert_close(batched_grad, grad, rtol=1e-3, atol=1e-3)
+
+
+def test_block_size_is_capped_by_memory():
+    model = SmallCNN()
+    # conv weight 36, conv bias 4, linear weight 432, linear bias 3 fp32 elements
+    cge = CGE(model, coordinate_batch_size=64, max_block_memory=432 * 4 * 10)
+    assert [cge.get_block_size(i) for i in range(4)] == [64, 64, 10, 64]
+
+
+@pytest.mark.parametrize("coordinate_sampling", ["uniform", "importance"])
+@pytest.mark.parametrize("coordinate_batch_size", [1, 4])
+def test_sampled_grad_is_unbiased(coordinate_sampling, coordinate_batch_size):
+    torch.manual_seed(0)
+    model = nn.Linear(4, 2)
+    batch_inputs, labels = torch.randn(3, 4), torch.randn(3, 2)
+    criterion = nn.MSELoss()
+
+    with torch.no_grad():
+        CGE(model).compute_grad(batch_inputs, labels, criterion)
+        full_grad = torch.cat([p.grad.flatten() for p in model.parameters()])
+
+        cge = CGE(
+            model,
+            query_budget=3,
+            coordinate_sampling=coordinate_sampling,
+            coordinate_batch_size=coordinate_batch_size,
+        )
+        num_steps = 3000
+        mean_grad = torch.zeros_like(full_grad)
+        for _ in range(num_steps):
+            cge.compute_grad(batch_inputs, labels, criterion)
+            sampled_grad = torch.cat([p.grad.flatten() for p in model.parameters()])
+            assert (sampled_grad != 0).sum() <= 3
+            mean_grad += sampled_grad / num_steps
+
+    torch.testing.assert_close(mean_grad, full_grad, rtol=0, atol=0.1 * full_grad.abs().max())
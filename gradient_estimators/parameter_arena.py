@@ -0,0 +1,56 @@
+import torch
+from torch.nn import Parameter
+
+
+class FlatParameterArena:
+    """
+    Re-home parameters as views into one contiguous 1d buffer.
+
+    The order of the buffer is the order of parameters_list, i.e. the same layout the gradient
+    estimators use for their flattened perturbation and gradient vectors. So perturbing, restoring,
+    snapshotting and gradient installation become a single op on the whole buffer instead of a
+    Python loop over parameters.
+
+    NOTE: Create the arena after the model is moved to its device. `model.to(...)` and anything
+    else assigning a new `.data` to the parameters will detach them from the arena again.
+    `load_state_dict` copies in place, so it is safe.
+    """
+
+    def __init__(self, parameters_list: list[Parameter]):
+        if len(parameters_list) == 0:
+            raise ValueError("Can not build an arena from an empty parameter list")
+        dtype, device = parameters_list[0].dtype, parameters_list[0].device
+        for p in parameters_list:
+            if p.dtype != dtype or p.device != device:
+                raise ValueError("All parameters of an arena must share the same dtype and device")
+
+        self.parameters_list = parameters_list
+        with torch.no_grad():
+            self.data = torch.cat([p.detach().reshape(-1) for p in parameters_list])
+        self.grad = torch.zeros_like(self.data)
+
+        self.grad_views: list[torch.Tensor] = []
+        start = 0
+        for p in parameters_list:
+            p.data = self.data[start : (start + p.numel())].view(p.shape)
+            self.grad_views.append(self.grad[start : (start + p.numel())].view(p.shape))
+            start += p.numel()
+
+    def add_(self, perturb: torch.Tensor, alpha: float | int = 1) -> None:
+        self.data.add_(perturb, alpha=alpha)
+
+    def mul_(self, alpha: float | int) -> None:
+        self.data.mul_(alpha)
+
+    def snapshot(self) -> torch.Tensor:
+        return self.data.clone()
+
+    def restore(self, snapshot: torch.Tensor) -> None:
+        self.data.copy_(snapshot)
+
+    def put_grad(self, grad: torch.Tensor) -> None:
+        self.grad.copy_(grad)
+        for p, grad_view in zip(self.parameters_list, self.grad_views):
+            # optimizer.zero_grad() sets grad to None by default, only re-attach in that case.
+            if p.grad is not grad_view:
+                p.grad = grad_view
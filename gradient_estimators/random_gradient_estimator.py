@@ -1,12 +1,51 @@
 import torch
+from torch.func import functional_call, vmap
 from torch.nn import Parameter
-from typing import Callable, Iterator, TypeAlias, Literal
+from typing import Callable, Iterator, Sequence, TypeAlias, Literal
 import transformers
 from shared.language_utils import LLMBatchInput
+from gradient_estimators.parameter_arena import FlatParameterArena
 
 
 GradEstimateMethod: TypeAlias = Literal["forward", "central"]
 
+_UINT64_MASK = (1 << 64) - 1
+
+
+def derive_seed(seed: int, index: int) -> int:
+    """
+    Derive the seed of the index-th independent stream of `seed` (splitmix64 mixing).
+    Used to regenerate any slice of a seeded perturbation without generating the ones before it.
+    """
+    z = (seed * 0x9E3779B97F4A7C15 + (index + 1) * 0xBF58476D1CE4E5B9) & _UINT64_MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _UINT64_MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _UINT64_MASK
+    z = z ^ (z >> 31)
+    # torch.Generator.manual_seed accepts at most 64 bits, keep it positive to be safe.
+    return z >> 1
+
+
+# Elements per block in fused sweeps. 3 fp32 blocks (target and two perturbations) stay well inside
+# a typical L2 cache, so the second add of a block does not go back to memory.
+FUSED_SWEEP_BLOCK_SIZE = 1 << 15
+
+
+def fused_add_pair_(
+    target: torch.Tensor, a: torch.Tensor, b: torch.Tensor, alpha: float | int = 1
+) -> None:
+    """
+    In place `target.add_(a, alpha=alpha).add_(b, alpha=alpha)` in a single pass over target.
+    Every element goes through the same two adds in the same order as the unfused version.
+    """
+    target, a, b = target.view(-1), a.reshape(-1), b.reshape(-1)
+    if target.is_cuda:
+        # GPU kernels do not benefit from cache blocking, avoid the launch overhead instead.
+        target.add_(a, alpha=alpha).add_(b, alpha=alpha)
+        return
+    for start in range(0, target.numel(), FUSED_SWEEP_BLOCK_SIZE):
+        end = start + FUSED_SWEEP_BLOCK_SIZE
+        target[start:end].add_(a[start:end], alpha=alpha).add_(b[start:end], alpha=alpha)
+
 
 class RandomGradientEstimator:
 
@@ -20,30 +59,117 @@ class RandomGradientEstimator:
         normalize_perturbation: bool = False,
         device: str | None = None,
         prune_mask_arr: torch.Tensor | None = None,
+        pert_batch_size: int = 1,
+        regenerate_perturbation: bool = False,
+        flat_parameters: bool = False,
+        fused_central_sweep: bool = False,
+        perturbation_chunk_size: int | None = None,
+        verbalizer_id_list: list[int] | None = None,
     ):
         self.model = model
         if parameters is None:
             parameters = model.parameters()
         self.parameters_list: list[Parameter] = list(parameters)
+        # Opt-in: parameters become views of one contiguous buffer, so full-dimension perturbations
+        # and gradients are applied with a single op.
+        self.parameter_arena: FlatParameterArena | None = None
+        if flat_parameters:
+            self.parameter_arena = FlatParameterArena(self.parameters_list)
         self.total_dimensions = sum([p.numel() for p in self.parameters_list])
+        self.parameter_offsets: list[int] = []
+        offset = 0
+        for p in self.parameters_list:
+            self.parameter_offsets.append(offset)
+            offset += p.numel()
 
         self.mu = mu
         self.num_pert = num_pert
         self.normalize_perturbation = normalize_perturbation
 
+        # OPT scoring mode for last-token losses: model_forward runs the decoder and projects only
+        # the last hidden state onto the LM head rows of these token ids, returning logits of
+        # shape [batch, len(verbalizer_id_list)] instead of [batch, seq, vocab].
+        self.verbalizer_id_list = verbalizer_id_list
+        if verbalizer_id_list is not None:
+            if not isinstance(model, transformers.models.opt.modeling_opt.OPTForCausalLM):
+                raise ValueError("verbalizer_id_list is only supported for OPTForCausalLM")
+            parameter_to_name = {p: name for name, p in model.named_parameters()}
+            # the tied embedding in OPT, named model.decoder.embed_tokens.weight
+            self.lm_head_weight_name = parameter_to_name[model.get_output_embeddings().weight]
+
+        # pert_batch_size > 1 evaluates that many perturbations in one vmap-ed forward.
+        # Memory grows linearly with it (stacked parameters + activations), so it is the chunk size
+        # used to cap memory when num_pert is large.
+        self.pert_batch_size = pert_batch_size
+        self.parameter_names: list[str] | None = None
+        if pert_batch_size > 1:
+            self.parameter_names = self._get_parameter_names()
+
+        # MeZO-style memory mode. Each perturbation is represented by a seed, and the slice of it
+        # belonging to one parameter is regenerated whenever it is needed. A full-dimension
+        # perturbation or gradient vector is never allocated.
+        self.regenerate_perturbation = regenerate_perturbation
+        if regenerate_perturbation and pert_batch_size > 1:
+            raise ValueError("regenerate_perturbation does not support pert_batch_size > 1")
+
         self.grad_estimate_method: GradEstimateMethod = grad_estimate_method
         self.method_func_dict: dict[GradEstimateMethod, Callable] = {
-            "central": self._forward_method,
-            "forward": self._central_method,
+            "central": self._central_method,
+            "forward": self._forward_method,
         }
+        self.batched_method_func_dict: dict[GradEstimateMethod, Callable] = {
+            "central": self._batched_central_method,
+            "forward": self._batched_forward_method,
+        }
+        self.seeded_method_func_dict: dict[GradEstimateMethod, Callable] = {
+            "central": self._seeded_central_method,
+            "forward": self._seeded_forward_method,
+        }
+        # Fold the restore of perturbation k into the +mu of perturbation k+1, 3 parameter sweeps
+        # per perturbation instead of 4. Each parameter sees the same adds as the unfused schedule.
+        self.fused_central_sweep = fused_central_sweep
+        if fused_central_sweep:
+            self.method_func_dict["central"] = self._fused_central_method
+            self.seeded_method_func_dict["central"] = self._seeded_fused_central_method
+
+        # Loss and model output the train metrics of the last estimate can be computed from, without
+        # a forward of their own: the unperturbed forward in forward mode and, in central mode, the
+        # mean loss of all +mu and -mu forwards and the output of the last one (mu away from the
+        # model, which does not matter for metrics).
+        self.last_loss: torch.Tensor | None = None
+        self.last_pred = None
+        self._metric_losses: list[torch.Tensor] = []
 
         self.device = device
+        # Reseeded for every slice of a seeded (or chunk of a counter-based) perturbation.
+        self.generator = torch.Generator(device=device if device is not None else "cpu")
+        # The estimator draws perturbations and perturbation seeds from its own streams, never from
+        # the global RNG, so estimators can run concurrently. manual_seed(seed) sets the state a
+        # local update of `seed` starts from, which is what replaying it relies on.
+        self.perturbation_generator = torch.Generator(
+            device=device if device is not None else "cpu"
+        )
+        self.seed_generator = torch.Generator()
+        # Counter-based full-dimension perturbations: chunk c of a perturbation is generated from
+        # derive_seed(its seed, c), so chunks can be generated in any order, e.g. in parallel.
+        # Seeded perturbations (regenerate_perturbation) already are counter-based per parameter.
+        self.perturbation_chunk_size = perturbation_chunk_size
+        # Start from the global random state, so the usual torch.manual_seed(args.seed) still
+        # decides the perturbations of a run that never calls manual_seed.
+        self.manual_seed(int(torch.randint(0, 2**62, ()).item()))
         self.prune_mask_arr = None
         if prune_mask_arr:
             self.set_prune_mask(prune_mask_arr)
 
     def model_forward(self, batch_inputs: torch.Tensor | LLMBatchInput):
         if isinstance(self.model, transformers.models.opt.modeling_opt.OPTForCausalLM):
+            if self.verbalizer_id_list is not None:
+                hidden_states = self.model.model.decoder(
+                    input_ids=batch_inputs.input_ids, attention_mask=batch_inputs.attention_mask
+                ).last_hidden_state
+                return self._verbalizer_logits(
+                    hidden_states, self.model.get_output_embeddings().weight
+                )
             return self.model(
                 input_ids=batch_inputs.input_ids, attention_mask=batch_inputs.attention_mask
             )
@@ -52,11 +178,97 @@ class RandomGradientEstimator:
         else:
             raise Exception("This model type is not supported")
 
+    def functional_model_forward(
+        self, params: dict[str, torch.Tensor], batch_inputs: torch.Tensor | LLMBatchInput
+    ):
+        """Same as model_forward, but the parameters in `params` replace the model's own ones."""
+        if isinstance(self.model, transformers.models.opt.modeling_opt.OPTForCausalLM):
+            if self.verbalizer_id_list is not None:
+                decoder_params = {
+                    name.removeprefix("model.decoder."): p
+                    for name, p in params.items()
+                    if name.startswith("model.decoder.")
+                }
+                hidden_states = functional_call(
+                    self.model.model.decoder,
+                    decoder_params,
+                    args=(),
+                    kwargs={
+                        "input_ids": batch_inputs.input_ids,
+                        "attention_mask": batch_inputs.attention_mask,
+                    },
+                ).last_hidden_state
+                lm_head_weight = params.get(
+                    self.lm_head_weight_name, self.model.get_output_embeddings().weight
+                )
+                return self._verbalizer_logits(hidden_states, lm_head_weight)
+            return functional_call(
+                self.model,
+                params,
+                args=(),
+                kwargs={
+                    "input_ids": batch_inputs.input_ids,
+                    "attention_mask": batch_inputs.attention_mask,
+                },
+            )
+        elif isinstance(self.model, torch.nn.Module):
+            return functional_call(self.model, params, (batch_inputs,))
+        else:
+            raise Exception("This model type is not supported")
+
+    def _verbalizer_logits(
+        self, hidden_states: torch.Tensor, lm_head_weight: torch.Tensor
+    ) -> torch.Tensor:
+        """logits[:, -1, verbalizer_id_list] of the full LM head (inputs are left padded)."""
+        return hidden_states[:, -1] @ lm_head_weight[self.verbalizer_id_list].T
+
+    def _get_parameter_names(self) -> list[str]:
+        parameter_to_name = {p: name for name, p in self.model.named_parameters()}
+        return [parameter_to_name[p] for p in self.parameters_list]
+
     def set_prune_mask(self, prune_mask_arr) -> None:
         self.prune_mask_arr = prune_mask_arr
 
+    def manual_seed(self, seed: int | torch.Tensor) -> None:
+        """Seed the estimator's random streams, the estimator's own torch.manual_seed."""
+        # replayed seeds are 0-d int64 tensors of the seed records, Generators only take ints
+        seed = int(seed)
+        self.perturbation_generator.manual_seed(seed)
+        self.seed_generator.manual_seed(seed)
+
+    def generate_perturbation_chunk(
+        self,
+        pert_seed: int,
+        chunk_index: int,
+        out: torch.Tensor | None = None,
+        generator: torch.Generator | None = None,
+    ) -> torch.Tensor:
+        """
+        Chunk chunk_index of the counter-based perturbation pert_seed, unmasked and unnormalized.
+        Parallel callers pass a generator each, the estimator's own one is reseeded otherwise.
+        """
+        start = chunk_index * self.perturbation_chunk_size
+        size = min(self.perturbation_chunk_size, self.total_dimensions - start)
+        if generator is None:
+            generator = self.generator
+        generator.manual_seed(derive_seed(pert_seed, chunk_index))
+        if out is None:
+            out = torch.empty(size, device=self.device)
+        return out.normal_(generator=generator)
+
     def generate_perturbation_norm(self) -> torch.Tensor:
-        p = torch.randn(self.total_dimensions, device=self.device)
+        if self.perturbation_chunk_size is None:
+            p = torch.randn(
+                self.total_dimensions, device=self.device, generator=self.perturbation_generator
+            )
+        else:
+            pert_seed = self.generate_perturbation_seeds(1)[0]
+            p = torch.empty(self.total_dimensions, device=self.device)
+            for chunk_index, start in enumerate(
+                range(0, self.total_dimensions, self.perturbation_chunk_size)
+            ):
+                chunk = p[start : (start + self.perturbation_chunk_size)]
+                self.generate_perturbation_chunk(pert_seed, chunk_index, out=chunk)
         if self.prune_mask_arr is not None:
             p.mul_(self.prune_mask_arr)
 
@@ -65,7 +277,120 @@ class RandomGradientEstimator:
 
         return p
 
-    def perturb_model(self, perturb: torch.Tensor | None = None, alpha: float | int = 1) -> None:
+    def generate_perturbation_seeds(self, num_pert: int) -> list[int]:
+        # Drawn from the estimator's seed stream, so manual_seed before the call (as local update
+        # and replay do) reproduces the same perturbations.
+        return torch.randint(0, 2**62, (num_pert,), generator=self.seed_generator).tolist()
+
+    def get_perturbation_seeds(self, seed: int, num_pert: int) -> list[int]:
+        """Perturbation seeds compute_grad draws after the caller runs manual_seed(seed)."""
+        self.manual_seed(seed)
+        return self.generate_perturbation_seeds(num_pert)
+
+    def _seeded_parameter_perturbation(self, pert_seed: int, index: int) -> torch.Tensor:
+        """Regenerate the (unnormalized) slice of perturbation `pert_seed` for parameter `index`."""
+        p = self.parameters_list[index]
+        self.generator.manual_seed(derive_seed(pert_seed, index))
+        perturb = torch.randn(p.shape, generator=self.generator, device=self.device)
+        if self.prune_mask_arr is not None:
+            start = self.parameter_offsets[index]
+            perturb.mul_(self.prune_mask_arr[start : (start + p.numel())].view(p.shape))
+        return perturb
+
+    def _seeded_perturbation_norm(self, pert_seed: int) -> torch.Tensor | None:
+        if not self.normalize_perturbation:
+            return None
+        norm_square = 0
+        for i in range(len(self.parameters_list)):
+            norm_square += self._seeded_parameter_perturbation(pert_seed, i).square().sum()
+        return torch.sqrt(norm_square)
+
+    def seeded_perturbation_norms(self, pert_seeds: Sequence[int]) -> list[torch.Tensor | None]:
+        """Norms to divide regenerated slices by, all None without normalize_perturbation."""
+        return [self._seeded_perturbation_norm(pert_seed) for pert_seed in pert_seeds]
+
+    def regenerate_parameter_perturbation(
+        self, pert_seed: int, index: int, norm: torch.Tensor | None = None
+    ) -> torch.Tensor:
+        """Slice of perturbation `pert_seed` of parameter `index`, see seeded_perturbation_norms."""
+        perturb = self._seeded_parameter_perturbation(pert_seed, index)
+        if norm is not None:
+            perturb.div_(norm)
+        return perturb
+
+    def generate_seeded_perturbation(
+        self, pert_seed: int
+    ) -> Iterator[tuple[Parameter, torch.Tensor]]:
+        """Yield (parameter, perturbation slice) pairs of perturbation `pert_seed`.
+
+        Only one parameter-sized slice is alive at a time.
+        """
+        norm = self._seeded_perturbation_norm(pert_seed)
+        for i, p in enumerate(self.parameters_list):
+            perturb = self._seeded_parameter_perturbation(pert_seed, i)
+            if norm is not None:
+                perturb.div_(norm)
+            yield p, perturb
+
+    def generate_seeded_update_direction(
+        self, pert_seeds: Sequence[int], dir_grads: torch.Tensor
+    ) -> Iterator[tuple[Parameter, torch.Tensor]]:
+        """Yield (parameter, mean(dir_grads[k] * perturbation_k)) pairs, one parameter at a time."""
+        norms = [self._seeded_perturbation_norm(pert_seed) for pert_seed in pert_seeds]
+        for i, p in enumerate(self.parameters_list):
+            direction = None
+            for pert_seed, norm, dir_grad in zip(pert_seeds, norms, dir_grads):
+                perturb = self._seeded_parameter_perturbation(pert_seed, i)
+                if norm is not None:
+                    perturb.div_(norm)
+                if direction is None:
+                    direction = perturb.mul_(dir_grad)
+                else:
+                    direction.addcmul_(perturb, dir_grad)
+            yield p, direction.div_(len(pert_seeds))
+
+    def apply_seeded_update(
+        self,
+        pert_seeds: Sequence[int],
+        dir_grads: torch.Tensor,
+        alpha: float | int,
+        decay: float | int = 1,
+    ) -> None:
+        """
+        In place p = decay * p + alpha * mean(dir_grads[k] * perturbation_k) for every parameter.
+        Each perturbation slice is regenerated and added right away, so the only extra memory is
+        one parameter-sized slice.
+        """
+        norms = [self._seeded_perturbation_norm(pert_seed) for pert_seed in pert_seeds]
+        scales = [alpha * dir_grad / len(pert_seeds) for dir_grad in dir_grads.tolist()]
+        for i, p in enumerate(self.parameters_list):
+            if decay != 1:
+                p.mul_(decay)
+            for pert_seed, norm, scale in zip(pert_seeds, norms, scales):
+                perturb = self._seeded_parameter_perturbation(pert_seed, i)
+                if norm is not None:
+                    perturb.div_(norm)
+                p.add_(perturb, alpha=scale)
+
+    def perturb_model(
+        self, perturb: torch.Tensor | int | None = None, alpha: float | int = 1
+    ) -> None:
+        """
+        perturb is either a full-dimension perturbation, the seed of a regenerated perturbation or
+        None, in which case the parameters are scaled by alpha.
+        """
+        if isinstance(perturb, int):
+            for p, _perturb in self.generate_seeded_perturbation(perturb):
+                p.add_(_perturb, alpha=alpha)
+            return
+
+        if self.parameter_arena is not None:
+            if perturb is not None:
+                self.parameter_arena.add_(perturb, alpha=alpha)
+            elif alpha != 1:
+                self.parameter_arena.mul_(alpha)
+            return
+
         start = 0
         for p in self.parameters_list:
             if perturb is not None:
@@ -76,15 +401,100 @@ class RandomGradientEstimator:
                     p.mul_(alpha)
             start += p.numel()
 
+    def restore_and_perturb_model(
+        self,
+        perturb: torch.Tensor | int,
+        next_perturb: torch.Tensor | int,
+        alpha: float | int = 1,
+    ) -> None:
+        """
+        Same as perturb_model(perturb, alpha) followed by perturb_model(next_perturb, alpha), but
+        done in one sweep over the parameters.
+        """
+        if isinstance(perturb, int):
+            for (p, _perturb), (_, _next_perturb) in zip(
+                self.generate_seeded_perturbation(perturb),
+                self.generate_seeded_perturbation(next_perturb),
+            ):
+                fused_add_pair_(p, _perturb, _next_perturb, alpha=alpha)
+            return
+
+        if self.parameter_arena is not None:
+            fused_add_pair_(self.parameter_arena.data, perturb, next_perturb, alpha=alpha)
+            return
+
+        start = 0
+        for p in self.parameters_list:
+            end = start + p.numel()
+            fused_add_pair_(p, perturb[start:end], next_perturb[start:end], alpha=alpha)
+            start = end
+
     def put_grad(self, grad: torch.Tensor) -> None:
+        if self.parameter_arena is not None:
+            self.parameter_arena.put_grad(grad)
+            return
+
         start = 0
         for p in self.parameters_list:
             p.grad = grad[start : (start + p.numel())].view(p.shape)
             start += p.numel()
 
+    def put_grad_from_seeds(self, pert_seeds: Sequence[int], dir_grads: torch.Tensor) -> None:
+        for p, direction in self.generate_seeded_update_direction(pert_seeds, dir_grads):
+            p.grad = direction
+
+    def compute_dir_grads(self, batch_inputs, labels, criterion) -> torch.Tensor:
+        """Same as compute_grad, but nothing is installed into .grad.
+
+        Used with ZOSGD, which applies the update from the seed and the returned dir_grads.
+        """
+        if not self.regenerate_perturbation:
+            raise ValueError("compute_dir_grads requires regenerate_perturbation=True")
+        estimation_method = self.seeded_method_func_dict[self.grad_estimate_method]
+        _, perturbation_dir_grads = self._estimate(
+            estimation_method, batch_inputs, labels, criterion
+        )
+        return perturbation_dir_grads
+
+    def _estimate(self, estimation_method: Callable, batch_inputs, labels, criterion):
+        self._metric_losses = []
+        # the previous step's output would stay alive during this step's forwards
+        self.last_pred = None
+        result = estimation_method(batch_inputs, labels, criterion)
+        self.last_loss = torch.cat([loss.reshape(-1) for loss in self._metric_losses]).mean()
+        return result
+
+    def _metric_loss(self, batch_inputs, labels, criterion, keep_pred: bool = True) -> torch.Tensor:
+        """
+        Loss of a forward the train metrics are computed from, see last_loss. Only forwards with
+        keep_pred replace last_pred, the others (+mu in central mode) drop it before running, so
+        at most one model output is alive next to the one being computed.
+        """
+        if not keep_pred:
+            self.last_pred = None
+        pred = self.model_forward(batch_inputs)
+        loss = criterion(pred, labels)
+        if keep_pred:
+            self.last_pred = pred
+        self._metric_losses.append(loss)
+        return loss
+
     def compute_grad(self, batch_inputs, labels, criterion) -> torch.Tensor:
-        estimation_method = self.method_func_dict[self.grad_estimate_method]
-        grad, perturbation_dir_grads = estimation_method(batch_inputs, labels, criterion)
+        if self.regenerate_perturbation:
+            estimation_method = self.seeded_method_func_dict[self.grad_estimate_method]
+            pert_seeds, perturbation_dir_grads = self._estimate(
+                estimation_method, batch_inputs, labels, criterion
+            )
+            self.put_grad_from_seeds(pert_seeds, perturbation_dir_grads)
+            return perturbation_dir_grads
+
+        if self.pert_batch_size > 1:
+            estimation_method = self.batched_method_func_dict[self.grad_estimate_method]
+        else:
+            estimation_method = self.method_func_dict[self.grad_estimate_method]
+        grad, perturbation_dir_grads = self._estimate(
+            estimation_method, batch_inputs, labels, criterion
+        )
 
         self.put_grad(grad)
         return perturbation_dir_grads
@@ -92,9 +502,9 @@ class RandomGradientEstimator:
     def _forward_method(self, batch_inputs, labels, criterion) -> tuple[torch.Tensor, torch.Tensor]:
         grad = 0
         dir_grads = []
-        initial_loss = criterion(self.model_forward(batch_inputs), labels)
+        initial_loss = self._metric_loss(batch_inputs, labels, criterion)
         for _ in range(self.num_pert):
-            pb_norm = self.generate_perturbation_norm()  # TODO add random seed
+            pb_norm = self.generate_perturbation_norm()
 
             self.perturb_model(pb_norm, alpha=self.mu)
             pert_plus_loss = criterion(self.model_forward(batch_inputs), labels)
@@ -105,20 +515,20 @@ class RandomGradientEstimator:
             if isinstance(grad, int):
                 grad = pb_norm.mul_(dir_grad)
             else:
-                grad.add_(pb_norm, alpha=dir_grad)
+                grad.addcmul_(pb_norm, dir_grad)
 
-        return grad.div_(self.num_pert), torch.tensor(dir_grads, device=self.device)
+        return grad.div_(self.num_pert), torch.stack(dir_grads)
 
     def _central_method(self, batch_inputs, labels, criterion) -> tuple[torch.Tensor, torch.Tensor]:
         grad = 0
         dir_grads = []
         for _ in range(self.num_pert):
-            pb_norm = self.generate_perturbation_norm()  # TODO add random seed
+            pb_norm = self.generate_perturbation_norm()
 
             self.perturb_model(pb_norm, alpha=self.mu)
-            pert_plus_loss = criterion(self.model_forward(batch_inputs), labels)
+            pert_plus_loss = self._metric_loss(batch_inputs, labels, criterion, keep_pred=False)
             self.perturb_model(pb_norm, alpha=-2 * self.mu)
-            pert_minus_loss = criterion(self.model_forward(batch_inputs), labels)
+            pert_minus_loss = self._metric_loss(batch_inputs, labels, criterion)
             self.perturb_model(pb_norm, alpha=self.mu)  # Restore model
 
             dir_grad = (pert_plus_loss - pert_minus_loss) / (2 * self.mu)
@@ -126,8 +536,214 @@ class RandomGradientEstimator:
             if isinstance(grad, int):
                 grad = pb_norm.mul_(dir_grad)
             else:
-                grad.add_(pb_norm, alpha=dir_grad)
-        return grad.div_(self.num_pert), torch.tensor(dir_grads, device=self.device)
+                grad.addcmul_(pb_norm, dir_grad)
+        return grad.div_(self.num_pert), torch.stack(dir_grads)
+
+    def _seeded_forward_method(
+        self, batch_inputs, labels, criterion
+    ) -> tuple[list[int], torch.Tensor]:
+        pert_seeds = self.generate_perturbation_seeds(self.num_pert)
+        dir_grads = []
+        initial_loss = self._metric_loss(batch_inputs, labels, criterion)
+        for pert_seed in pert_seeds:
+            self.perturb_model(pert_seed, alpha=self.mu)
+            pert_plus_loss = criterion(self.model_forward(batch_inputs), labels)
+            self.perturb_model(pert_seed, alpha=-self.mu)  # Restore model
+
+            dir_grads += [(pert_plus_loss - initial_loss) / self.mu]
+        return pert_seeds, torch.stack(dir_grads)
+
+    def _seeded_central_method(
+        self, batch_inputs, labels, criterion
+    ) -> tuple[list[int], torch.Tensor]:
+        pert_seeds = self.generate_perturbation_seeds(self.num_pert)
+        dir_grads = []
+        for pert_seed in pert_seeds:
+            self.perturb_model(pert_seed, alpha=self.mu)
+            pert_plus_loss = self._metric_loss(batch_inputs, labels, criterion, keep_pred=False)
+            self.perturb_model(pert_seed, alpha=-2 * self.mu)
+            pert_minus_loss = self._metric_loss(batch_inputs, labels, criterion)
+            self.perturb_model(pert_seed, alpha=self.mu)  # Restore model
+
+            dir_grads += [(pert_plus_loss - pert_minus_loss) / (2 * self.mu)]
+        return pert_seeds, torch.stack(dir_grads)
+
+    def _fused_central_sweeps(
+        self, perturbs: Iterator[torch.Tensor | int], batch_inputs, labels, criterion
+    ) -> Iterator[tuple[torch.Tensor | int, torch.Tensor]]:
+        """Yield (perturbation, dir_grad) pairs; the model is restored when a pair is yielded.
+
+        Perturbations are drawn from `perturbs` in the same order as the unfused schedule.
+        """
+        perturb = next(perturbs, None)
+        if perturb is None:
+            return
+        self.perturb_model(perturb, alpha=self.mu)
+        while perturb is not None:
+            pert_plus_loss = self._metric_loss(batch_inputs, labels, criterion, keep_pred=False)
+            self.perturb_model(perturb, alpha=-2 * self.mu)
+            pert_minus_loss = self._metric_loss(batch_inputs, labels, criterion)
+
+            next_perturb = next(perturbs, None)
+            if next_perturb is None:
+                self.perturb_model(perturb, alpha=self.mu)  # Restore model
+            else:
+                # Restore model and apply the next perturbation in one sweep
+                self.restore_and_perturb_model(perturb, next_perturb, alpha=self.mu)
+
+            yield perturb, (pert_plus_loss - pert_minus_loss) / (2 * self.mu)
+            perturb = next_perturb
+
+    def _fused_central_method(
+        self, batch_inputs, labels, criterion
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        grad = 0
+        dir_grads = []
+        pb_norms = (self.generate_perturbation_norm() for _ in range(self.num_pert))
+        for pb_norm, dir_grad in self._fused_central_sweeps(
+            pb_norms, batch_inputs, labels, criterion
+        ):
+            dir_grads += [dir_grad]
+            if isinstance(grad, int):
+                grad = pb_norm.mul_(dir_grad)
+            else:
+                grad.addcmul_(pb_norm, dir_grad)
+        return grad.div_(self.num_pert), torch.stack(dir_grads)
+
+    def _seeded_fused_central_method(
+        self, batch_inputs, labels, criterion
+    ) -> tuple[list[int], torch.Tensor]:
+        pert_seeds = self.generate_perturbation_seeds(self.num_pert)
+        dir_grads = [
+            dir_grad
+            for _, dir_grad in self._fused_central_sweeps(
+                iter(pert_seeds), batch_inputs, labels, criterion
+            )
+        ]
+        return pert_seeds, torch.stack(dir_grads)
+
+    def _generate_perturbation_chunks(self) -> Iterator[torch.Tensor]:
+        """Yield [chunk_size, total_dimensions] perturbations, num_pert rows in total.
+
+        Rows are generated one by one in the same order as the sequential methods, so the same
+        random state produces the same perturbations.
+        """
+        for start in range(0, self.num_pert, self.pert_batch_size):
+            chunk_size = min(self.pert_batch_size, self.num_pert - start)
+            pb_norms = torch.empty(chunk_size, self.total_dimensions, device=self.device)
+            for i in range(chunk_size):
+                pb_norms[i] = self.generate_perturbation_norm()
+            yield pb_norms
+
+    def _batched_parameter_perturbations(
+        self, pb_norms: torch.Tensor
+    ) -> Iterator[tuple[str, Parameter, torch.Tensor]]:
+        chunk_size = pb_norms.shape[0]
+        start = 0
+        for name, p in zip(self.parameter_names, self.parameters_list):
+            _perturb = pb_norms[:, start : (start + p.numel())].view(chunk_size, *p.shape)
+            yield name, p, _perturb
+            start += p.numel()
+
+    def _batched_losses(
+        self, stacked_params: dict[str, torch.Tensor], batch_inputs, labels, criterion
+    ) -> torch.Tensor:
+        """Losses of all parameter sets stacked along dim 0, computed in one vmap-ed forward.
+
+        NOTE: Modules updating buffers in place (e.g. BatchNorm in train mode) and random modules
+        (e.g. dropout in train mode) can not run under vmap.
+        """
+
+        def loss_fn(params):
+            return criterion(self.functional_model_forward(params, batch_inputs), labels)
+
+        return vmap(loss_fn)(stacked_params)
+
+    def _batched_metric_losses(
+        self, stacked_params: dict[str, torch.Tensor], batch_inputs, labels, criterion
+    ) -> torch.Tensor:
+        """Same as _batched_losses, for forwards the train metrics are computed from."""
+
+        def loss_and_pred_fn(params):
+            pred = self.functional_model_forward(params, batch_inputs)
+            return criterion(pred, labels), pred
+
+        self.last_pred = None
+        losses, preds = vmap(loss_and_pred_fn)(stacked_params)
+        self.last_pred = _last_of_stacked(preds)
+        self._metric_losses.append(losses)
+        return losses
+
+    @staticmethod
+    def _accumulate_grad(grad, pb_norms: torch.Tensor, dir_grads: torch.Tensor):
+        # Same accumulation order as the sequential methods.
+        for pb_norm, dir_grad in zip(pb_norms, dir_grads):
+            if isinstance(grad, int):
+                grad = pb_norm.mul(dir_grad)
+            else:
+                grad.addcmul_(pb_norm, dir_grad)
+        return grad
+
+    def _batched_forward_method(
+        self, batch_inputs, labels, criterion
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        grad = 0
+        dir_grads = []
+        initial_loss = self._metric_loss(batch_inputs, labels, criterion)
+        for pb_norms in self._generate_perturbation_chunks():
+            pert_plus_params = {
+                name: torch.add(p, perturb, alpha=self.mu)
+                for name, p, perturb in self._batched_parameter_perturbations(pb_norms)
+            }
+            pert_plus_losses = self._batched_losses(
+                pert_plus_params, batch_inputs, labels, criterion
+            )
+            del pert_plus_params
+
+            chunk_dir_grads = (pert_plus_losses - initial_loss) / self.mu
+            dir_grads += [chunk_dir_grads]
+            grad = self._accumulate_grad(grad, pb_norms, chunk_dir_grads)
+
+        return grad.div_(self.num_pert), torch.cat(dir_grads)
+
+    def _batched_central_method(
+        self, batch_inputs, labels, criterion
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        grad = 0
+        dir_grads = []
+        for pb_norms in self._generate_perturbation_chunks():
+            chunk_size = pb_norms.shape[0]
+            # +mu and -mu parameters are stacked together, so one forward serves both sides.
+            # -mu is derived from +mu the same way the sequential method does it in place.
+            stacked_params = {}
+            for name, p, perturb in self._batched_parameter_perturbations(pb_norms):
+                pert_plus = torch.add(p, perturb, alpha=self.mu)
+                pert_minus = torch.add(pert_plus, perturb, alpha=-2 * self.mu)
+                stacked_params[name] = torch.cat([pert_plus, pert_minus])
+            losses = self._batched_metric_losses(stacked_params, batch_inputs, labels, criterion)
+            del stacked_params
+
+            chunk_dir_grads = (losses[:chunk_size] - losses[chunk_size:]) / (2 * self.mu)
+            dir_grads += [chunk_dir_grads]
+            grad = self._accumulate_grad(grad, pb_norms, chunk_dir_grads)
+
+        return grad.div_(self.num_pert), torch.cat(dir_grads)
+
+
+def _last_of_stacked(outputs):
+    """
+    Output of the last forward of a vmap-ed forward, outputs may be a model output dict (of which
+    only the tensors, e.g. logits, are kept). Copied, a view would keep all stacked outputs alive.
+    """
+    if isinstance(outputs, torch.Tensor):
+        return outputs[-1].clone()
+    return type(outputs)(
+        **{
+            key: value[-1].clone()
+            for key, value in outputs.items()
+            if isinstance(value, torch.Tensor)
+        }
+    )
 
 
 # Copied from DeepZero and slightly modified
@@ -0,0 +1,258 @@
+import pytest
+import torch
+from torch import nn
+
+from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+
+
+class SmallCNN(nn.Module):
+    def __init__(self):
+        super(SmallCNN, self).__init__()
+        self.conv = nn.Conv2d(1, 4, 3)
+        self.linear = nn.Linear(4 * 6 * 6, 3)
+
+    def forward(self, x):
+        x = nn.functional.relu(self.conv(x))
+        return self.linear(x.view(x.size(0), -1))
+
+
+def get_grad_and_dir_grads(grad_estimate_method, pert_batch_size):
+    torch.manual_seed(0)
+    model = SmallCNN()
+    batch_inputs = torch.randn(5, 1, 8, 8)
+    labels = torch.randint(0, 3, (5,))
+    rge = RGE(
+        model,
+        mu=1e-2,
+        num_pert=5,
+        grad_estimate_method=grad_estimate_method,
+        pert_batch_size=pert_batch_size,
+    )
+    with torch.no_grad():
+        dir_grads = rge.compute_grad(batch_inputs, labels, nn.CrossEntropyLoss())
+    return [p.grad.clone() for p in model.parameters()], dir_grads
+
+
+@pytest.mark.parametrize("grad_estimate_method", ["forward", "central"])
+@pytest.mark.parametrize("pert_batch_size", [2, 5, 8])
+def test_batched_method_matches_sequential(grad_estimate_method, pert_batch_size):
+    grads, dir_grads = get_grad_and_dir_grads(grad_estimate_method, 1)
+    batched_grads, batched_dir_grads = get_grad_and_dir_grads(
+        grad_estimate_method, pert_batch_size
+    )
+
+    assert batched_dir_grads.shape == (5,)
+    torch.testing.assert_close(batched_dir_grads, dir_grads, rtol=1e-3, atol=1e-3)
+    for grad, batched_grad in zip(grads, batched_grads):
+        torch.testing.assert_close(batched_grad, grad, rtol=1e-3, atol=1e-3)
+
+
+def test_batched_method_does_not_touch_model():
+    torch.manual_seed(0)
+    model = SmallCNN()
+    original_parameters = [p.clone() for p in model.parameters()]
+    rge = RGE(model, num_pert=4, grad_estimate_method="central", pert_batch_size=4)
+    with torch.no_grad():
+        rge.compute_grad(torch.randn(2, 1, 8, 8), torch.tensor([0, 1]), nn.CrossEntropyLoss())
+
+    for orig_param, param in zip(original_parameters, model.parameters()):
+        assert torch.equal(orig_param, param)
+
+
+@pytest.mark.parametrize("grad_estimate_method", ["forward", "central"])
+@pytest.mark.parametrize("normalize_perturbation", [False, True])
+def test_regenerated_perturbation_grad_is_reproducible(
+    grad_estimate_method, normalize_perturbation
+):
+    torch.manual_seed(0)
+    model = SmallCNN()
+    original_parameters = [p.clone() for p in model.parameters()]
+    rge = RGE(
+        model,
+        mu=1e-2,
+        num_pert=3,
+        grad_estimate_method=grad_estimate_method,
+        normalize_perturbation=normalize_perturbation,
+        regenerate_perturbation=True,
+    )
+    batch_inputs, labels = torch.randn(2, 1, 8, 8), torch.tensor([0, 1])
+    with torch.no_grad():
+        rge.manual_seed(42)
+        dir_grads = rge.compute_grad(batch_inputs, labels, nn.CrossEntropyLoss())
+        grads = [p.grad.clone() for p in model.parameters()]
+
+        # model is restored after the estimation
+        for orig_param, param in zip(original_parameters, model.parameters()):
+            torch.testing.assert_close(orig_param, param)
+
+        # grad is the mean of regenerated perturbations weighted by dir_grads
+        pert_seeds = rge.get_perturbation_seeds(42, 3)
+        expected_grad = 0
+        for pert_seed, dir_grad in zip(pert_seeds, dir_grads):
+            slices = rge.generate_seeded_perturbation(pert_seed)
+            perturb = torch.cat([z.flatten() for _, z in slices])
+            if normalize_perturbation:
+                torch.testing.assert_close(perturb.norm(), torch.tensor(1.0))
+            expected_grad = expected_grad + perturb * dir_grad / 3
+        torch.testing.assert_close(torch.cat([grad.flatten() for grad in grads]), expected_grad)
+
+
+@pytest.mark.parametrize("grad_estimate_method", ["forward", "central"])
+def test_flat_parameters_matches_parameter_loop(grad_estimate_method):
+    grads_list, dir_grads_list = [], []
+    for flat_parameters in [False, True]:
+        torch.manual_seed(0)
+        model = SmallCNN()
+        rge = RGE(
+            model,
+            mu=1e-2,
+            num_pert=3,
+            grad_estimate_method=grad_estimate_method,
+            flat_parameters=flat_parameters,
+        )
+        with torch.no_grad():
+            dir_grads = rge.compute_grad(
+                torch.randn(2, 1, 8, 8), torch.tensor([0, 1]), nn.CrossEntropyLoss()
+            )
+        grads_list.append([p.grad.clone() for p in model.parameters()])
+        dir_grads_list.append(dir_grads)
+
+    torch.testing.assert_close(dir_grads_list[0], dir_grads_list[1])
+    for grad, flat_grad in zip(*grads_list):
+        torch.testing.assert_close(grad, flat_grad)
+
+    # parameters are views of the arena buffer
+    rge.parameter_arena.data.zero_()
+    for p in model.parameters():
+        assert (p == 0).all()
+
+
+@pytest.mark.parametrize("regenerate_perturbation", [False, True])
+@pytest.mark.parametrize("flat_parameters", [False, True])
+def test_fused_central_sweep_matches_unfused(regenerate_perturbation, flat_parameters):
+    results = []
+    for fused_central_sweep in [False, True]:
+        torch.manual_seed(0)
+        model = SmallCNN()
+        rge = RGE(
+            model,
+            mu=1e-2,
+            num_pert=4,
+            grad_estimate_method="central",
+            regenerate_perturbation=regenerate_perturbation,
+            flat_parameters=flat_parameters,
+            fused_central_sweep=fused_central_sweep,
+        )
+        with torch.no_grad():
+            dir_grads = rge.compute_grad(
+                torch.randn(2, 1, 8, 8), torch.tensor([0, 1]), nn.CrossEntropyLoss()
+            )
+        results.append(
+            (
+                dir_grads,
+                [p.grad.clone() for p in model.parameters()],
+                [p.clone() for p in model.parameters()],
+            )
+        )
+
+    (dir_grads, grads, params), (fused_dir_grads, fused_grads, fused_params) = results
+    assert torch.equal(dir_grads, fused_dir_grads)
+    for grad, fused_grad in zip(grads, fused_grads):
+        assert torch.equal(grad, fused_grad)
+    # model is restored the same way at the end of the loop
+    for param, fused_param in zip(params, fused_params):
+        assert torch.equal(param, fused_param)
+
+
+@pytest.mark.parametrize("perturbation_chunk_size", [None, 50])
+def test_perturbations_do_not_depend_on_global_rng(perturbation_chunk_size):
+    runs = []
+    for interleave in [False, True]:
+        rge = RGE(SmallCNN(), perturbation_chunk_size=perturbation_chunk_size)
+        rge.manual_seed(7)
+        draws = []
+        for _ in range(3):
+            if interleave:
+                # global RNG draws between the estimator's draws change nothing
+                torch.rand(10)
+            draws.append(rge.generate_perturbation_norm())
+            if interleave:
+                torch.rand(10)
+            draws.append(torch.tensor(rge.generate_perturbation_seeds(2)))
+        runs.append(draws)
+    for draw, interleaved_draw in zip(*runs):
+        assert torch.equal(draw, interleaved_draw)
+
+
+def test_counter_based_chunks_are_independent():
+    rge = RGE(SmallCNN(), perturbation_chunk_size=50)
+    rge.manual_seed(3)
+    perturbation = rge.generate_perturbation_norm()
+    pert_seed = rge.get_perturbation_seeds(3, 1)[0]
+
+    num_chunks = (rge.total_dimensions + 49) // 50
+    generator = torch.Generator()
+    for chunk_index in reversed(range(num_chunks)):
+        chunk = rge.generate_perturbation_chunk(pert_seed, chunk_index, generator=generator)
+        torch.testing.assert_close(chunk, perturbation[chunk_index * 50 : (chunk_index + 1) * 50])
+
+
+@pytest.mark.parametrize("grad_estimate_method", ["forward", "central"])
+@pytest.mark.parametrize("pert_batch_size", [1, 4])
+def test_last_loss_reuses_estimate_forwards(grad_estimate_method, pert_batch_size):
+    torch.manual_seed(0)
+    model = SmallCNN()
+    batch_inputs, labels = torch.randn(2, 1, 8, 8), torch.tensor([0, 1])
+    criterion = nn.CrossEntropyLoss()
+    rge = RGE(
+        model,
+        mu=1e-2,
+        num_pert=4,
+        grad_estimate_method=grad_estimate_method,
+        pert_batch_size=pert_batch_size,
+    )
+    with torch.no_grad():
+        loss = criterion(model(batch_inputs), labels)
+        rge.compute_grad(batch_inputs, labels, criterion)
+
+    assert rge.last_pred.shape == (2, 3)
+    if grad_estimate_method == "forward":
+        torch.testing.assert_close(rge.last_loss, loss)
+    else:
+        # mean of losses mu away from the model
+        torch.testing.assert_close(rge.last_loss, loss, rtol=1e-2, atol=1e-2)
+
+
+def test_verbalizer_scoring_matches_full_logits():
+    from transformers import OPTConfig, OPTForCausalLM
+
+    from shared.language_utils import LLMBatchInput
+
+    torch.manual_seed(0)
+    config = OPTConfig(
+        vocab_size=50,
+        hidden_size=16,
+        num_hidden_layers=2,
+        ffn_dim=32,
+        num_attention_heads=2,
+        max_position_embeddings=32,
+        word_embed_proj_dim=16,
+    )
+    model = OPTForCausalLM(config).eval()
+    verbalizer_id_list = [7, 3]
+    batch_inputs = LLMBatchInput(
+        torch.randint(2, 50, (3, 6)), torch.tensor([[0, 0, 1, 1, 1, 1]] + [[1] * 6] * 2)
+    )
+    full_rge = RGE(model)
+    rge = RGE(model, verbalizer_id_list=verbalizer_id_list)
+    params = {name: p + 0.01 for name, p in model.named_parameters()}
+
+    with torch.no_grad():
+        expected = full_rge.model_forward(batch_inputs).logits[:, -1, verbalizer_id_list]
+        torch.testing.assert_close(rge.model_forward(batch_inputs), expected)
+
+        expected = full_rge.functional_model_forward(params, batch_inputs).logits
+        torch.testing.assert_close(
+            rge.functional_model_forward(params, batch_inputs),
+            expected[:, -1, verbalizer_id_list],
+        )
@@ -0,0 +1,34 @@
+import torch
+
+from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+
+
+class ZOSGD(torch.optim.Optimizer):
+    """
+    Plain SGD (with weight decay, without momentum) applied directly from (seed, dir_grads).
+
+    For every parameter w -= lr * (mean_k(dir_grads[k] * z_k) + weight_decay * w), where z_k are
+    regenerated slice by slice from the seed by a RandomGradientEstimator with
+    regenerate_perturbation=True. There is no .grad, no momentum buffer and no full-dimension
+    perturbation, so a step costs no extra model-sized memory.
+
+    Up to float rounding this is the same update torch.optim.SGD(momentum=0) does on the gradient
+    installed by grad_estimator.compute_grad.
+    """
+
+    def __init__(self, grad_estimator: RGE, lr: float, weight_decay: float = 0):
+        if not isinstance(grad_estimator, RGE) or not grad_estimator.regenerate_perturbation:
+            raise ValueError("ZOSGD requires a grad estimator with regenerate_perturbation=True")
+        super().__init__(grad_estimator.parameters_list, {"lr": lr, "weight_decay": weight_decay})
+        self.grad_estimator = grad_estimator
+
+    @torch.no_grad()
+    def step(self, seed: int, dir_grads: torch.Tensor) -> None:  # type: ignore[override]
+        """`seed` is the one set by grad_estimator.manual_seed before its compute_dir_grads."""
+        # All parameters are in one param group, created in __init__.
+        group = self.param_groups[0]
+        lr, weight_decay = group["lr"], group["weight_decay"]
+        pert_seeds = self.grad_estimator.get_perturbation_seeds(seed, dir_grads.shape[0])
+        self.grad_estimator.apply_seeded_update(
+            pert_seeds, dir_grads, alpha=-lr, decay=1 - lr * weight_decay
+        )
@@ -0,0 +1,42 @@
+import pytest
+import torch
+from torch import nn
+
+from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+from gradient_estimators.random_gradient_estimator_test import SmallCNN
+from gradient_estimators.zo_optimizer import ZOSGD
+
+
+@pytest.mark.parametrize("weight_decay", [0, 1e-2])
+def test_zo_sgd_matches_sgd(weight_decay):
+    batch_inputs, labels = torch.randn(2, 1, 8, 8), torch.tensor([0, 1])
+    criterion = nn.CrossEntropyLoss()
+    results = []
+    for fused in [False, True]:
+        torch.manual_seed(0)
+        model = SmallCNN()
+        rge = RGE(model, mu=1e-2, num_pert=3, regenerate_perturbation=True)
+        if fused:
+            optimizer = ZOSGD(rge, lr=0.1, weight_decay=weight_decay)
+        else:
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.1, weight_decay=weight_decay)
+        with torch.no_grad():
+            for seed in [1, 2, 3]:
+                rge.manual_seed(seed)
+                if fused:
+                    optimizer.step(seed, rge.compute_dir_grads(batch_inputs, labels, criterion))
+                    assert all(p.grad is None for p in model.parameters())
+                else:
+                    optimizer.zero_grad()
+                    rge.compute_grad(batch_inputs, labels, criterion)
+                    optimizer.step()
+        results.append([p.clone() for p in model.parameters()])
+
+    for param, fused_param in zip(*results):
+        torch.testing.assert_close(param, fused_param)
+
+
+def test_zo_sgd_requires_regenerate_perturbation():
+    rge = RGE(SmallCNN())
+    with pytest.raises(ValueError):
+        ZOSGD(rge, lr=0.1)
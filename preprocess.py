@@ -2,6 +2,7 @@ import torch
 import torchvision
 import torchvision.transforms as transforms
 import json
+from functools import partial
 from typing import Union
 from shared.dataset import ShakeSpeare
 from shared.language_utils import (
@@ -9,7 +10,10 @@ from shared.language_utils import (
     LM_DATASET_MAP,
     LmTask,
     CustomLMDataset,
+    LengthBucketBatchSampler,
+    TokenizedLMDataset,
     get_collate_fn,
+    load_tokenized_lm_dataset,
 )
 from datasets import load_dataset
 from transformers import AutoTokenizer
@@ -197,20 +201,34 @@ def preprocess_cezo_fl(
         else:
             max_length = 2048
 
-        dataset = load_dataset(LM_DATASET_MAP[args.dataset], args.dataset)
-        raw_train_dataset = dataset["train"]
-        raw_test_dataset = dataset["validation"]
-
         model_name = "facebook/opt-125m"
         tokenizer = AutoTokenizer.from_pretrained(
             model_name, padding_side="left", truncate_side="left"
         )
         template = LM_TEMPLATE_MAP[args.dataset]()
-        encoded_train_texts = list(map(template.verbalize, raw_train_dataset))
-        encoded_test_texts = list(map(template.verbalize, raw_test_dataset))
+        if args.token_cache_dir:
+            # tokenized once, later launches only map the cache
+            train_dataset, test_dataset = [
+                load_tokenized_lm_dataset(
+                    args.token_cache_dir,
+                    args.dataset,
+                    split,
+                    template,
+                    tokenizer,
+                    max_length,
+                    partial(load_dataset, LM_DATASET_MAP[args.dataset], args.dataset, split=split),
+                )
+                for split in ["train", "validation"]
+            ]
+        else:
+            dataset = load_dataset(LM_DATASET_MAP[args.dataset], args.dataset)
+            raw_train_dataset = dataset["train"]
+            raw_test_dataset = dataset["validation"]
+            encoded_train_texts = list(map(template.verbalize, raw_train_dataset))
+            encoded_test_texts = list(map(template.verbalize, raw_test_dataset))
 
-        train_dataset = CustomLMDataset(encoded_train_texts, tokenizer, max_length=max_length)
-        test_dataset = CustomLMDataset(encoded_test_texts, tokenizer, max_length=max_length)
+            train_dataset = CustomLMDataset(encoded_train_texts, tokenizer, max_length=max_length)
+            test_dataset = CustomLMDataset(encoded_test_texts, tokenizer, max_length=max_length)
         test_loader = torch.utils.data.DataLoader(
             test_dataset,
             batch_size=args.test_batch_size,
@@ -237,16 +255,39 @@ def preprocess_cezo_fl(
         )
     splitted_train_loaders = []
     for i in range(num_clients):
-        if args.dataset in LM_TEMPLATE_MAP.keys():
+        # The serial loop shuffles with the global RNG as before. Clients run by a thread, process
+        # or network executor shuffle with their own generator, so their batches do not depend on
+        # which clients ran before them (or concurrently) in the same process.
+        client_generator = None
+        if args.client_executor != "serial":
+            client_generator = torch.Generator().manual_seed(args.seed + i)
+        if isinstance(train_dataset, TokenizedLMDataset):
+            # lengths are known without tokenizing, batch sequences of similar lengths
+            batch_sampler = LengthBucketBatchSampler(
+                train_dataset.lengths[splitted_train_sets[i].indices],
+                args.train_batch_size,
+                bucket_batches=args.length_bucket_batches,
+                generator=client_generator,
+            )
+            dataloader = torch.utils.data.DataLoader(
+                splitted_train_sets[i],
+                batch_sampler=batch_sampler,
+                collate_fn=get_collate_fn(tokenizer, max_length),
+            )
+        elif args.dataset in LM_TEMPLATE_MAP.keys():
             dataloader = torch.utils.data.DataLoader(
                 splitted_train_sets[i],
                 batch_size=args.train_batch_size,
                 shuffle=True,
                 collate_fn=get_collate_fn(tokenizer, max_length),
+                generator=client_generator,
             )
         else:
             dataloader = torch.utils.data.DataLoader(
-                splitted_train_sets[i], batch_size=args.train_batch_size, **kwargs
+                splitted_train_sets[i],
+                batch_size=args.train_batch_size,
+                generator=client_generator,
+                **kwargs,
             )
         splitted_train_loaders.append(dataloader)
     return device, splitted_train_loaders, test_loader
@@ -1,16 +1,19 @@
 import torch
+from copy import deepcopy
 from tqdm import tqdm
 import torch.nn as nn
 from tensorboardX import SummaryWriter
 from os import path
 from shared.checkpoint import CheckPoint
 from shared.model_helpers import get_current_datetime_str
+from shared.evaluation import BackgroundEvaluator, evaluate_model
 from shared.metrics import Metric, accuracy
 from pruning.helpers import generate_random_mask_arr
 from config import get_params, get_args_str
 from preprocess import preprocess, use_sparsity_dict
 from models.cnn_mnist import CNN_MNIST
 from gradient_estimators.random_gradient_estimator import RandomGradientEstimator as RGE
+from gradient_estimators.zo_optimizer import ZOSGD
 from gradient_estimators.coordinate_gradient_estimator import (
     CoordinateGradientEstimator as CGE,
 )
@@ -26,34 +29,24 @@ def prepare_settings(args, device):
         optimizer = torch.optim.SGD(
             model.parameters(), lr=args.lr, weight_decay=1e-5, momentum=args.momentum
         )
-        scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.8)
     elif args.dataset == "cifar10":
         model = LeNet().to(device)
         criterion = nn.CrossEntropyLoss()
         optimizer = torch.optim.SGD(
             model.parameters(), lr=args.lr, weight_decay=5e-4, momentum=args.momentum
         )
-        scheduler = torch.optim.lr_scheduler.MultiStepLR(
-            optimizer, milestones=[200], gamma=0.1
-        )
     elif args.dataset == "fashion":
         model = CNN_FMNIST().to(device)
         criterion = nn.CrossEntropyLoss()
         optimizer = torch.optim.SGD(
             model.parameters(), lr=args.lr, weight_decay=1e-5, momentum=args.momentum
         )
-        scheduler = torch.optim.lr_scheduler.MultiStepLR(
-            optimizer, milestones=[200], gamma=0.1
-        )
     elif args.dataset == "shakespeare":
         model = CharLSTM().to(device)
         criterion = nn.CrossEntropyLoss()
         optimizer = torch.optim.SGD(
             model.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4
         )
-        scheduler = torch.optim.lr_scheduler.MultiStepLR(
-            optimizer, milestones=[200], gamma=0.1
-        )
 
     if args.grad_estimate_method in ["rge-central", "rge-forward"]:
         method = args.grad_estimate_method[4:]
@@ -64,18 +57,54 @@ def prepare_settings(args, device):
             num_pert=args.num_pert,
             grad_estimate_method=method,
             device=device,
+            pert_batch_size=args.pert_batch_size,
+            regenerate_perturbation=args.regenerate_perturbation,
+            flat_parameters=args.flat_parameters,
+            fused_central_sweep=args.fused_central_sweep,
+            perturbation_chunk_size=args.perturbation_chunk_size,
         )
     elif args.grad_estimate_method in ["cge-forward"]:
-        print("Using CGE forward")
+        if args.cge_query_budget is None:
+            print("Using CGE forward")
+        else:
+            # RGE forward costs num_pert and RGE central 2 * num_pert forwards per step
+            print(
+                f"Using CGE forward, {args.cge_sampling} {args.cge_query_budget} "
+                "coordinates/step"
+            )
         grad_estimator = CGE(
             model,
             mu=args.mu,
             device=device,
+            flat_parameters=args.flat_parameters,
+            coordinate_batch_size=args.cge_batch_size,
+            max_block_memory=(
+                None
+                if args.cge_max_block_memory_mb is None
+                else int(args.cge_max_block_memory_mb * 2**20)
+            ),
+            query_budget=args.cge_query_budget,
+            coordinate_sampling=args.cge_sampling,
         )
     else:
         raise Exception(
             f"Grad estimate method {args.grad_estimate_method} not supported"
         )
+
+    if args.fused_zo_sgd:
+        if optimizer.defaults["momentum"] != 0:
+            raise Exception("--fused-zo-sgd only supports SGD without momentum")
+        optimizer = ZOSGD(
+            grad_estimator, lr=args.lr, weight_decay=optimizer.defaults["weight_decay"]
+        )
+
+    # created last so that the scheduler drives the optimizer that actually steps
+    if args.dataset == "mnist":
+        scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.8)
+    else:
+        scheduler = torch.optim.lr_scheduler.MultiStepLR(
+            optimizer, milestones=[200], gamma=0.1
+        )
     return model, criterion, optimizer, scheduler, grad_estimator
 
 
@@ -102,14 +131,29 @@ def train_model(epoch: int) -> tuple[float, float]:
             if device != torch.device("cpu"):
                 images, labels = images.to(device), labels.to(device)
             # update models
-            optimizer.zero_grad()
-            grad_estimator.compute_grad(images, labels, criterion)
-            optimizer.step()
+            if isinstance(optimizer, ZOSGD):
+                seed = torch.randint(0, 2**31 - 1, ()).item()
+                grad_estimator.manual_seed(seed)
+                dir_grads = grad_estimator.compute_dir_grads(images, labels, criterion)
+                optimizer.step(seed, dir_grads)
+            else:
+                optimizer.zero_grad()
+                grad_estimator.compute_grad(images, labels, criterion)
+                optimizer.step()
 
-            pred = model(images)
-            train_loss.update(criterion(pred, labels))
+            # train metrics come from the forwards of the estimate, unless an exact one is due
+            interval = args.exact_train_metrics_interval
+            if interval and (iteration + 1) % interval == 0:
+                pred = model(images)
+                loss = criterion(pred, labels)
+            else:
+                pred, loss = grad_estimator.last_pred, grad_estimator.last_loss
+            train_loss.update(loss)
             train_accuracy.update(accuracy(pred, labels))
-            t.set_postfix({"Loss": train_loss.avg, "Accuracy": train_accuracy.avg})
+            if (iteration + 1) % args.metrics_sync_interval == 0:
+                # reading avg waits for the device, so the progress bar is only updated every
+                # metrics_sync_interval steps
+                t.set_postfix({"Loss": train_loss.avg, "Accuracy": train_accuracy.avg})
             t.update(1)
         if epoch > args.warmup_epochs:
             scheduler.step()
@@ -134,6 +178,29 @@ def eval_model(epoch: int) -> tuple[float, float]:
     return eval_loss.avg, eval_accuracy.avg
 
 
+def handle_eval_results(eval_results: list[tuple[int, float, float]]) -> None:
+    for epoch, eval_loss, eval_accuracy in eval_results:
+        if evaluator is not None:
+            print(
+                f"Evaluation(round {epoch}): Eval Loss:{eval_loss:.4f}, "
+                f"Accuracy:{eval_accuracy * 100:.2f}%"
+            )
+        if args.log_to_tensorboard:
+            writer.add_scalar("Loss/test", eval_loss, epoch)
+            writer.add_scalar("Accuracy/test", eval_accuracy, epoch)
+
+        # With --background-eval the results arrive after training moved on, so the states saved
+        # are the ones snapshotted when the evaluation was submitted.
+        snapshot = eval_snapshots.pop(epoch, None)
+        if checkpoint.should_update(eval_loss, eval_accuracy, epoch):
+            checkpoint.save(
+                args_str + "-" + get_current_datetime_str(),
+                epoch,
+                subfolder=args.log_to_tensorboard,
+                snapshot=snapshot,
+            )
+
+
 if __name__ == "__main__":
     args = get_params().parse_args()
     torch.manual_seed(args.seed)
@@ -157,6 +224,16 @@ if __name__ == "__main__":
             )
         )
 
+    evaluator = None
+    # epoch -> checkpoint.snapshot() of the model submitted to the background evaluation
+    eval_snapshots: dict[int, dict] = {}
+    if args.background_eval:
+        evaluator = BackgroundEvaluator(
+            deepcopy(model),
+            test_loader,
+            lambda replica, batches: evaluate_model(replica, criterion, accuracy, batches, device),
+        )
+
     sparsity_dict = use_sparsity_dict(args, model.model_name)
     for epoch in range(args.epoch):
         if sparsity_dict is not None and epoch % args.mask_shuffle_interval == 0:
@@ -168,17 +245,15 @@ if __name__ == "__main__":
         if args.log_to_tensorboard:
             writer.add_scalar("Loss/train", train_loss, epoch)
             writer.add_scalar("Accuracy/train", train_accuracy, epoch)
-        eval_loss, eval_accuracy = eval_model(epoch)
-        if args.log_to_tensorboard:
-            writer.add_scalar("Loss/test", eval_loss, epoch)
-            writer.add_scalar("Accuracy/test", eval_accuracy, epoch)
-
-        if checkpoint.should_update(eval_loss, eval_accuracy, epoch):
-            checkpoint.save(
-                args_str + "-" + get_current_datetime_str(),
-                epoch,
-                subfolder=args.log_to_tensorboard,
-            )
+        if evaluator is None:
+            handle_eval_results([(epoch, *eval_model(epoch))])
+        else:
+            if args.checkpoint_update_plan != "never":
+                eval_snapshots[epoch] = checkpoint.snapshot()
+            evaluator.submit(epoch, model)
+            handle_eval_results(evaluator.poll())
 
+    if evaluator is not None:
+        handle_eval_results(evaluator.close())
     if args.log_to_tensorboard:
         writer.close()
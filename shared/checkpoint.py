@@ -1,5 +1,6 @@
 import torch
 import os
+from copy import deepcopy
 
 from config import get_args_dict
 
@@ -104,25 +105,40 @@ class CheckPoint:
         else:
             raise Exception("Optimizer does not match checkpoint!")
 
-    def _generate_save_data(self, file_name, epoch_idx):
+    def _get_states(self) -> dict:
+        return {
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "rng_states": {
+                "cpu": torch.random.get_rng_state(),
+                "cuda_all": torch.cuda.get_rng_state_all(),
+            },
+        }
+
+    def snapshot(self) -> dict:
+        """
+        Copy of the current model, optimizer and rng states, for save() to write them later, e.g.
+        once the background evaluation of this model is done and training has moved on.
+        """
+        return deepcopy(self._get_states())
+
+    def _generate_save_data(self, file_name, epoch_idx, snapshot=None):
         checkpoint_step = {"n_epoch": epoch_idx + 1, "args": get_args_dict(self.args)}
+        states = self._get_states() if snapshot is None else snapshot
         return {
             "model": {
                 "model_name": self.model.model_name,
-                "state_dict": self.model.state_dict(),
+                "state_dict": states["model"],
             },
             "optimizer": {
                 "name": self.optimizer.__class__.__name__,
-                "state_dict": self.optimizer.state_dict(),
+                "state_dict": states["optimizer"],
             },
             # "gradient_estimator": {
             #     "name": self.gradient_estimator.__class__.__name__,
             #     "state_dict": self.gradient_estimator.state_dict(),
             # },
-            "rng_states": {
-                "cpu": torch.random.get_rng_state(),
-                "cuda_all": torch.cuda.get_rng_state_all(),
-            },
+            "rng_states": states["rng_states"],
             "last_checkpoint": self.last_checkpoint_file,
             "history": self.history + [checkpoint_step],
             "checkpoint_step_since_last_checkpoint": checkpoint_step,
@@ -150,8 +166,9 @@ class CheckPoint:
 
         return False
 
-    def save(self, file_name, epoch_idx, subfolder=None):
-        to_save = self._generate_save_data(file_name, epoch_idx)
+    def save(self, file_name, epoch_idx, subfolder=None, snapshot=None):
+        """Saves the current states, or the ones of `snapshot` (from snapshot()) if given."""
+        to_save = self._generate_save_data(file_name, epoch_idx, snapshot)
 
         if subfolder:
             folder_path = "./checkpoints/" + subfolder + "/"
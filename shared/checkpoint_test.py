@@ -0,0 +1,23 @@
+import torch
+
+from config import FakeArgs
+from shared.checkpoint import CheckPoint
+
+
+def test_save_snapshot_instead_of_current_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    model = torch.nn.Linear(4, 3)
+    model.model_name = "linear"
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    checkpoint = CheckPoint(FakeArgs(), model, optimizer, None)
+
+    snapshot = checkpoint.snapshot()
+    expected_weight = model.weight.detach().clone()
+    # training goes on before the evaluation of the snapshotted model comes back
+    model(torch.randn(2, 4)).sum().backward()
+    optimizer.step()
+
+    checkpoint.save("snapshot", 0, snapshot=snapshot)
+    saved = torch.load(tmp_path / "checkpoints" / "snapshot.pth")
+    assert torch.equal(saved["model"]["state_dict"]["weight"], expected_weight)
+    assert saved["optimizer"]["state_dict"]["state"] == {}
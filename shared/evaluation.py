@@ -0,0 +1,89 @@
+import itertools
+import torch
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+from shared.metrics import Metric
+
+
+def evaluate_model(
+    model_forward: Callable,
+    criterion: Callable,
+    accuracy_func: Callable,
+    test_loader: Iterable[Any],
+    device: torch.device,
+) -> tuple[float, float]:
+    """Average loss and accuracy of model_forward over test_loader, the model must be in eval."""
+    eval_loss = Metric("Eval loss")
+    eval_accuracy = Metric("Eval accuracy")
+    with torch.no_grad():
+        for batch_inputs, batch_labels in test_loader:
+            if device != torch.device("cpu"):
+                batch_inputs, batch_labels = batch_inputs.to(device), batch_labels.to(device)
+            pred = model_forward(batch_inputs)
+            eval_loss.update(criterion(pred, batch_labels))
+            eval_accuracy.update(accuracy_func(pred, batch_labels))
+    return eval_loss.avg, eval_accuracy.avg
+
+
+class BackgroundEvaluator:
+    """
+    Evaluates a replica of the trained model in a background thread, so training goes on while
+    the test set is evaluated.
+
+    submit(tag, model) copies the weights of `model` into the replica (one copy on the replica's
+    device, on the caller's thread) and queues evaluate(replica, batches of test_loader). Only one
+    evaluation runs at a time: submit first waits for the previous one, so training only stalls
+    when evaluations are submitted faster than they finish. Finished (tag, loss, accuracy) are
+    returned by poll() on the caller's thread, e.g. to log them under the iteration they were
+    submitted at.
+
+    A DataLoader draws its seeds from the global RNG when its iterator is created and its first
+    batch is loaded, so submit does both on the caller's thread, at the same point of the training
+    RNG stream as an inline evaluation. Nothing else in the evaluation may touch the global RNG.
+    """
+
+    def __init__(
+        self,
+        replica: torch.nn.Module,
+        test_loader: Iterable[Any],
+        evaluate: Callable[[torch.nn.Module, Iterable[Any]], tuple[float, float]],
+    ):
+        self.replica = replica
+        self.test_loader = test_loader
+        self.evaluate = evaluate
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending: list[tuple[int, Future]] = []
+
+    def _evaluate_replica(self, batches: Iterable[Any]) -> tuple[float, float]:
+        self.replica.eval()
+        return self.evaluate(self.replica, batches)
+
+    def submit(self, tag: int, model: torch.nn.Module) -> None:
+        for _, future in self.pending:
+            future.result()
+        with torch.no_grad():
+            for replica_tensor, tensor in zip(
+                self.replica.state_dict().values(), model.state_dict().values()
+            ):
+                replica_tensor.copy_(tensor)
+        batch_iterator = iter(self.test_loader)
+        first_batch = next(batch_iterator, None)
+        batches = [] if first_batch is None else itertools.chain([first_batch], batch_iterator)
+        self.pending.append((tag, self.pool.submit(self._evaluate_replica, batches)))
+
+    def poll(self) -> list[tuple[int, float, float]]:
+        """(tag, loss, accuracy) of the evaluations finished since the last call."""
+        finished = []
+        while self.pending and self.pending[0][1].done():
+            tag, future = self.pending.pop(0)
+            finished.append((tag, *future.result()))
+        return finished
+
+    def close(self) -> list[tuple[int, float, float]]:
+        """Wait for the evaluations still running, returns what poll() has not returned yet."""
+        for _, future in self.pending:
+            future.result()
+        finished = self.poll()
+        self.pool.shutdown()
+        return finished
@@ -0,0 +1,82 @@
+import threading
+import torch
+from copy import deepcopy
+from torch.utils.data import DataLoader, TensorDataset
+
+from shared.evaluation import BackgroundEvaluator, evaluate_model
+from shared.metrics import accuracy
+
+
+def test_background_evaluation_matches_inline():
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 3)
+    test_loader = [(torch.randn(5, 4), torch.randint(0, 3, (5,))) for _ in range(3)]
+    criterion = torch.nn.CrossEntropyLoss()
+
+    def evaluate(m, batches):
+        return evaluate_model(m, criterion, accuracy, batches, torch.device("cpu"))
+
+    evaluator = BackgroundEvaluator(torch.nn.Linear(4, 3), test_loader, evaluate)
+    expected = []
+    for step in range(3):
+        with torch.no_grad():
+            model.weight.add_(0.1)
+        expected.append((step, *evaluate(model, test_loader)))
+        evaluator.submit(step, model)
+        # training goes on while the replica is evaluated
+        with torch.no_grad():
+            model.weight.add_(1.0)
+    results = evaluator.poll()
+    results += evaluator.close()
+
+    assert [result[0] for result in results] == [0, 1, 2]
+    for (step, loss, acc), (expected_step, expected_loss, expected_acc) in zip(results, expected):
+        assert step == expected_step
+        assert loss == expected_loss and acc == expected_acc
+
+
+def train_seeded(background_eval: bool) -> tuple[torch.Tensor, list[tuple[int, float, float]]]:
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 3)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    criterion = torch.nn.CrossEntropyLoss()
+    train_loader = DataLoader(
+        TensorDataset(torch.randn(16, 4), torch.randint(0, 3, (16,))), batch_size=4, shuffle=True
+    )
+    test_loader = DataLoader(
+        TensorDataset(torch.randn(8, 4), torch.randint(0, 3, (8,))), batch_size=4, shuffle=True
+    )
+    device = torch.device("cpu")
+    trained = threading.Semaphore(0)
+
+    def evaluate(m, batches):
+        # the evaluation of an epoch only starts once the next epoch trained
+        trained.acquire()
+        return evaluate_model(m, criterion, accuracy, batches, device)
+
+    evaluator = BackgroundEvaluator(deepcopy(model), test_loader, evaluate)
+    results = []
+    for epoch in range(3):
+        for inputs, labels in train_loader:
+            optimizer.zero_grad()
+            criterion(model(inputs), labels).backward()
+            optimizer.step()
+        if background_eval:
+            if epoch > 0:
+                trained.release()
+            evaluator.submit(epoch, model)
+        else:
+            eval_loss, eval_accuracy = evaluate_model(
+                model, criterion, accuracy, test_loader, device
+            )
+            results.append((epoch, eval_loss, eval_accuracy))
+    trained.release()
+    results += evaluator.close()
+    return model.weight.detach(), results
+
+
+def test_background_evaluation_keeps_seeded_training_reproducible():
+    inline_weight, inline_results = train_seeded(background_eval=False)
+    background_weight, background_results = train_seeded(background_eval=True)
+    assert torch.equal(inline_weight, background_weight)
+    assert background_results == inline_results
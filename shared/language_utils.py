@@ -1,5 +1,7 @@
+import os
+import numpy as np
 import torch
-from typing import Literal
+from typing import Literal, Sequence
 from enum import Enum
 from functools import partial
 from dataclasses import dataclass
@@ -56,6 +58,93 @@ class CustomLMDataset(torch.utils.data.DataLoader):
         return torch.tensor(input_ids, dtype=torch.long)
 
 
+# Bump when the cache format, a template's wording or the cached dataset contents change, the key
+# only has the names of the template and dataset.
+TOKEN_CACHE_VERSION = 1
+
+
+def get_token_cache_path(
+    cache_dir: str, dataset: str, split: str, template, tokenizer, max_length: int
+) -> str:
+    """Path prefix of the token cache of a split, keyed by everything the token ids depend on."""
+    key = (
+        f"v{TOKEN_CACHE_VERSION}-{dataset}-{split}-{type(template).__name__}"
+        f"-{tokenizer.name_or_path}-{max_length}"
+    )
+    return os.path.join(cache_dir, key.replace("/", "_"))
+
+
+def build_token_cache(path: str, texts: Sequence[str], tokenizer, max_length: int) -> None:
+    """
+    Tokenize texts once (left truncated, like CustomLMDataset) into `path`.tokens.npy, the token
+    ids of all texts in one flat int32 array, and `path`.offsets.npy, where text i is
+    tokens[offsets[i] : offsets[i + 1]]. The offsets are written last, so a cache with offsets
+    is complete.
+    """
+    input_ids = tokenizer(list(texts), add_special_tokens=True)["input_ids"]
+    offsets = np.zeros(len(input_ids) + 1, dtype=np.int64)
+    np.cumsum([min(len(ids), max_length) for ids in input_ids], out=offsets[1:])
+    tokens = np.empty(offsets[-1], dtype=np.int32)
+    for i, ids in enumerate(input_ids):
+        tokens[offsets[i] : offsets[i + 1]] = ids[-max_length:]
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    for suffix, array in [(".tokens.npy", tokens), (".offsets.npy", offsets)]:
+        # np.save appends .npy to names without it
+        tmp_path = f"{path}.tmp{suffix}"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path + suffix)
+
+
+class TokenizedLMDataset(torch.utils.data.Dataset):
+    """
+    Same items as CustomLMDataset, sliced from a token cache written by build_token_cache instead
+    of tokenized on every access. The arrays are memory-mapped, so all clients and dataloader
+    workers share the page cache; pickling (e.g. into client worker processes) only sends the path.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = np.load(path + ".offsets.npy")
+        self._tokens: np.ndarray | None = None
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path + ".offsets.npy")
+
+    @property
+    def tokens(self) -> np.ndarray:
+        if self._tokens is None:
+            self._tokens = np.load(self.path + ".tokens.npy", mmap_mode="r")
+        return self._tokens
+
+    def __getstate__(self):
+        return {**self.__dict__, "_tokens": None}
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of tokens of every item, without reading the tokens."""
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        input_ids = self.tokens[self.offsets[idx] : self.offsets[idx + 1]]
+        return torch.from_numpy(input_ids.astype(np.int64))
+
+
+def load_tokenized_lm_dataset(
+    cache_dir: str, dataset: str, split: str, template, tokenizer, max_length: int, get_samples
+) -> TokenizedLMDataset:
+    """TokenizedLMDataset of a split, get_samples() is only verbalized on a cache miss."""
+    path = get_token_cache_path(cache_dir, dataset, split, template, tokenizer, max_length)
+    if not TokenizedLMDataset.exists(path):
+        texts = list(map(template.verbalize, get_samples()))
+        build_token_cache(path, texts, tokenizer, max_length)
+    return TokenizedLMDataset(path)
+
+
 class ClassificationTemplate:
     verbalizer = {0: "0", 1: "1"}
 
@@ -171,20 +260,68 @@ class LLMBatchInput:
         return self
 
 
+def collate_lm_batch(pad_token_id: int, batch: list[torch.Tensor]):
+    # Left pad to the longest sequence in the batch, same as tokenizer.pad with padding_side="left"
+    lengths = torch.tensor([len(input_ids) for input_ids in batch])
+    max_length = int(lengths.max())
+    attention_mask = torch.arange(max_length) >= (max_length - lengths).unsqueeze(1)
+    input_ids = torch.full((len(batch), max_length), pad_token_id, dtype=torch.long)
+    # the unpadded positions, in row-major order, are the concatenated sequences
+    input_ids[attention_mask] = torch.cat(batch)
+    attention_mask = attention_mask.long()
+    return (
+        LLMBatchInput(input_ids[:, :(-1)], attention_mask[:, :(-1)]),
+        input_ids[:, 1:],
+    )  # Prepare input and target sequences
+
+
 def get_collate_fn(tokenizer, max_length):
-    def collate_fn(batch):
-        # Pad sequences to the max length in the batch
-        padded_batch = tokenizer.pad(
-            {"input_ids": batch}, padding=True, max_length=max_length, return_tensors="pt"
-        )
-        input_ids = padded_batch["input_ids"]
-        attention_mask = padded_batch["attention_mask"]
-        return (
-            LLMBatchInput(input_ids[:, :(-1)], attention_mask[:, :(-1)]),
-            input_ids[:, 1:],
-        )  # Prepare input and target sequences
+    """Collate of left padded batches, sequences are already truncated to max_length."""
+    assert tokenizer.padding_side == "left"
+    # partial instead of a closure, so dataloaders can be pickled into client worker processes
+    return partial(collate_lm_batch, tokenizer.pad_token_id)
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler[list[int]]):
+    """
+    Batches of similar lengths, so a long sequence does not make a whole batch of short ones pad
+    (and attend) to its length. Every epoch the indices are shuffled, cut into buckets of
+    bucket_batches * batch_size, each bucket is sorted by length and cut into batches and the
+    batches of all buckets are shuffled. bucket_batches=1 gives plain shuffled batches.
+
+    The fraction of padded tokens of every epoch started is appended to padding_waste.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        bucket_batches: int = 1,
+        generator: torch.Generator | None = None,
+    ):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.generator = generator
+        self.padding_waste: list[float] = []
 
-    return collate_fn
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths), generator=self.generator)
+        batches = []
+        for bucket in indices.split(self.bucket_batches * self.batch_size):
+            bucket = bucket[self.lengths[bucket].argsort(stable=True)]
+            batches += bucket.split(self.batch_size)
+        order = torch.randperm(len(batches), generator=self.generator).tolist()
+        batches = [batches[i] for i in order]
+
+        num_tokens = int(self.lengths.sum())
+        num_padded = sum(len(batch) * int(self.lengths[batch].max()) for batch in batches)
+        self.padding_waste.append(1 - num_tokens / num_padded if num_padded else 0.0)
+        for batch in batches:
+            yield batch.tolist()
 
 
 def get_lm_loss(
@@ -220,11 +357,21 @@ def full_sentence_cross_entropy_loss(batch_pred, sentence_label_tokens):
     return loss
 
 
+def last_token_verbalizer_logits(batch_pred, verbalizer_id_list) -> torch.Tensor:
+    """
+    [batch, len(verbalizer_id_list)] logits of the verbalizer tokens at the last position. A
+    tensor batch_pred already is that, see RandomGradientEstimator's verbalizer_id_list.
+    """
+    if isinstance(batch_pred, torch.Tensor):
+        return batch_pred
+    logits = batch_pred.logits
+    return logits[:, -1, verbalizer_id_list].view(-1, len(verbalizer_id_list))
+
+
 def last_token_cross_entropy_loss(
     batch_pred, sentence_label_tokens, verbalizer_id_map, verbalizer_id_list
 ):
-    logits = batch_pred.logits
-    last_token_batch_pred = logits[:, -1, verbalizer_id_list].view(-1, len(verbalizer_id_list))
+    last_token_batch_pred = last_token_verbalizer_logits(batch_pred, verbalizer_id_list)
     last_token_label = (sentence_label_tokens[:, -1] == verbalizer_id_map[1]).to(int)
 
     loss = torch.nn.functional.cross_entropy(last_token_batch_pred, last_token_label)
@@ -232,9 +379,8 @@ def last_token_cross_entropy_loss(
 
 
 def last_token_accuracy(batch_pred, sentence_label_tokens, verbalizer_id_map, verbalizer_id_list):
-    logits = batch_pred.logits
-    last_token_batch_pred = logits[:, -1, verbalizer_id_list].view(-1, len(verbalizer_id_list))
+    last_token_batch_pred = last_token_verbalizer_logits(batch_pred, verbalizer_id_list)
     last_token_label = (sentence_label_tokens[:, -1] == verbalizer_id_map[1]).to(int)
 
     pred = last_token_batch_pred.max(1, keepdim=True)[1]
-    return pred.eq(last_token_label.view_as(pred)).cpu().float().mean()
+    return pred.eq(last_token_label.view_as(pred)).float().mean()
@@ -0,0 +1,87 @@
+import pickle
+import torch
+
+from shared.language_utils import (
+    CustomLMDataset,
+    LengthBucketBatchSampler,
+    SST2Template,
+    TokenizedLMDataset,
+    get_collate_fn,
+    load_tokenized_lm_dataset,
+)
+
+
+class CharTokenizer:
+    """Stand-in for a HF tokenizer: one token per character after a BOS token."""
+
+    name_or_path = "test/char"
+    padding_side = "left"
+    pad_token_id = 1
+
+    def encode(self, text, add_special_tokens=True):
+        return ([2] if add_special_tokens else []) + [ord(c) for c in text]
+
+    def __call__(self, texts, add_special_tokens=True):
+        return {"input_ids": [self.encode(text, add_special_tokens) for text in texts]}
+
+
+def test_token_cache_matches_tokenizing_on_access(tmp_path):
+    samples = [
+        {"sentence": "great movie", "label": 1},
+        {"sentence": "", "label": 0},
+        {"sentence": "a long and boring story", "label": 0},
+    ]
+    template, tokenizer = SST2Template(), CharTokenizer()
+    num_loads = []
+
+    def get_samples():
+        num_loads.append(1)
+        return samples
+
+    for _ in range(2):
+        dataset = load_tokenized_lm_dataset(
+            str(tmp_path), "sst2", "train", template, tokenizer, 16, get_samples
+        )
+    # the second launch only maps the cache
+    assert len(num_loads) == 1
+
+    expected = CustomLMDataset(list(map(template.verbalize, samples)), tokenizer, 16)
+    assert len(dataset) == len(expected)
+    for i in range(len(dataset)):
+        assert dataset[i].dtype == torch.long
+        assert torch.equal(dataset[i], expected[i])
+
+    # pickling sends the path, not the mapped tokens
+    dataset.tokens
+    unpickled = pickle.loads(pickle.dumps(dataset))
+    assert isinstance(unpickled, TokenizedLMDataset) and unpickled._tokens is None
+    assert torch.equal(unpickled[2], expected[2])
+
+
+def test_collate_left_pads_batch():
+    batch = [torch.tensor([2, 5, 6]), torch.tensor([2, 7]), torch.tensor([2, 8, 9, 10])]
+    batch_input, labels = get_collate_fn(CharTokenizer(), 16)(batch)
+
+    expected_ids = torch.tensor([[1, 2, 5, 6], [1, 1, 2, 7], [2, 8, 9, 10]])
+    expected_mask = torch.tensor([[0, 1, 1, 1], [0, 0, 1, 1], [1, 1, 1, 1]])
+    assert torch.equal(batch_input.input_ids, expected_ids[:, :-1])
+    assert torch.equal(batch_input.attention_mask, expected_mask[:, :-1])
+    assert torch.equal(labels, expected_ids[:, 1:])
+
+
+def test_length_bucket_batches_cover_epoch_and_reduce_padding():
+    lengths = torch.randint(1, 200, (100,), generator=torch.Generator().manual_seed(0))
+    samplers = [
+        LengthBucketBatchSampler(
+            lengths, batch_size=8, bucket_batches=bucket_batches, generator=torch.Generator()
+        )
+        for bucket_batches in [1, 4]
+    ]
+    for sampler in samplers:
+        for _ in range(2):
+            batches = list(sampler)
+            assert len(batches) == len(sampler)
+            assert sorted(i for batch in batches for i in batch) == list(range(100))
+    shuffled, bucketed = samplers
+    assert len(bucketed.padding_waste) == 2
+    assert max(bucketed.padding_waste) < min(shuffled.padding_waste)
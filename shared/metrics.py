@@ -1,29 +1,59 @@
 import torch
 
 
-def accuracy(output: torch.tensor, target: torch.tensor) -> float:
-    # get the index of the max log-probability
+def accuracy(output: torch.tensor, target: torch.tensor) -> torch.Tensor:
+    # get the index of the max log-probability, on the device of output
     pred = output.max(1, keepdim=True)[1]
-    return pred.eq(target.view_as(pred)).cpu().float().mean()
+    return pred.eq(target.view_as(pred)).float().mean()
 
 
 class Metric(object):
-    def __init__(self, name):
+    """
+    Running average. Tensor values are summed on their own device, so update does not wait for
+    the device: the sum only goes to the host when avg is read, or every flush_interval updates
+    if set (which bounds how much is accumulated in float32 on the device).
+
+    A value may hold one entry per client (or any fixed shape), e.g. the losses of all clients of
+    a round in one update; avg is then a list.
+    """
+
+    def __init__(self, name, flush_interval: int | None = None):
         self.name = name
-        self.sum = torch.tensor(0.0)  # pylint: disable=not-callable
-        self.n = torch.tensor(0.0)  # pylint: disable=not-callable
+        self.flush_interval = flush_interval
+        self.reset()
 
     def reset(self):
-        self.sum = torch.tensor(0.0)  # pylint: disable=not-callable
-        self.n = torch.tensor(0.0)  # pylint: disable=not-callable
+        self.host_sum = torch.tensor(0.0, dtype=torch.float64)
+        self.device_sum: torch.Tensor | None = None
+        self.n = 0
 
     def update(self, val: float | torch.Tensor):
-        if isinstance(val, float):
-            self.sum += val
+        if isinstance(val, torch.Tensor):
+            if self.device_sum is None:
+                self.device_sum = val.detach().to(torch.float32, copy=True)
+            else:
+                self.device_sum += val.detach()
         else:
-            self.sum += val.detach().cpu()
+            self.host_sum += val
         self.n += 1
+        if self.flush_interval and self.n % self.flush_interval == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        """Move the device sum to the host, this waits for the device."""
+        if self.device_sum is not None:
+            self.host_sum = self.host_sum + self.device_sum.cpu()
+            self.device_sum = None
+
+    @property
+    def avg_tensor(self) -> torch.Tensor:
+        """Average without a sync, on the device of the tensor values (else on the host)."""
+        if self.device_sum is None:
+            return (self.host_sum / self.n).float()
+        total = self.device_sum + self.host_sum.to(self.device_sum.device, torch.float32)
+        return total / self.n
 
     @property
-    def avg(self) -> float:
-        return (self.sum / self.n).item()
+    def avg(self) -> float | list[float]:
+        self.flush()
+        return (self.host_sum / self.n).tolist()
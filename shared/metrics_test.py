@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from shared.metrics import Metric
+
+
+@pytest.mark.parametrize("flush_interval", [None, 2])
+def test_metric_average_of_floats_and_tensors(flush_interval):
+    metric = Metric("loss", flush_interval=flush_interval)
+    for value in [1.0, torch.tensor(2.0), torch.tensor(3.0), 6.0, torch.tensor(3.0)]:
+        metric.update(value)
+
+    torch.testing.assert_close(metric.avg_tensor, torch.tensor(3.0))
+    assert metric.avg == pytest.approx(3.0)
+    # reading avg moved the sum to the host
+    assert metric.device_sum is None
+    metric.update(torch.tensor(9.0))
+    assert metric.avg == pytest.approx(4.0)
+
+
+def test_metric_values_do_not_alias_sum():
+    metric = Metric("loss")
+    value = torch.tensor(1.0)
+    metric.update(value)
+    value.add_(10)
+    assert metric.avg == pytest.approx(1.0)
+
+
+def test_metric_of_several_clients():
+    metric = Metric("Client train loss")
+    metric.update(torch.tensor([1.0, 2.0, 3.0]))
+    metric.update(torch.tensor([3.0, 2.0, 1.0]))
+
+    torch.testing.assert_close(metric.avg_tensor, torch.tensor([2.0, 2.0, 2.0]))
+    assert metric.avg == pytest.approx([2.0, 2.0, 2.0])